@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import argparse
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from model_registry import registry, SRC_DIR, RF_MODEL_PATH, RF_FEATURES_PATH, LDA_MODEL_PATH, LDA_DICTIONARY_PATH
+
+
+#Parallel full-census scoring.  Cohort and hold-out stays are split into shards by a hash of subject_id and each
+#shard runs extract -> daily grid -> featurize -> score -> upsert in its own worker process, on its own pooled
+#connection, committing its scores and watermarks together.  Models are loaded once per worker.  Finished shards
+#are recorded in a manifest file, so a run that dies partway is resumed by running it again.
+#   python bulk_scoring.py --shards 32 --workers 8
+#   python bulk_scoring.py --restart        ignore the manifest and score every shard
+#   python bulk_scoring.py --pivots         refresh the daily lab/vital pivot tables (daily_pivots.py) and extract from them
+
+DEFAULT_MANIFEST = os.path.join(SRC_DIR, 'bulk_scoring_manifest.json')
+BULK_SQL = {'patientsql': 'bulk_member_model_extraction.sql', 'labsql': 'bulk_member_model_labs.sql',
+            'vitalsql': 'bulk_member_model_chart_events.sql', 'echoecgsql': 'bulk_member_echo_ecg_notes.sql'}
+
+
+def shard_of(subject_ids, n_shards):
+    """
+    Overview:
+        Stable shard assignment by subject: multiplicative (Fibonacci) hash of subject_id modulo the shard count, so
+        all stays of a patient land in the same shard and the assignment is identical across runs and machines.
+    Parameters:
+        subject_ids: array-like of int
+        n_shards: int
+    Returns:
+        array of shard numbers
+    """
+    ids = np.asarray(subject_ids, dtype=np.uint64)
+    return ((ids * np.uint64(2654435761)) % np.uint64(2**32) % np.uint64(n_shards)).astype(np.int64)
+
+def census_stays(conn):
+    """
+    Overview:
+        All ICU stays in the cohort and hold-out tables.
+    Parameters:
+        conn: connection
+            Active database connection
+    Returns:
+        dataframe of subject_id, hadm_id, icustay_id
+    """
+    query = """
+    select ie.subject_id, ie.hadm_id, ie.icustay_id
+    from icustays ie
+    join (select icustay_id from cohort union select icustay_id from hold_out) ap on ap.icustay_id = ie.icustay_id
+    order by ie.subject_id, ie.icustay_id
+    """
+    with conn.cursor() as cur:
+        cur.execute(query)
+        rows = cur.fetchall()
+    return pd.DataFrame(rows, columns=['subject_id', 'hadm_id', 'icustay_id'])
+
+def load_manifest(path, n_shards, model_path):
+    """
+    Overview:
+        Reads the run manifest, or starts a new one if there is none or it belongs to a different shard count or model.
+    Returns:
+        dict with n_shards, model and shards (shard number as str -> result of the finished shard)
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['n_shards'] == n_shards and manifest['model'] == os.path.abspath(model_path):
+            return manifest
+        print(f'Manifest {path} is for a different run - starting over')
+    return {'n_shards': n_shards, 'model': os.path.abspath(model_path), 'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'shards': {}}
+
+def save_manifest(manifest, path):
+    """
+    Writes the manifest atomically (temp file then rename), so a crash never leaves it half written.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+
+
+_worker = {}
+
+def init_worker(model_path, pipeline_path, connection_details):
+    """
+    Process pool initializer - loads the classifier, feature pipeline and topic model once per worker process.
+    """
+    from mimic_fxns import load_topic_dictionary
+    _worker['model'] = registry.get(model_path)
+    _worker['pipeline'] = registry.get(pipeline_path) if pipeline_path and os.path.exists(pipeline_path) else None
+    load_topic_dictionary(registry.get(LDA_MODEL_PATH), LDA_DICTIONARY_PATH)
+    _worker['connection_details'] = connection_details
+
+def score_shard(shard, stays, sql_files=BULK_SQL):
+    """
+    Overview:
+        Scores every day of every stay in one shard and upserts the scores and the stays' watermarks in one transaction.
+        Runs in a pool worker (see init_worker).
+    Parameters:
+        shard: int
+            Shard number (for reporting)
+        stays: dataframe
+            subject_id, hadm_id, icustay_id of the shard's stays
+        sql_files: dict
+            Bulk extraction queries (patientsql, labsql, vitalsql, echoecgsql)
+    Returns:
+        dict with the shard number, stays, daily rows written and elapsed seconds
+    """
+    from mimic_fxns import connect, release
+    from daily_grid import build_daily_grid, score_daily_grid, prepare_bulk_frames
+    from incremental_scoring import stage_scope, scoped_extraction, scope_last_events, upsert_risk, advance_watermarks
+    start = time.perf_counter()
+    id_cols = ['subject_id', 'hadm_id', 'icustay_id']
+    conn = connect(_worker['connection_details'])
+    try:
+        stage_scope(conn, stays)
+        #each extraction reads icustays restricted to this shard's stays (scope_query), so the event joins and the
+        #daily grouping only see the shard's events
+        pt_admit = scoped_extraction(sql_files['patientsql'], conn)
+        pt_labs = scoped_extraction(sql_files['labsql'], conn)
+        pt_vitals = scoped_extraction(sql_files['vitalsql'], conn)
+        pt_ee_notes = scoped_extraction(sql_files['echoecgsql'], conn)
+        pt_admit, pt_labs, pt_vitals, pt_ee_docs = prepare_bulk_frames(pt_admit, pt_labs, pt_vitals, pt_ee_notes, id_cols)
+
+        daily_df = build_daily_grid(pt_admit, pt_labs, pt_vitals, pt_ee_docs)
+        X, y, risk = score_daily_grid(daily_df, list(pt_admit.columns), list(pt_labs.columns), list(pt_vitals.columns),
+                                      list(pt_ee_notes.columns), _worker['model'], pipeline=_worker['pipeline'])
+        daily_df['mortality_risk'] = risk
+        upsert_risk(conn, daily_df)
+        advance_watermarks(conn, scope_last_events(conn))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release(conn)
+    return {'shard': shard, 'stays': int(stays.shape[0]), 'rows': int(daily_df.shape[0]),
+            'seconds': round(time.perf_counter() - start, 2)}
+
+def run_shards(shard_stays, manifest, manifest_path, workers, initargs, task=score_shard, initializer=init_worker):
+    """
+    Overview:
+        Runs the unfinished shards on a process pool, recording each one in the manifest as it completes.
+        A failed shard is reported and left unfinished for the next run; the other shards carry on.
+    Parameters:
+        shard_stays: dict
+            Shard number -> dataframe of its stays
+        manifest: dict
+            Run manifest (see load_manifest)
+        manifest_path: str
+            Where the manifest is saved
+        workers: int
+            Worker processes
+        initargs: tuple
+            Arguments for the initializer
+        task: callable
+            Function run per shard, taking the shard number and its stays
+        initializer: callable
+            Per-worker setup, defaults to init_worker
+    Returns:
+        list of shard numbers that failed
+    """
+    pending = [shard for shard in sorted(shard_stays) if str(shard) not in manifest['shards']]
+    print(f'{len(shard_stays) - len(pending)} shards already done, {len(pending)} to score on {workers} workers')
+    failed = []
+    #spawned (not forked) workers, so no parent database connection is shared with a child
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initializer, initargs=initargs) as pool:
+        futures = {pool.submit(task, shard, shard_stays[shard]): shard for shard in pending}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                result = future.result()
+            except Exception as error:
+                print(f'Shard {shard} failed: {error}')
+                failed.append(shard)
+                continue
+            manifest['shards'][str(shard)] = result
+            save_manifest(manifest, manifest_path)
+            print(f'Shard {shard}: {result["rows"]} daily rows for {result["stays"]} stays in {result["seconds"]} s')
+    return failed
+
+def bulk_score(n_shards=32, workers=None, model_path=RF_MODEL_PATH, pipeline_path=RF_FEATURES_PATH,
+               manifest_path=DEFAULT_MANIFEST, restart=False, connection_details=None, pivots=False):
+    """
+    Overview:
+        Full-census refresh of the daily risk scores, sharded by subject across a process pool and resumable per shard.
+        Stays added to a shard after it finished in an interrupted run are left to the incremental refresh, which
+        scores any stay without a watermark.
+    Parameters:
+        n_shards: int
+            Number of subject-hash shards - more shards than workers keeps the pool busy and makes resumes cheaper
+        workers: int, optional
+            Worker processes, defaults to the CPU count
+        model_path, pipeline_path: str
+            Classifier and the feature pipeline saved with it (the pipeline is optional)
+        manifest_path: str
+            Manifest file recording finished shards
+        restart: bool
+            If True any existing manifest is discarded and every shard is scored
+        connection_details: dict, optional
+            Connection parameters, defaults to connect_details()
+        pivots: bool
+            If True the daily pivot tables are refreshed first and labs/vitals are extracted from them instead of the raw events
+    Returns:
+        manifest dict
+    """
+    from mimic_fxns import connect, release, connect_details
+    if connection_details is None:
+        connection_details = connect_details()
+    if workers is None:
+        workers = os.cpu_count()
+    if restart and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    manifest = load_manifest(manifest_path, n_shards, model_path)
+
+    from incremental_scoring import ensure_tables
+    sql_files = BULK_SQL
+    conn = connect(connection_details)
+    try:
+        #created once here - concurrent create table if not exists in the workers can collide on pg_type
+        ensure_tables(conn)
+        if pivots:
+            from daily_pivots import refresh_pivots, PIVOT_SQL
+            refresh_pivots(conn)
+            sql_files = {**BULK_SQL, **PIVOT_SQL}
+        stays = census_stays(conn)
+    finally:
+        release(conn)
+    stays['shard'] = shard_of(stays['subject_id'], n_shards)
+    shard_stays = {int(shard): group.drop(columns='shard').reset_index(drop=True) for shard, group in stays.groupby('shard')}
+    print(f'{stays.shape[0]} stays in {len(shard_stays)} shards')
+
+    start = time.perf_counter()
+    failed = run_shards(shard_stays, manifest, manifest_path, workers, (model_path, pipeline_path, connection_details),
+                        task=functools.partial(score_shard, sql_files=sql_files))
+    elapsed = time.perf_counter() - start
+    rows = sum(result['rows'] for result in manifest['shards'].values())
+    if failed:
+        print(f'{len(failed)} shards failed ({sorted(failed)}) - run again to resume')
+    else:
+        manifest['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        save_manifest(manifest, manifest_path)
+        print(f'All {len(shard_stays)} shards scored, {rows} daily rows, {elapsed:.1f} s this run')
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel full-census daily ICU mortality risk scoring')
+    parser.add_argument('--shards', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--model', default=RF_MODEL_PATH, help='pickled classifier, or a flat forest directory (forest_export.py)')
+    parser.add_argument('--pipeline', default=RF_FEATURES_PATH)
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST)
+    parser.add_argument('--restart', action='store_true', help='discard the manifest and score every shard')
+    parser.add_argument('--pivots', action='store_true', help='refresh and extract from the daily lab/vital pivot tables')
+    args = parser.parse_args()
+    bulk_score(args.shards, args.workers, args.model, args.pipeline, args.manifest, args.restart, pivots=args.pivots)
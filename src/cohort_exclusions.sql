@@ -0,0 +1,22 @@
+select adm.subject_id, adm.hadm_id, icustay_id
+, case 
+  when deathtime < admittime then 1
+  else 0 end as excl_death_prior
+, case 
+    when icustay_id is null then 1
+  else 0 end as excl_no_icu
+, case 
+  when los <= (4.0/24) then 1
+  else 0 end as excl_4hr_stay
+, case
+    when date_part('years', AGE(intime,dob)) < 20 then 1
+    else 0 end as excl_age
+, case 
+    when adm.diagnosis like '%TRANSPLANT%' then 1
+    else 0 end as excl_transplant
+, case 
+    when adm.diagnosis like '%BURN%' then 1
+    else 0 end as excl_burns
+from admissions adm
+left join icustays icu on adm.hadm_id = icu.hadm_id
+left join patients pat on adm.subject_id = pat.subject_id
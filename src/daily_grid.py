@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+from mimic_fxns import data_processing, normal_lab_vital_ranges, data_processing_column_refs, align_to_model, KEY_COLUMNS
+from pipeline_metrics import stage
+
+
+def daily_grid_column_refs():
+    id_cols = ['subject_id', 'hadm_id', 'icustay_id']
+    day_cols = ['dos', 'day_n']
+    left_cols = id_cols + ['dos']
+    right_cols = id_cols + ['chartdate']
+    return id_cols, day_cols, left_cols, right_cols
+
+def expand_stay_days(pt_admit, id_cols=None):
+    """
+    Overview:
+        Expands each ICU stay into one row per calendar day from intime to outtime (inclusive), without a per-stay loop.
+        Stay day counts are computed once, ids are repeated and dates of service are built from an offset arange.
+    Parameters:
+        pt_admit: dataframe
+            One row per ICU stay with the id columns plus 'intime' and 'outtime'
+        id_cols: list
+            Id columns carried onto each daily row
+    Returns:
+        dataframe with columns dos, day_n, id columns and stay_id, in pt_admit row order
+    """
+    if id_cols is None:
+        id_cols = daily_grid_column_refs()[0]
+    #kept at the resolution pandas parsed them to, so dos matches the chartdate columns it is merged with
+    intime = pd.to_datetime(pt_admit['intime']).to_numpy()
+    outtime = pd.to_datetime(pt_admit['outtime']).to_numpy()
+    one_day = np.timedelta64(1, 'D')
+    n_days = np.maximum((outtime - intime) // one_day + 1, 0)
+
+    stay_idx = np.repeat(np.arange(len(n_days)), n_days)
+    stay_start = np.repeat(np.cumsum(n_days) - n_days, n_days)
+    day_n = np.arange(len(stay_idx)) - stay_start + 1
+
+    daily = pd.DataFrame({'dos': intime[stay_idx] + (day_n - 1) * one_day, 'day_n': day_n})
+    for col in id_cols:
+        daily[col] = pt_admit[col].to_numpy()[stay_idx]
+    daily['stay_id'] = daily['subject_id'].astype('str') + '_' + daily['hadm_id'].astype('str') + '_' + daily['icustay_id'].astype('str')
+    return daily
+
+def prepare_bulk_frames(pt_admit, pt_labs, pt_vitals, pt_ee_notes, id_cols):
+    """
+    Applies the same clean-up to the bulk extractions as the bulk modeling notebook before grid building.
+    """
+    pt_admit = pt_admit.dropna(axis=0, subset=['intime', 'outtime'])
+    pt_labs = pt_labs.dropna(axis=0, subset=['chartdate'])
+    pt_labs['chartdate'] = pd.to_datetime(pt_labs['chartdate'])
+    pt_vitals = pt_vitals.dropna(axis=0, subset=['chartdate'])
+    pt_vitals['chartdate'] = pd.to_datetime(pt_vitals['chartdate'])
+    pt_ee_notes = pt_ee_notes.dropna(axis=0)
+    pt_ee_docs = pt_ee_notes[id_cols + ['chartdate', 'echo_ecg']].groupby(id_cols + ['chartdate']).sum()
+    pt_ee_docs.reset_index(inplace=True)
+    pt_ee_docs['chartdate'] = pd.to_datetime(pt_ee_docs['chartdate'])
+    return pt_admit, pt_labs, pt_vitals, pt_ee_docs
+
+def build_daily_grid(pt_admit, labs, vitals, notes, stay_col='icustay_id'):
+    """
+    Overview:
+        Builds the daily patient-day data set used for bulk scoring: one row per ICU stay day with that day's labs, vitals
+        and echo/ecg notes, the last available values carried forward within each stay, and the admission attributes attached.
+        Produces the same rows as the per-stay loops of the bulk modeling notebook.
+    Parameters:
+        pt_admit: dataframe
+            Admission/ICU stay data with intime and outtime (bulk_member_model_extraction.sql)
+        labs: dataframe
+            Daily lab values keyed on the id columns and a datetime 'chartdate' (bulk_member_model_labs.sql)
+        vitals: dataframe
+            Daily vitals keyed the same way (bulk_member_model_chart_events.sql)
+        notes: dataframe
+            Echo/ecg documents aggregated to one row per stay and chartdate (bulk_member_echo_ecg_notes.sql)
+        stay_col: str
+            Column identifying a stay for the forward fill
+    Returns:
+        dataframe of daily rows
+    """
+    id_cols, day_cols, left_cols, right_cols = daily_grid_column_refs()
+    daily_df = expand_stay_days(pt_admit, id_cols)
+
+    for events in (labs, vitals, notes):
+        daily_df = daily_df.merge(events, how='left', left_on=left_cols, right_on=right_cols)
+        daily_df.drop('chartdate', axis=1, inplace=True)
+
+    #carry forward last available values within each stay - rows of a stay are contiguous and in date order
+    fill_cols = [col for col in daily_df.columns if col != stay_col]
+    daily_df[fill_cols] = daily_df.groupby(stay_col, sort=False)[fill_cols].ffill()
+
+    return daily_df.merge(pt_admit, how='inner', on=id_cols)
+
+def daily_model_inputs(daily_df, admit_cols, lab_cols, vital_cols, note_cols):
+    """
+    Overview:
+        Splits the daily grid back into the admission, lab, vital and note frames data_processing expects, keyed by date of service.
+    Parameters:
+        daily_df: dataframe
+            Output of build_daily_grid
+        admit_cols, lab_cols, vital_cols, note_cols: list
+            Columns of the original extractions (admission, labs, vitals, echo/ecg notes)
+    Returns:
+        labs, admits, vitals, echoecg dataframes
+    """
+    ad = [col for col in admit_cols if col not in ('intime', 'outtime')] + ['dos', 'stay_id']
+    lb = [col for col in lab_cols if col != 'chartdate'] + ['dos']
+    vt = [col for col in vital_cols if col != 'chartdate'] + ['dos']
+    ee = [col for col in note_cols if col != 'chartdate'] + ['dos']
+    labs = daily_df[lb].copy()
+    admits = daily_df[ad].copy()
+    vitals = daily_df[vt].copy()
+    echoecg = daily_df[ee].dropna(axis=0, how='any').reset_index(drop=True)
+    return labs, admits, vitals, echoecg
+
+def score_daily_grid(daily_df, admit_cols, lab_cols, vital_cols, note_cols, model, norm_ranges=None, pipeline=None):
+    """
+    Overview:
+        Featurizes the daily grid and returns the model's mortality risk for each daily row.
+    Parameters:
+        daily_df: dataframe
+            Output of build_daily_grid
+        admit_cols, lab_cols, vital_cols, note_cols: list
+            Columns of the original extractions
+        model: obj
+            Fit classifier with predict_proba
+        norm_ranges: dict, optional
+            Lab/vital normal ranges.  Defaults to normal_lab_vital_ranges().
+        pipeline: FeaturePipeline, optional
+            Fitted feature pipeline saved with the model.  If given, features come from it (no refit of the encoder)
+            and X is returned as its float32 matrix.
+    Returns:
+        X: dataframe of features (or float32 matrix with a pipeline), y: labels, risk: 1d array aligned with the rows of X
+    """
+    if norm_ranges is None:
+        norm_ranges = normal_lab_vital_ranges()
+    id_cols, month_col, age_col, encoding_cols, chronic_cols, merge_cols = data_processing_column_refs()
+    labs, admits, vitals, echoecg = daily_model_inputs(daily_df, admit_cols, lab_cols, vital_cols, note_cols)
+    if pipeline is not None:
+        X, y, keys = pipeline.transform(labs, admits, vitals, echoecg, merge_cols=merge_cols + ['dos'], id_cols=[])
+        with stage('predict', X) as current:
+            return X, y, current.output(model.predict_proba(X)[:, 1])
+    X, y = data_processing(labs, norm_ranges, admits, month_col, encoding_cols, age_col,
+                           chronic_cols, merge_cols + ['dos'], [], vitals, echoecg)
+    X_predict = align_to_model(X, model, KEY_COLUMNS)
+    with stage('predict', X_predict) as current:
+        return X, y, current.output(model.predict_proba(X_predict)[:, 1])
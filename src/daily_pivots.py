@@ -0,0 +1,251 @@
+import argparse
+import datetime
+
+from psycopg2 import sql
+
+from mimic_fxns import connect, release
+from incremental_scoring import (LAB_ITEMIDS, VITAL_ITEMIDS, ensure_event_watermark_table, event_window,
+                                 window_params, advance_event_watermarks)
+
+
+#Summary tables of the daily lab and vital pivots (bulk_member_model_labs.sql / bulk_member_model_chart_events.sql),
+#keyed and indexed on (icustay_id, chartdate), for cohort and hold-out stays.  Each pivot keeps an event watermark on
+#its source table (the highest labevents/chartevents row_id it has looked at, see incremental_scoring.event_window),
+#so a refresh reads only the event rows inserted since - back-dated ones included - through the row_id index, and
+#maps them to their stays.  Those stays' days are recomputed from the first new event onwards, by running the pivot
+#query restricted to them; stays new to the cohort are computed in full.  The event tables are never rescanned.
+#Point extractions at the tables with PIVOT_SQL (bulk_scoring.py / incremental_scoring.py --pivots).
+#   python daily_pivots.py                        refresh both pivots
+#   python daily_pivots.py --since 2150-06-01     also recompute every stay's days from a date (reads the events in full)
+#   python daily_pivots.py --rebuild              empty the tables and recompute everything
+
+WATERMARK_TABLE = 'daily_pivot_watermark'
+SCOPE_TABLE = 'pivot_refresh_scope'
+#The pivot queries inner join the tables, so a stay with no lab (vital) events has no rows there, where the raw bulk
+#queries left join the events and return one row with a null chartdate for it.  prepare_bulk_frames drops null
+#chartdate rows, so the daily grid built from either source is the same.
+PIVOT_SQL = {'labsql': 'pivot_member_model_labs.sql', 'vitalsql': 'pivot_member_model_chart_events.sql'}
+
+#'events' selects the stays' lab/vital events matching {new} - the window of unseen rows (see new_event_condition)
+PIVOTS = {
+    'labs': {
+        'table': 'daily_lab_pivot',
+        'source': 'bulk_member_model_labs.sql',
+        'columns': ['aniongap', 'albumin', 'bilirubin', 'creatinine', 'glucose', 'hematocrit', 'hemoglobin', 'lactate',
+                    'platelet', 'sodium', 'bun', 'wbc'],
+        'items': LAB_ITEMIDS,
+        'event_table': 'labevents',
+        'alias': 'le',
+        'events': """
+        select st.icustay_id, le.charttime as event_time
+        from labevents le
+        join stays st on st.subject_id = le.subject_id and st.hadm_id = le.hadm_id
+            and le.charttime between st.intime and st.outtime
+        where le.itemid in %(items)s and le.valuenum > 0 and {new}
+        """},
+    'vitals': {
+        'table': 'daily_vital_pivot',
+        'source': 'bulk_member_model_chart_events.sql',
+        'columns': ['temperature', 'heartrate', 'systolic_bp', 'mean_arterial_pressure'],
+        'items': VITAL_ITEMIDS,
+        'event_table': 'chartevents',
+        'alias': 'ce',
+        'events': """
+        select st.icustay_id, ce.charttime as event_time
+        from chartevents ce
+        join stays st on st.icustay_id = ce.icustay_id and ce.charttime between st.intime and st.outtime
+        where ce.itemid in %(items)s and ce.valuenum > 0 and {new}
+        """},
+}
+
+
+def pivot_consumer(pivot):
+    """
+    Name a pivot's event watermark is kept under.
+    """
+    return 'pivot:' + pivot
+
+def ensure_pivot_tables(conn):
+    """
+    Overview:
+        Creates the pivot tables, their indexes and the watermark table if they do not exist.
+    Parameters:
+        conn: connection
+            Active database connection
+    """
+    with conn.cursor() as cur:
+        for spec in PIVOTS.values():
+            values = sql.SQL('').join(sql.SQL(', {} numeric').format(sql.Identifier(col)) for col in spec['columns'])
+            cur.execute(sql.SQL("""
+            create table if not exists {table} (
+                subject_id integer not null
+                , hadm_id integer not null
+                , icustay_id integer not null
+                , chartdate date not null
+                {values}
+                , primary key (icustay_id, chartdate))
+            """).format(table=sql.Identifier(spec['table']), values=values))
+            #extractions read the tables in (subject_id, hadm_id) order
+            cur.execute(sql.SQL('create index if not exists {index} on {table} (subject_id, hadm_id)').format(
+                index=sql.Identifier(spec['table'] + '_subject_hadm'), table=sql.Identifier(spec['table'])))
+        cur.execute(sql.SQL("""
+        create table if not exists {wm} (
+            pivot text not null
+            , icustay_id integer not null
+            , last_event timestamp not null
+            , refreshed_at timestamp not null default now()
+            , primary key (pivot, icustay_id))
+        """).format(wm=sql.Identifier(WATERMARK_TABLE)))
+    ensure_event_watermark_table(conn)
+    conn.commit()
+
+def new_event_condition(spec, since=None):
+    """
+    Overview:
+        Condition picking a pivot's new events: rows in the event window (a row_id range), or - while the pivot has no
+        event watermark yet - events later than the stay's watermark.  With since, events on or after that date count too.
+    Parameters:
+        spec: dict
+            Entry of PIVOTS
+        since: date, optional
+            Also treat every event on or after this date as new
+    Returns:
+        psycopg2 sql Composed
+    """
+    alias, source = sql.Identifier(spec['alias']), spec['event_table']
+    after, through = sql.Placeholder(source + '_after'), sql.Placeholder(source + '_through')
+    condition = sql.SQL("""({alias}.row_id > coalesce({after}::bigint, 0) and {alias}.row_id <= {through}
+            and ({after}::bigint is not null or {alias}.charttime > st.last_event))""").format(
+        alias=alias, after=after, through=through)
+    if since is not None:
+        condition = sql.SQL('({} or {}.charttime >= {})').format(condition, alias, sql.Literal(since))
+    return condition
+
+def stage_pivot_scope(conn, pivot, window, since=None):
+    """
+    Overview:
+        Fills a temporary table with the stays whose pivot days need recomputing, with the date of their first new
+        event: cohort/hold-out stays with new events in the window, and stays without a pivot watermark yet (new to the
+        cohort - their events may predate the window), which are recomputed from intime.  Only the window's event rows
+        are read and joined to the stays.
+    Parameters:
+        conn: connection
+            Active database connection
+        pivot: str
+            Key of PIVOTS
+        window: dict
+            Event window of the pivot's source table, from event_window
+        since: date, optional
+            Also treat every event on or after this date as new
+    Returns:
+        int, stays in scope
+    """
+    spec = PIVOTS[pivot]
+    query = sql.SQL("""
+    create temporary table {scope} on commit drop as
+    with stays as (
+        select ie.subject_id, ie.hadm_id, ie.icustay_id, ie.intime, ie.outtime
+            , coalesce(wm.last_event, '-infinity'::timestamp) as last_event
+        from icustays ie
+        join (select icustay_id from cohort union select icustay_id from hold_out) ap on ap.icustay_id = ie.icustay_id
+        left join {wm} wm on wm.pivot = %(pivot)s and wm.icustay_id = ie.icustay_id
+    ),
+    new_events as ({events})
+    select st.icustay_id
+        , case when st.last_event = '-infinity'::timestamp then st.intime::date else min(ev.event_time)::date end as from_date
+        , coalesce(greatest(max(ev.event_time), nullif(st.last_event, '-infinity'::timestamp)), st.intime) as last_event
+    from stays st
+    left join new_events ev on ev.icustay_id = st.icustay_id
+    group by st.icustay_id, st.intime, st.last_event
+    having st.last_event = '-infinity'::timestamp or count(ev.event_time) > 0
+    """).format(scope=sql.Identifier(SCOPE_TABLE), wm=sql.Identifier(WATERMARK_TABLE),
+                events=sql.SQL(spec['events']).format(new=new_event_condition(spec, since)))
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('drop table if exists {}').format(sql.Identifier(SCOPE_TABLE)))
+        cur.execute(query, {'pivot': pivot, 'items': spec['items'], **window_params(window)})
+        cur.execute(sql.SQL('select count(*) from {}').format(sql.Identifier(SCOPE_TABLE)))
+        return cur.fetchone()[0]
+
+def refresh_pivot(conn, pivot, since=None, rebuild=False):
+    """
+    Overview:
+        Recomputes the days of one pivot touched by new events, in one transaction: the scoped stays' rows from their
+        first new day on are deleted and re-inserted from the pivot query restricted to those stays and days, and the
+        stays' and the pivot's event watermarks advanced.
+    Parameters:
+        conn: connection
+            Active database connection
+        pivot: str
+            Key of PIVOTS
+        since: date, optional
+            Also recompute every stay's days from this date
+        rebuild: bool
+            If True the table and its watermarks are emptied first, so every stay is recomputed
+    Returns:
+        dict with the stays refreshed and rows written
+    """
+    spec = PIVOTS[pivot]
+    table, scope = sql.Identifier(spec['table']), sql.Identifier(SCOPE_TABLE)
+    with open(spec['source']) as f:
+        source = f.read().strip().rstrip(';')
+    columns = ['subject_id', 'hadm_id', 'icustay_id', 'chartdate'] + spec['columns']
+    try:
+        with conn.cursor() as cur:
+            if rebuild:
+                cur.execute(sql.SQL('truncate {}').format(table))
+                cur.execute(sql.SQL('delete from {} where pivot = {}').format(sql.Identifier(WATERMARK_TABLE), sql.Literal(pivot)))
+        window = event_window(conn, pivot_consumer(pivot), (spec['event_table'],))
+        stays = stage_pivot_scope(conn, pivot, window, since)
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL('select coalesce(array_agg(icustay_id), array[]::integer[]) from {}').format(scope))
+            stay_ids = cur.fetchone()[0]
+            cur.execute(sql.SQL('delete from {table} p using {scope} s where p.icustay_id = s.icustay_id and p.chartdate >= s.from_date').format(
+                table=table, scope=scope))
+            #a constant array condition on a grouping column is pushed down into the pivot query (a join would not be),
+            #so only the scoped stays' events are read; the join then keeps each stay's days from its first new event
+            cur.execute(sql.SQL("""
+            insert into {table} ({columns})
+            select {q_columns}
+            from ({source}) q
+            join {scope} s on s.icustay_id = q.icustay_id
+            where q.icustay_id = any(%(stays)s) and q.chartdate >= s.from_date
+            """).format(table=table, columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+                        q_columns=sql.SQL(', ').join(sql.SQL('q.{}').format(sql.Identifier(col)) for col in columns),
+                        source=sql.SQL(source.replace('%', '%%')), scope=scope), {'stays': stay_ids})
+            rows = cur.rowcount
+            cur.execute(sql.SQL("""
+            insert into {wm} (pivot, icustay_id, last_event)
+            select {pivot}, icustay_id, last_event from {scope}
+            on conflict (pivot, icustay_id) do update
+            set last_event = greatest({wm}.last_event, excluded.last_event), refreshed_at = now()
+            """).format(wm=sql.Identifier(WATERMARK_TABLE), pivot=sql.Literal(pivot), scope=scope))
+        advance_event_watermarks(conn, pivot_consumer(pivot), window)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print(f'{spec["table"]}: {rows} daily rows recomputed for {stays} stays')
+    return {'stays': stays, 'rows': rows}
+
+def refresh_pivots(conn, pivots=tuple(PIVOTS), since=None, rebuild=False):
+    """
+    Overview:
+        Creates the pivot tables if needed and refreshes each pivot (see refresh_pivot).
+    Returns:
+        dict of pivot -> refresh result
+    """
+    ensure_pivot_tables(conn)
+    return {pivot: refresh_pivot(conn, pivot, since, rebuild) for pivot in pivots}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the daily lab and vital pivot tables')
+    parser.add_argument('--pivot', choices=list(PIVOTS), action='append', help='pivot to refresh (default: all)')
+    parser.add_argument('--since', type=datetime.date.fromisoformat, default=None, help='also recompute every stay from this date (YYYY-MM-DD)')
+    parser.add_argument('--rebuild', action='store_true', help='empty the tables and recompute every stay')
+    args = parser.parse_args()
+    conn = connect()
+    try:
+        refresh_pivots(conn, args.pivot or tuple(PIVOTS), args.since, args.rebuild)
+    finally:
+        release(conn)
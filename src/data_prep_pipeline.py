@@ -1,51 +1,195 @@
-from mimic_fxns import connect, insert_data, get_exclusions
+from mimic_fxns import connect, insert_data, release
+import hashlib
+import argparse
 import numpy as np
-import psycopg2 as psy
+import pandas as pd
 from psycopg2 import sql
-from sklearn.model_selection import train_test_split
-   
+
+
+#Cohort builder.  Admissions/ICU stays meeting none of the exclusion criteria (cohort_exclusions.sql) are assigned to
+#the train/test pool ('cohort') or the 'hold_out' pool by a hash of subject_id, so a patient's stays always land in the
+#same pool and the assignment never changes as admissions are added.  By default this runs entirely in Postgres as
+#INSERT ... SELECT, adding only stays not yet in either table; the pandas path is the reference implementation.
+#   python data_prep_pipeline.py                  assign new stays in the database
+#   python data_prep_pipeline.py --rebuild        empty both tables and reassign every stay
+#   python data_prep_pipeline.py --check          compare the database assignment with the pandas reference
+
+EXCLUSIONS_SQL = 'cohort_exclusions.sql'
+EXCLUSION_COLS = ['excl_death_prior', 'excl_no_icu', 'excl_4hr_stay', 'excl_age', 'excl_transplant', 'excl_burns']
+COHORT_COLS = ['hadm_id', 'subject_id', 'icustay_id']
+HOLD_OUT_FRACTION = .4
+BUCKETS = 10000
+#first 28 bits of the md5 of the decimal subject_id, as computed by hold_out_bucket
+BUCKET_SQL = "('x' || substr(md5(ex.subject_id::text), 1, 7))::bit(28)::int % {buckets}"
+
+
+def exclusions_query(filepath=EXCLUSIONS_SQL):
+    with open(filepath) as f:
+        return f.read().strip().rstrip(';')
+
 def get_exclusions(conn):
     """
-    Overview: 
+    Overview:
         Returns dataframe of all admissions with indicator columns for the various model exclusions (based on clinical clinical indications and/or data gaps.)
     Parameters:
-        conn: 
+        conn:
             active connection to EMR database
     Returns:
         dataframe of all admissions with indicators for exclusion criteria
     """
+    return pd.read_sql(sql.SQL(exclusions_query()), conn)
+
+def hold_out_bucket(subject_ids, buckets=BUCKETS):
+    """
+    Overview:
+        Python equivalent of BUCKET_SQL: the first 28 bits of the md5 of each subject_id, modulo buckets.
+    Parameters:
+        subject_ids: iterable of int
+        buckets: int
+    Returns:
+        array of int
+    """
+    return np.array([int(hashlib.md5(str(int(s)).encode()).hexdigest()[:7], 16) % buckets for s in subject_ids], dtype=np.int64)
+
+def split_cohort(admits_excl, hold_out_fraction=HOLD_OUT_FRACTION):
+    """
+    Overview:
+        Pandas reference implementation of the cohort assignment: drops stays meeting any exclusion and splits the rest
+        into train/test and hold-out by subject hash bucket.
+    Parameters:
+        admits_excl: dataframe
+            Output of get_exclusions
+        hold_out_fraction: float
+            Share of the hash buckets assigned to the hold-out pool
+    Returns:
+        c_train, c_hold_out: dataframes of hadm_id, subject_id, icustay_id
+    """
+    cohort = admits_excl.loc[admits_excl[EXCLUSION_COLS].any(axis=1) == False, COHORT_COLS]
+    hold_out = hold_out_bucket(cohort['subject_id']) < round(hold_out_fraction * BUCKETS)
+    return cohort.loc[~hold_out], cohort.loc[hold_out]
+
+def assigned_stays(conn):
+    """
+    Stays already in the cohort or hold_out table, as hadm_id, icustay_id.
+    """
+    return pd.read_sql(sql.SQL('select hadm_id, icustay_id from cohort union select hadm_id, icustay_id from hold_out'), conn)
+
+def drop_assigned(stays, assigned):
+    """
+    Overview:
+        Pandas counterpart of cohort_select's new_only filter: leaves out stays whose hadm_id and icustay_id are
+        already assigned, so re-running the pandas path only inserts new admissions.
+    Parameters:
+        stays: dataframe
+            Stays to insert (hadm_id, subject_id, icustay_id)
+        assigned: dataframe
+            Output of assigned_stays
+    Returns:
+        dataframe
+    """
+    keys = ['hadm_id', 'icustay_id']
+    known = pd.MultiIndex.from_frame(assigned[keys].astype('int64'))
+    return stays.loc[~pd.MultiIndex.from_frame(stays[keys].astype('int64')).isin(known)]
+
+def cohort_select(hold_out, hold_out_fraction=HOLD_OUT_FRACTION, new_only=True):
+    """
+    Overview:
+        SELECT of the non-excluded stays assigned to one pool, evaluated in the database.
+    Parameters:
+        hold_out: bool
+            True for the hold-out pool, False for train/test
+        hold_out_fraction: float
+            Share of the hash buckets assigned to the hold-out pool
+        new_only: bool
+            If True stays already in cohort or hold_out are left out, so the insert only adds new admissions
+    Returns:
+        psycopg2 sql Composed
+    """
+    not_excluded = sql.SQL(' and ').join(sql.SQL('ex.{} = 0').format(sql.Identifier(col)) for col in EXCLUSION_COLS)
+    bucket = sql.SQL(BUCKET_SQL.format(buckets=BUCKETS))
+    comparison = sql.SQL('<' if hold_out else '>=')
     query = sql.SQL("""
-    select adm.subject_id, adm.hadm_id, icustay_id
-    , case 
-	  when deathtime < admittime then 1
-	  else 0 end as excl_death_prior
-	, case 
-		when icustay_id is null then 1
-	  else 0 end as excl_no_icu
- 	, case 
-	  when los <= (4.0/24) then 1
-	  else 0 end as excl_4hr_stay
-    , case
-		when date_part('years', AGE(intime,dob)) < 20 then 1
-		else 0 end as excl_age
-	, case 
-    	when adm.diagnosis like '%TRANSPLANT%' then 1
-	    else 0 end as excl_transplant
-    , case 
-    	when adm.diagnosis like '%BURN%' then 1
-    	else 0 end as excl_burns
-	from admissions adm
-	left join icustays icu on adm.hadm_id = icu.hadm_id
-	left join patients pat on adm.subject_id = pat.subject_id
+    select ex.hadm_id, ex.subject_id, ex.icustay_id
+    from ({exclusions}) ex
+    where {not_excluded}
+    and {bucket} {comparison} {cut}
+    """).format(exclusions=sql.SQL(exclusions_query()), not_excluded=not_excluded, bucket=bucket, comparison=comparison,
+                cut=sql.Literal(round(hold_out_fraction * BUCKETS)))
+    if new_only:
+        query += sql.SQL("""
+    and not exists (select 1 from cohort c where c.hadm_id = ex.hadm_id and c.icustay_id = ex.icustay_id)
+    and not exists (select 1 from hold_out h where h.hadm_id = ex.hadm_id and h.icustay_id = ex.icustay_id)
     """)
-    return pd.read_sql(query, conn)
+    return query
+
+def assign_cohort(conn, hold_out_fraction=HOLD_OUT_FRACTION, rebuild=False):
+    """
+    Overview:
+        Assigns stays to the cohort and hold_out tables with INSERT ... SELECT in one transaction - no rows pass
+        through Python.  Without rebuild only stays in neither table are added.
+    Parameters:
+        conn: connection
+            Active database connection
+        hold_out_fraction: float
+            Share of the hash buckets assigned to the hold-out pool
+        rebuild: bool
+            If True both tables are emptied first and every stay is reassigned
+    Returns:
+        dict of rows inserted per table
+    """
+    inserted = {}
+    try:
+        with conn.cursor() as cur:
+            if rebuild:
+                cur.execute(sql.SQL('truncate table cohort, hold_out'))
+            for table, hold_out in (('cohort', False), ('hold_out', True)):
+                cur.execute(sql.SQL('insert into {} ({}) ').format(sql.Identifier(table), sql.SQL(', ').join(map(sql.Identifier, COHORT_COLS)))
+                            + cohort_select(hold_out, hold_out_fraction, new_only=not rebuild))
+                inserted[table] = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print(f'{inserted["cohort"]} stays added to cohort, {inserted["hold_out"]} to hold_out')
+    return inserted
+
+def check_parity(conn, hold_out_fraction=HOLD_OUT_FRACTION):
+    """
+    Overview:
+        Compares the database assignment (cohort_select, ignoring what the tables already hold) with the pandas
+        reference split_cohort on the same exclusion data.
+    Returns:
+        bool, True if both pools hold exactly the same stays
+    """
+    def stays(df):
+        return set(map(tuple, df[COHORT_COLS].astype('int64').to_numpy()))
+    reference = split_cohort(get_exclusions(conn), hold_out_fraction)
+    same = True
+    for (table, hold_out), expected in zip((('cohort', False), ('hold_out', True)), reference):
+        actual = pd.read_sql(cohort_select(hold_out, hold_out_fraction, new_only=False), conn)
+        missing, extra = stays(expected) - stays(actual), stays(actual) - stays(expected)
+        print(f'{table}: {len(actual)} stays in database, {len(expected)} in reference, {len(missing)} missing, {len(extra)} extra')
+        same = same and not missing and not extra
+    return same
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Assign non-excluded ICU stays to the train/test and hold-out pools')
+    parser.add_argument('--hold-out', type=float, default=HOLD_OUT_FRACTION, help='share of subjects in the hold-out pool')
+    parser.add_argument('--rebuild', action='store_true', help='empty cohort and hold_out and reassign every stay')
+    parser.add_argument('--check', action='store_true', help='compare the database assignment with the pandas reference')
+    parser.add_argument('--pandas', action='store_true', help='assign with the pandas reference path and insert the rows')
+    args = parser.parse_args()
     conn = connect()
-    # Following code pulls out all ICU admissions that do not meet any of the exclusion criteria, splits the data into a train/test and hold-out data set.  Tables in the PostgreSQL DB are then populated with the appropriate identifiers for the admissions allocated to each of the two pools (hold-out vs. test/train)
-    admits_excl = get_exclusions(conn)
-    cohort = admits_excl.loc[admits_excl[['excl_death_prior','excl_no_icu', 'excl_4hr_stay', 'excl_age', 'excl_transplant', 'excl_burns']].any(axis=1) == False, ['hadm_id', 'subject_id', 'icustay_id']]
-    c_train, c_hold_out = train_test_split(cohort, test_size = .4, random_state=18, shuffle=True)
-    insert_data(con_details, c_train, 'cohort', conn)
-    insert_data(con_details, c_hold_out, 'hold_out', conn)
\ No newline at end of file
+    try:
+        if args.check:
+            check_parity(conn, args.hold_out)
+        elif args.pandas:
+            c_train, c_hold_out = split_cohort(get_exclusions(conn), args.hold_out)
+            assigned = assigned_stays(conn)
+            insert_data(None, drop_assigned(c_train, assigned), 'cohort', conn)
+            insert_data(None, drop_assigned(c_hold_out, assigned), 'hold_out', conn)
+        else:
+            assign_cohort(conn, args.hold_out, args.rebuild)
+    finally:
+        release(conn)
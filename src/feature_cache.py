@@ -0,0 +1,171 @@
+import os
+import mmap
+import hashlib
+import json
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.feather as feather
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.environ.get('MIMIC_FEATURE_CACHE', os.path.join(SRC_DIR, '.feature_cache'))
+DEFAULT_MAX_BYTES = 20 * 2**30
+
+
+def connection_target(conn):
+    """
+    Overview:
+        Identifies the database a connection points at (host, port, database, user, options) - never the password.
+    Parameters:
+        conn: connection
+            Active psycopg2 connection
+    Returns:
+        str
+    """
+    params = conn.get_dsn_parameters()
+    target = {k: params.get(k) for k in ('host', 'port', 'dbname', 'user', 'options')}
+    return json.dumps(target, sort_keys=True)
+
+def mapped_frame(fname):
+    """
+    Overview:
+        Reads a cached Arrow file into a dataframe without copying its numeric columns.  The file is mapped
+        copy-on-write: null-free integer and float columns become numpy views of the mapping (pages are read in as they
+        are touched, and a write copies only the touched pages, privately - the file is never changed).  Columns Arrow
+        stores differently from pandas (strings, nulls, dates, booleans) are converted as usual.
+    Parameters:
+        fname: str
+            Arrow IPC (feather) file written by FeatureCache.put
+    Returns:
+        dataframe
+    """
+    with open(fname, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    buf = pa.py_buffer(mapped)
+    table = ipc.open_file(buf).read_all()
+    if len(set(table.column_names)) < table.num_columns:
+        return table.to_pandas(split_blocks=True)
+    views = {}
+    for name, column in zip(table.column_names, table.columns):
+        if (column.num_chunks == 1 and len(column) and column.null_count == 0
+                and (pa.types.is_integer(column.type) or pa.types.is_floating(column.type))):
+            chunk = column.chunk(0)
+            dtype = np.dtype(column.type.to_pandas_dtype())
+            views[name] = np.frombuffer(mapped, dtype=dtype, count=len(chunk),
+                                        offset=chunk.buffers()[1].address - buf.address + chunk.offset * dtype.itemsize)
+    df = table.drop_columns(list(views)).to_pandas(split_blocks=True)
+    for position, name in enumerate(table.column_names):
+        if name in views:
+            #a Series wrapping the view is inserted as is; a bare array would be copied
+            df.insert(position, name, pd.Series(views[name], index=df.index, copy=False))
+    return df
+
+
+class FeatureCache:
+    """
+    On-disk columnar cache of extracted SQL results.  Results are stored as uncompressed, single-batch Arrow IPC
+    (feather) files so hits can be served zero-copy from a memory map (see mapped_frame), keyed by a hash of the query text and the connection target, so editing a query or
+    pointing at another database misses the cache.  Total size is bounded by evicting the least recently used files.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, memory_map=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_map = memory_map
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key_for(self, query_text, conn):
+        """
+        Cache key for a query run against the connection's database.
+        """
+        digest = hashlib.sha256()
+        digest.update(query_text.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(connection_target(conn).encode('utf-8'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.arrow')
+
+    def get(self, key):
+        """
+        Overview:
+            Returns the cached dataframe for key, or None on a miss.  Marks the entry as recently used.
+        Parameters:
+            key: str
+                Cache key from key_for
+        Returns:
+            dataframe or None
+        """
+        fname = self.path(key)
+        if not os.path.exists(fname):
+            self.stats['misses'] += 1
+            return None
+        if self.memory_map:
+            df = mapped_frame(fname)
+        else:
+            df = feather.read_table(fname, memory_map=False).to_pandas(split_blocks=True)
+        os.utime(fname)
+        self.stats['hits'] += 1
+        return df
+
+    def put(self, key, df):
+        """
+        Overview:
+            Writes a dataframe to the cache, then evicts least recently used entries beyond max_bytes.
+            Frames Arrow cannot represent are left uncached.
+        Parameters:
+            key: str
+                Cache key from key_for
+            df: dataframe
+                Query results
+        Returns:
+            bool indicating if the frame was cached
+        """
+        fname = self.path(key)
+        tmp = f'{fname}.{uuid.uuid4().hex}.tmp'
+        try:
+            #one record batch, so each column is contiguous in the file and can be mapped without concatenating
+            feather.write_feather(df, tmp, compression='uncompressed', chunksize=max(len(df), 1))
+        except (pa.ArrowException, TypeError, ValueError) as error:
+            print(f'Unable to cache extraction results: {error}')
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        os.replace(tmp, fname)
+        self.stats['writes'] += 1
+        self.evict(keep=fname)
+        return True
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits in max_bytes (the entry just written is kept).
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.arrow'):
+                st = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((st.st_mtime, st.st_size, os.path.join(self.cache_dir, name)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if fname == keep:
+                continue
+            os.remove(fname)
+            total -= size
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.arrow'):
+                os.remove(os.path.join(self.cache_dir, name))
+
+
+def default_cache():
+    return FeatureCache()
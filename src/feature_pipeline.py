@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pickle
+
+from mimic_fxns import (normal_lab_vital_ranges, data_processing_column_refs, one_hot_encoder, admission_features,
+                        assemble_features)
+from pipeline_metrics import stage
+
+
+class FeaturePipeline:
+    """
+    Fit-once featurization for the ICU mortality models.  Fitting records everything that would otherwise be re-derived
+    from each batch - the one-hot encoder categories, the lab/vital normal ranges, the column references and the final
+    feature column order.  transform then featurizes a batch with no refitting into a float32 matrix laid out exactly
+    like the training features, so single-patient and batch scoring need no per-batch column fix-ups.  The input frames
+    are only read - derived admission columns go on a shallow copy and the lab/vital transform into the feature matrix.
+    Saved next to the model by build_icu_model.
+    """
+
+    key_candidates = ['subject_id', 'hadm_id', 'icustay_id', 'dos', 'stay_id']
+
+    def __init__(self, norm_ranges=None):
+        if norm_ranges is None:
+            norm_ranges = normal_lab_vital_ranges()
+        self.norm_ranges = norm_ranges
+        self.id_cols, self.month_col, self.age_col, self.encoding_cols, self.chronic_cols, self.merge_cols = data_processing_column_refs()
+        self.encoder = None
+        self.columns = None
+
+    def features(self, labs_df, admit_df, vitals_df, echoecg_notes_df, merge_cols, id_cols):
+        """
+        Overview:
+            Featurizes a batch with the pipeline's encoder and normal ranges (the same steps as data_processing),
+            leaving the input frames unchanged.
+        Returns:
+            X: dataframe of features and key columns, y: labels or None
+        """
+        from mimic_text import echoecg_topics
+        with stage('feature_pipeline', admit_df) as current:
+            admits, _ = admission_features(admit_df, self.month_col, self.encoding_cols, self.age_col, self.chronic_cols,
+                                           self.encoder)
+            topics = echoecg_topics(echoecg_notes_df)
+            lab_frames = [labs_df] if vitals_df.empty else [labs_df, vitals_df]
+            drop_cols = list(self.encoding_cols) + list(self.month_col) + list(self.age_col) + list(id_cols) + list(self.chronic_cols)
+            X, y = assemble_features(admits, lab_frames, topics, list(merge_cols), drop_cols, self.norm_ranges)
+            current.output(X)
+        return X, y
+
+    def fit_transform(self, labs_df, admit_df, vitals_df, echoecg_notes_df):
+        """
+        Overview:
+            Fits the encoder on the training admissions and featurizes the training data, recording the feature layout.
+        Parameters:
+            labs_df, admit_df, vitals_df, echoecg_notes_df: dataframe
+                Extracted training data, as passed to data_processing
+        Returns:
+            X: dataframe of training features, y: labels
+        """
+        self.encoder = one_hot_encoder(handle_unknown='ignore')
+        self.encoder.fit(admit_df[self.encoding_cols])
+        X, y = self.features(labs_df, admit_df, vitals_df, echoecg_notes_df, self.merge_cols, self.id_cols)
+        self.columns = list(X.columns)
+        return X, y
+
+    def transform(self, labs_df, admit_df, vitals_df, echoecg_notes_df, merge_cols=None, id_cols=None, out=None):
+        """
+        Overview:
+            Featurizes a batch with the fitted encoder and writes the features into a float32 matrix in training column order.
+            Columns absent from the batch are zero, anything not seen in training is ignored.  Nothing is refit and the
+            input frames are not modified.
+        Parameters:
+            labs_df, admit_df, vitals_df, echoecg_notes_df: dataframe
+                Data to score, as passed to data_processing
+            merge_cols: list, optional
+                Keys the sources are joined on - defaults to the training keys (daily scoring adds 'dos')
+            id_cols: list, optional
+                Id columns to drop - defaults to the training id columns (daily scoring keeps them as keys)
+            out: 2d float32 array, optional
+                Preallocated destination with one row per admission row and one column per feature
+        Returns:
+            features: 2d float32 array, y: labels or None, keys: dataframe of the id/date columns present for each row
+        """
+        if self.columns is None:
+            raise ValueError('FeaturePipeline must be fit before transform')
+        if merge_cols is None:
+            merge_cols = self.merge_cols
+        if id_cols is None:
+            id_cols = self.id_cols
+        X, y = self.features(labs_df, admit_df, vitals_df, echoecg_notes_df, merge_cols, id_cols)
+        if out is None:
+            out = np.empty((X.shape[0], len(self.columns)), dtype=np.float32)
+        for j, col in enumerate(self.columns):
+            if col in X.columns:
+                out[:, j] = X[col].to_numpy(dtype=np.float32, na_value=np.nan)
+            else:
+                out[:, j] = 0
+        keys = X[[col for col in self.key_candidates if col in X.columns]]
+        return out, y, keys
+
+    def save(self, fname):
+        open(fname, 'x')
+        with open(fname, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,311 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import argparse
+
+import numpy as np
+
+
+#Flat export of a fitted random forest for scoring.  All trees are stored as contiguous node arrays (feature,
+#threshold, missing-value direction, leaf value) in a directory of .npy files; loading memory-maps them, so scoring
+#workers on one machine share a single copy of the model through the page cache instead of each unpickling their own.
+#Each tree is laid out as a perfect binary tree of the forest's depth (children of slot i at 2i+1 and 2i+2, leaves
+#above the bottom padded with always-go-left splits), so no child links are stored or looked up and every row
+#descends every tree in exactly depth steps with no branching.
+#   python forest_export.py icu_model_rf.pickle icu_model_rf_flat     export a pickled forest
+#   python forest_export.py --benchmark                               parity and latency/memory benchmark
+
+ARRAYS = ['feature', 'threshold', 'missing_right', 'value']
+#a perfect tree of depth d takes 2**d - 1 split slots and 2**d leaf slots per tree
+MAX_DEPTH = 14
+
+
+def float32_threshold(threshold):
+    """
+    Overview:
+        Converts split thresholds to float32 without changing any split decision for float32 inputs: a float32 x
+        satisfies x <= t exactly when it satisfies x <= (largest float32 not above t), so thresholds are rounded down.
+    Parameters:
+        threshold: array of float64
+    Returns:
+        array of float32
+    """
+    t32 = threshold.astype(np.float32)
+    over = t32.astype(np.float64) > threshold
+    t32[over] = np.nextafter(t32[over], np.float32(-np.inf))
+    return t32
+
+def flatten_forest(model):
+    """
+    Overview:
+        Flattens a fitted binary RandomForestClassifier into perfect-binary-tree node arrays, one block of slots per tree.
+        Split slot i of a tree has children 2i+1 and 2i+2; a leaf above the bottom level gets +inf thresholds below it
+        (always go left) and its value is written to every bottom slot under it.
+    Parameters:
+        model: RandomForestClassifier
+            Fitted forest with two classes, no deeper than MAX_DEPTH
+    Returns:
+        dict of arrays (see ARRAYS) and dict of metadata
+    """
+    depth = max(est.tree_.max_depth for est in model.estimators_)
+    if depth > MAX_DEPTH:
+        raise ValueError(f'forest depth {depth} is above the {MAX_DEPTH} supported by the flat export')
+    n_trees = len(model.estimators_)
+    n_splits, n_leaves = 2**depth - 1, 2**depth
+    feature = np.zeros((n_trees, n_splits), dtype=np.int32)
+    threshold = np.full((n_trees, n_splits), np.inf)
+    missing_right = np.zeros((n_trees, n_splits), dtype=bool)
+    value = np.zeros((n_trees, n_leaves), dtype=np.float32)
+    for k, est in enumerate(model.estimators_):
+        tree = est.tree_
+        counts = tree.value[:, 0, :]
+        #class 1 share of each node, as the tree's predict_proba reports it
+        proba = counts[:, 1] / counts.sum(axis=1)
+        missing_left = getattr(tree, 'missing_go_to_left', None)
+        stack = [(0, 0, 0)]
+        while stack:
+            node, slot, level = stack.pop()
+            if tree.children_left[node] == -1:
+                first = slot
+                for _ in range(depth - level):
+                    first = 2 * first + 1
+                value[k, first - n_splits:first - n_splits + 2**(depth - level)] = proba[node]
+                continue
+            feature[k, slot] = tree.feature[node]
+            threshold[k, slot] = tree.threshold[node]
+            missing_right[k, slot] = missing_left is not None and missing_left[node] == 0
+            stack.append((tree.children_left[node], 2 * slot + 1, level + 1))
+            stack.append((tree.children_right[node], 2 * slot + 2, level + 1))
+    arrays = {'feature': feature.ravel(), 'threshold': float32_threshold(threshold.ravel()),
+              'missing_right': missing_right.ravel(), 'value': value.ravel()}
+    meta = {'n_trees': n_trees, 'depth': int(depth), 'n_nodes': int(sum(est.tree_.node_count for est in model.estimators_)),
+            'n_features': int(model.n_features_in_), 'classes': [int(c) for c in model.classes_]}
+    return arrays, meta
+
+def export_forest(model, path):
+    """
+    Overview:
+        Writes the flattened forest to a directory of .npy files plus meta.json.  The directory is built under a
+        temporary name and swapped in, so a loader never sees a half-written model.
+    Parameters:
+        model: RandomForestClassifier
+            Fitted forest
+        path: str
+            Output directory
+    Returns:
+        path
+    """
+    arrays, meta = flatten_forest(model)
+    tmp = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), array)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    return path
+
+def load_flat_forest(path, mmap=True):
+    """
+    Overview:
+        Loads an exported forest.  With mmap the node arrays are memory-mapped read only, so processes loading the same
+        directory share its pages.
+    Parameters:
+        path: str
+            Directory written by export_forest
+        mmap: bool
+            If False the arrays are read into memory
+    Returns:
+        FlatForest
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None) for name in ARRAYS}
+    return FlatForest(arrays, meta)
+
+
+class FlatForest:
+    """
+    Batch evaluator over the flat node arrays.  Rows are scored in blocks; each block descends all trees at once with
+    numpy take/compare into buffers allocated once per evaluator, and the float32 input is read in place.
+    Offers predict_proba so it can stand in for the sklearn forest when scoring.
+    """
+
+    def __init__(self, arrays, meta, block_rows=512):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.n_trees = meta['n_trees']
+        self.depth = meta['depth']
+        self.n_features_in_ = meta['n_features']
+        self.classes_ = np.array(meta['classes'])
+        self.has_missing = bool(np.any(self.missing_right))
+        self.n_splits = 2**self.depth - 1
+        self.block_rows = block_rows
+        self.buffers = None
+
+    def allocate(self, rows):
+        shape = (rows, self.n_trees)
+        self.buffers = {'slot': np.empty(shape, dtype=np.intp), 'index': np.empty(shape, dtype=np.intp),
+                        'feat': np.empty(shape, dtype=np.int32), 'pos': np.empty(shape, dtype=np.intp),
+                        'x': np.empty(shape, dtype=np.float32), 't': np.empty(shape, dtype=np.float32),
+                        'go_right': np.empty(shape, dtype=bool), 'nan': np.empty(shape, dtype=bool),
+                        'nan_right': np.empty(shape, dtype=bool), 'value': np.empty(shape, dtype=np.float32)}
+        self.row_base = np.arange(rows, dtype=np.intp)[:, None] * self.n_features_in_
+        self.split_base = np.arange(self.n_trees, dtype=np.intp) * self.n_splits
+        self.leaf_base = np.arange(self.n_trees, dtype=np.intp) * (self.n_splits + 1)
+
+    def descend(self, flat_x, start, rows):
+        """
+        Index into value of the leaf reached in every tree by rows start:start+rows.  flat_x is the raveled C-ordered float32 input.
+        """
+        b = {name: buf[:rows] for name, buf in self.buffers.items()}
+        slot, index, pos, x, t, go_right = b['slot'], b['index'], b['pos'], b['x'], b['t'], b['go_right']
+        slot[:] = 0
+        for _ in range(self.depth):
+            np.add(slot, self.split_base, out=index)
+            #x[i, k] = X[start + i, feature of the current slot of tree k]
+            np.take(self.feature, index, out=b['feat'], mode='clip')
+            np.add(b['feat'], self.row_base[:rows], out=pos)
+            pos += start * self.n_features_in_
+            np.take(flat_x, pos, out=x, mode='clip')
+            np.take(self.threshold, index, out=t, mode='clip')
+            np.greater(x, t, out=go_right)
+            if self.has_missing:
+                np.isnan(x, out=b['nan'])
+                np.take(self.missing_right, index, out=b['nan_right'], mode='clip')
+                b['nan'] &= b['nan_right']
+                go_right |= b['nan']
+            slot *= 2
+            slot += 1
+            slot += go_right
+        slot -= self.n_splits
+        slot += self.leaf_base
+        return slot
+
+    def predict_risk(self, X, out=None):
+        """
+        Overview:
+            Mean class 1 probability over the trees for each row, matching RandomForestClassifier.predict_proba(X)[:, 1].
+        Parameters:
+            X: 2d array-like
+                Features in training column order.  A C-contiguous float32 array is used without copying.
+            out: 1d float64 array, optional
+                Destination for the risks
+        Returns:
+            1d array of float64
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(f'expected {self.n_features_in_} features, got shape {X.shape}')
+        n = X.shape[0]
+        if out is None:
+            out = np.empty(n, dtype=np.float64)
+        block = min(self.block_rows, max(n, 1))
+        if self.buffers is None or self.buffers['slot'].shape[0] < block:
+            self.allocate(block)
+        flat_x = X.ravel()
+        for start in range(0, n, block):
+            rows = min(block, n - start)
+            leaves = self.descend(flat_x, start, rows)
+            values = self.buffers['value'][:rows]
+            np.take(self.value, leaves, out=values, mode='clip')
+            np.sum(values, axis=1, dtype=np.float64, out=out[start:start + rows])
+        out /= self.n_trees
+        return out
+
+    def predict_proba(self, X):
+        risk = self.predict_risk(X)
+        return np.column_stack([1 - risk, risk])
+
+    def __getstate__(self):
+        #pickled (e.g. sent to a worker) without the scratch buffers
+        state = dict(self.__dict__)
+        state['buffers'] = None
+        return state
+
+
+def check_parity(model, flat, X, atol=1e-6):
+    """
+    Overview:
+        Compares the flat evaluator with the sklearn forest's predict_proba on the same rows.
+    Returns:
+        float largest absolute difference in class 1 probability (raises AssertionError above atol)
+    """
+    expected = model.predict_proba(X)[:, 1]
+    diff = float(np.max(np.abs(flat.predict_risk(X) - expected))) if len(X) else 0.0
+    assert diff <= atol, f'flat forest differs from predict_proba by {diff}'
+    return diff
+
+def rss_mb():
+    try:
+        import psutil
+    except ImportError:
+        return float('nan')
+    return psutil.Process().memory_info().rss / 2**20
+
+def benchmark(model_path=None, n_rows=5000, n_features=120, batch_sizes=(1, 64, 1024, 20000), repeats=5):
+    """
+    Overview:
+        Parity check plus latency and memory comparison of sklearn predict_proba and the flat evaluator.  Uses the
+        pickled forest at model_path, or fits a forest shaped like the production one (250 trees, depth 9) to random data.
+    Returns:
+        dict of results
+    """
+    rng = np.random.default_rng(18)
+    if model_path is None:
+        from sklearn.ensemble import RandomForestClassifier
+        X_fit = rng.normal(size=(n_rows, n_features)).astype(np.float32)
+        y_fit = (X_fit[:, :5].sum(axis=1) + rng.normal(size=n_rows) > 0).astype(int)
+        model = RandomForestClassifier(max_depth=9, n_estimators=250, random_state=18, n_jobs=-1).fit(X_fit, y_fit)
+        model.n_jobs = 1
+    else:
+        with open(model_path, 'rb') as f:
+            model = pickle.load(f)
+        n_features = model.n_features_in_
+    X = rng.normal(size=(max(batch_sizes), n_features)).astype(np.float32)
+
+    flat_dir = export_forest(model, os.path.join(os.path.dirname(os.path.abspath(__file__)), '.forest_benchmark_flat'))
+    before = rss_mb()
+    flat = load_flat_forest(flat_dir)
+    results = {'n_trees': flat.n_trees, 'depth': flat.depth,
+               'pickle_mb': len(pickle.dumps(model, pickle.HIGHEST_PROTOCOL)) / 2**20,
+               'flat_mb': sum(os.path.getsize(os.path.join(flat_dir, f)) for f in os.listdir(flat_dir)) / 2**20,
+               'flat_load_rss_mb': rss_mb() - before,
+               'max_abs_diff': check_parity(model, flat, X), 'latency_ms': {}}
+    for batch in batch_sizes:
+        Xb = X[:batch]
+        timings = {}
+        for name, fn in (('sklearn', lambda: model.predict_proba(Xb)), ('flat', lambda: flat.predict_risk(Xb))):
+            fn()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                fn()
+            timings[name] = (time.perf_counter() - start) / repeats * 1000
+        results['latency_ms'][batch] = timings
+        print(f'batch {batch:>6}: sklearn {timings["sklearn"]:9.2f} ms   flat {timings["flat"]:9.2f} ms')
+    shutil.rmtree(flat_dir, ignore_errors=True)
+    print(f'{results["n_trees"]} trees of depth {results["depth"]}: pickle {results["pickle_mb"]:.1f} MB, '
+          f'flat {results["flat_mb"]:.1f} MB on disk, {results["flat_load_rss_mb"]:.1f} MB resident after mmap load')
+    print(f'parity: max |flat - predict_proba| = {results["max_abs_diff"]:.2e}')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a random forest to flat node arrays, or benchmark the flat evaluator')
+    parser.add_argument('model', nargs='?', help='pickled RandomForestClassifier')
+    parser.add_argument('output', nargs='?', help='directory to write the flat forest to')
+    parser.add_argument('--benchmark', action='store_true', help='parity check and latency/memory comparison with predict_proba')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.model)
+    elif args.model and args.output:
+        with open(args.model, 'rb') as f:
+            export_forest(pickle.load(f), args.output)
+        print(f'Flat forest written to {args.output}')
+    else:
+        parser.error('give a model and output directory, or --benchmark')
@@ -8,14 +8,16 @@ import os
 
 # from sklearn.model_selection import train_test_split, KFold, cross_val_score
 # from sklearn.metrics import (plot_confusion_matrix, confusion_matrix, precision_score, recall_score, accuracy_score, plot_roc_curve, auc)
-from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier
+#sklearn estimators and the feature cache (pyarrow) are imported where they are used, to keep imports of this module cheap
 
-from mimic_fxns import (connect, data_extraction, transform_labs, hot_coding, age_bands, month_transform, data_processing, normal_lab_vital_ranges, data_processing_column_refs)
+from mimic_fxns import (pooled_connection, data_extraction, transform_labs, hot_coding, age_bands, month_transform, data_processing, normal_lab_vital_ranges, data_processing_column_refs)
+from feature_pipeline import FeaturePipeline
+from pipeline_metrics import stage
 import pickle
+import argparse
 
 
-def build_x_y(labsql='train_lab_values.sql', patientsql='v_two_data_set_extraction.sql',vitalsql='train_chart_events.sql', echoecgsql='train_echo_ecg_notes.sql'):
+def build_x_y(labsql='train_lab_values.sql', patientsql='v_two_data_set_extraction.sql',vitalsql='train_chart_events.sql', echoecgsql='train_echo_ecg_notes.sql', cache='default', refresh=False, pipeline=None, return_pipeline=False):
     """
         Data transformation and clean-up to create model training and evaluation data sets - feature data and target data.
         Parameters:
@@ -27,47 +29,102 @@ def build_x_y(labsql='train_lab_values.sql', patientsql='v_two_data_set_extracti
                 file name of the desired vitals data extraction query to run in building the model
             echoecgsql: string
                 file name of the desired echo and ecg chart notes data extraction query to run in building the model
+            cache: FeatureCache
+                On-disk cache for the extraction results.  Default value uses the default cache location; None always queries the database.
+            refresh: bool
+                Flag for re-running the extraction queries and replacing any cached results.
+            pipeline: FeaturePipeline
+                Fitted feature pipeline to apply (e.g. for hold-out evaluation).  If None a new one is fit to this data.
+            return_pipeline: bool
+                Flag for also returning the feature pipeline.
         Returns:
             X: dataframe
                 Data sets post-clean-up and featurization
             y: dataframe
                 Target labels indicating actual mortality.
+            pipeline: FeaturePipeline
+                Only if return_pipeline = True
     """
-    conn = connect()
+    if cache == 'default':
+        from feature_cache import default_cache
+        cache = default_cache()
 
     normal_ranges = normal_lab_vital_ranges()
 
     id_cols, month_col, age_col, encoding_cols, chronic_cols, merge_cols = data_processing_column_refs()
 
-    labpath = labsql
-    labs = data_extraction(labpath, conn)
-    print('Lab data loaded...')
+    #the connection goes back to the shared pool once the extractions are read
+    with pooled_connection() as conn:
+        labpath = labsql
+        labs = data_extraction(labpath, conn, cache, refresh)
 
-    patientpath = patientsql
-    admits = data_extraction(patientpath, conn)
-    print('Patient admitting data loaded...')
+        patientpath = patientsql
+        admits = data_extraction(patientpath, conn, cache, refresh)
 
-    vitalspath = vitalsql
-    vitals = data_extraction(vitalspath, conn)
-    print('Vitals data loaded...')
+        vitalspath = vitalsql
+        vitals = data_extraction(vitalspath, conn, cache, refresh)
 
-    echoecgpath = echoecgsql
-    echoecg_notes = data_extraction(echoecgpath, conn)
-    echoecg_notes.dropna(axis=0, inplace=True)
-    groupcols = id_cols + ['echo_ecg']
-    echoecg_docs = echoecg_notes[groupcols].groupby(id_cols).sum()
-    echoecg_docs.reset_index(inplace=True)
-    
-    print('Echo and ECG data loaded...')
-    print('Preparing data for model fitting and/or evaluation...')
+        echoecgpath = echoecgsql
+        echoecg_notes = data_extraction(echoecgpath, conn, cache, refresh)
 
-    X,y = data_processing(labs, normal_ranges, admits, month_col, encoding_cols, age_col, chronic_cols, merge_cols, id_cols, vitals, echoecg_docs)
+    with stage('group_notes', echoecg_notes) as current:
+        echoecg_notes.dropna(axis=0, inplace=True)
+        groupcols = id_cols + ['echo_ecg']
+        echoecg_docs = echoecg_notes[groupcols].groupby(id_cols).sum()
+        echoecg_docs.reset_index(inplace=True)
+        current.output(echoecg_docs)
 
-    print('Data preparation complete.') 
+    if pipeline is None:
+        pipeline = FeaturePipeline(normal_ranges)
+        X, y = pipeline.fit_transform(labs, admits, vitals, echoecg_docs)
+    else:
+        features, y, keys = pipeline.transform(labs, admits, vitals, echoecg_docs)
+        X = pd.DataFrame(features, columns=pipeline.columns)
+
+    if return_pipeline:
+        return X, y, pipeline
     return X, y
 
 
-def build_icu_model(model_type='rf', labsql='train_lab_values.sql', patientsql='v_two_data_set_extraction.sql',vitalsql='train_chart_events.sql', echoecgsql='train_echo_ecg_notes.sql', make_pickl=False, pickle_f='icu_model'):
+def make_model(model_type='rf', params=None):
+    """
+        Unfit classifier for a model type, with the pipeline's standard settings updated by any given parameters.
+        Parameters:
+            model_type: string
+                'lr' or 'rf'
+            params: dict
+                Estimator parameters overriding the standard settings
+        Returns:
+            cm: obj
+                Unfit class-model object, or None if the model type is not valid
+    """
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.ensemble import RandomForestClassifier
+    params = params or {}
+    if model_type == 'lr':
+        return LogisticRegression(**{'solver': 'liblinear', 'max_iter': 1500, **params})
+    elif model_type == 'rf':
+        return RandomForestClassifier(**{'max_depth': 9, 'n_estimators': 250, 'criterion': 'gini', 'class_weight': None,
+                                         'max_features': 'sqrt', 'random_state': 18, 'n_jobs': -1, **params})
+    return None
+
+def save_model(cm, pipeline, model_type, pickle_f='icu_model'):
+    """
+        Writes a fit model as <pickle_f>_<model_type>.pickle with its FeaturePipeline alongside as
+        <pickle_f>_<model_type>_features.pickle and, for the random forest, the flat export (forest_export.py) as <pickle_f>_rf_flat.
+    """
+    fname = pickle_f + '_' + model_type + '.pickle' 
+    open(fname,'x')
+    with open(fname, 'wb') as f:
+        pickle.dump(cm, f, pickle.HIGHEST_PROTOCOL)
+    #fitted featurization saved alongside, so scoring applies the training encoding and column layout
+    pipeline.save(pickle_f + '_' + model_type + '_features.pickle')
+    if model_type == 'rf':
+        #flat node-array copy of the forest for memory-mapped, shared scoring
+        from forest_export import export_forest
+        export_forest(cm, pickle_f + '_rf_flat')
+
+def build_icu_model(model_type='rf', labsql='train_lab_values.sql', patientsql='v_two_data_set_extraction.sql',vitalsql='train_chart_events.sql', echoecgsql='train_echo_ecg_notes.sql', make_pickl=False, pickle_f='icu_model', cache='default', refresh=False, params=None):
     """
         ICU Mortality risk prediction model pipeline and trained model file creation.
         Parameters:
@@ -85,35 +142,37 @@ def build_icu_model(model_type='rf', labsql='train_lab_values.sql', patientsql='
                 Flag for indicating if a pickle file should be made from the fit model.
             pickle_f: string
                 File name for the trained model pickle file
+            cache: FeatureCache
+                On-disk cache for the extraction results, passed to build_x_y
+            refresh: bool
+                Flag for re-running the extraction queries and replacing any cached results.
+            params: dict
+                Estimator parameters overriding the standard settings (e.g. the best candidate from model_search.py)
         Returns:
             cm: obj
                 Returns the fit class-model object
             pickel: file
-                Outputs the fit model as a pickel file if make_pickl = True
+                Outputs the fit model as a pickel file if make_pickl = True (see save_model)
     """
-    X, y = build_x_y(labsql, patientsql, vitalsql, echoecgsql)
-    print('Fitting model...')
-
-    if model_type == 'lr':
-        cm = LogisticRegression(solver='liblinear', max_iter=1500)
-        cm.fit(X, y)
-    elif model_type == 'rf':
-        cm = RandomForestClassifier(max_depth=9, n_estimators=250, criterion='gini',  class_weight=None,                         max_features = 'auto', random_state=18,n_jobs=-1)
-        cm.fit(X,y)
-    else:
+    cm = make_model(model_type, params)
+    if cm is None:
         print ('No valid model selected.  Program ending.')
         return None
-
-    print('Model complete.')
+    X, y, pipeline = build_x_y(labsql, patientsql, vitalsql, echoecgsql, cache, refresh, return_pipeline=True)
+    with stage('fit', X) as current:
+        cm.fit(X, y)
+        current.note(model=type(cm).__name__)
 
     if make_pickl == True:
-        fname = pickle_f + '_' + model_type + '.pickle' 
-        open(fname,'x')
-        with open(fname, 'wb') as f:
-            pickle.dump(cm, f, pickle.HIGHEST_PROTOCOL)
+        save_model(cm, pipeline, model_type, pickle_f)
 
     return cm
 
 
 if __name__ == '__main__':
-    build_icu_model(make_pickl=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Build the ICU mortality risk model')
+    parser.add_argument('--model', default='rf', choices=['rf', 'lr'])
+    parser.add_argument('--refresh', action='store_true', help='re-run extraction queries instead of using cached results')
+    parser.add_argument('--no-cache', action='store_true', help='bypass the extraction results cache entirely')
+    args = parser.parse_args()
+    build_icu_model(args.model, make_pickl=True, cache=None if args.no_cache else 'default', refresh=args.refresh)
\ No newline at end of file
@@ -0,0 +1,121 @@
+import os
+import sys
+import subprocess
+import argparse
+
+
+#Cold-start import benchmark.  Each target is imported in a fresh interpreter under -X importtime and checked against
+#a baseline import (numpy/pandas, which every data module needs anyway) two ways:
+#   - none of the heavy dependencies listed for it may be imported, unless the baseline already imports them
+#     (newer pandas pulls in pyarrow by itself) - machine independent
+#   - its import time over the baseline must stay within the time budget (ms)
+#The script exits non-zero if any check fails, so it can gate a build.
+#   python import_benchmark.py            check all targets
+#   python import_benchmark.py --scale 2  loosen time budgets for slow machines
+#   python import_benchmark.py mimic_db   check a subset of targets
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HEAVY_MODULES = ['gensim', 'nltk', 'smart_open', 'sklearn', 'sqlalchemy', 'psycopg2', 'scipy', 'pyarrow', 'matplotlib']
+
+NO_BASELINE = 'pass'
+PANDAS_BASELINE = 'import numpy, pandas'
+
+#statement to time, baseline statement, modules it must not pull in, time budget over the baseline in ms
+TARGETS = {
+    'mimic_fxns': ('import mimic_fxns', NO_BASELINE, HEAVY_MODULES + ['pandas', 'numpy'], 50),
+    'mimic_fxns.connect': ('from mimic_fxns import connect', PANDAS_BASELINE, HEAVY_MODULES, 100),
+    'mimic_fxns.transform_labs': ('from mimic_fxns import transform_labs', PANDAS_BASELINE, HEAVY_MODULES, 100),
+    'mimic_db': ('import mimic_db', PANDAS_BASELINE, HEAVY_MODULES, 100),
+    'mimic_features': ('import mimic_features', PANDAS_BASELINE, HEAVY_MODULES, 100),
+    'mimic_text': ('import mimic_text', PANDAS_BASELINE, HEAVY_MODULES, 100),
+    'mimic_evaluation': ('import mimic_evaluation', NO_BASELINE, HEAVY_MODULES, 50),
+    'model_registry': ('import model_registry', NO_BASELINE, HEAVY_MODULES + ['pandas', 'numpy'], 100),
+    'feature_pipeline': ('import feature_pipeline', PANDAS_BASELINE, HEAVY_MODULES, 100),
+    'icu_mortality_model': ('import icu_mortality_model', PANDAS_BASELINE, HEAVY_MODULES, 100),
+    'lda_model_pipeline': ('import lda_model_pipeline', PANDAS_BASELINE, HEAVY_MODULES, 100),
+}
+
+
+def import_profile(statement):
+    """
+    Overview:
+        Runs the statement in a fresh interpreter with -X importtime and parses the report.
+    Parameters:
+        statement: str
+            Import statement to profile
+    Returns:
+        dict of module name, indented by import depth as in the report -> (self us, cumulative us)
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=SRC_DIR,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'{statement} failed:\n{proc.stderr}')
+    profile = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        profile[name[1:].rstrip()] = (int(self_us), int(cumulative_us))
+    return profile
+
+def total_ms(profile):
+    """
+    Total import time of a statement: the sum of the cumulative times of its top-level (unindented) imports.
+    """
+    return sum(cumulative for name, (_, cumulative) in profile.items() if name == name.lstrip()) / 1000
+
+def top_level_modules(profile):
+    return {module.strip().split('.')[0] for module in profile}
+
+def best_profile(statement, repeat):
+    """
+    Fastest of repeat profiles of the statement - import times are noisy, the minimum is the stable figure.
+    """
+    return min((import_profile(statement) for _ in range(repeat)), key=total_ms)
+
+def target_ms(profile, base_profile):
+    """
+    Import time attributable to the target: the cumulative time of the top-level imports the baseline does not make.
+    """
+    baseline = {module.strip() for module in base_profile}
+    return total_ms({module: times for module, times in profile.items() if module.strip() not in baseline})
+
+def check_target(name, statement, baseline, forbidden, budget_ms, scale=1.0, repeat=3):
+    """
+    Overview:
+        Profiles one target and its baseline and checks the target against its forbidden modules and time budget.
+    Returns:
+        dict with the time measured over the baseline and any failures
+    """
+    base_profile = best_profile(baseline, repeat)
+    profile = best_profile(baseline + '; ' + statement, repeat)
+    imported = top_level_modules(profile) - top_level_modules(base_profile)
+    heavy = sorted(imported.intersection(forbidden))
+    elapsed = target_ms(profile, base_profile)
+    failures = []
+    if heavy:
+        failures.append(f'imports {", ".join(heavy)}')
+    if elapsed > budget_ms * scale:
+        failures.append(f'{elapsed:.0f} ms > {budget_ms * scale:.0f} ms budget')
+    return {'target': name, 'ms': elapsed, 'failures': failures}
+
+def run(targets=TARGETS, scale=1.0, repeat=3):
+    results = []
+    for name, (statement, baseline, forbidden, budget_ms) in targets.items():
+        result = check_target(name, statement, baseline, forbidden, budget_ms, scale, repeat)
+        status = 'FAIL ' + '; '.join(result['failures']) if result['failures'] else 'ok'
+        print(f'{name:<28} {result["ms"]:8.1f} ms  {status}')
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold-start import time benchmark')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier applied to the time budgets')
+    parser.add_argument('--repeat', type=int, default=3, help='profiles per statement, the fastest is used')
+    parser.add_argument('targets', nargs='*', help='subset of targets to check')
+    args = parser.parse_args()
+    targets = {name: TARGETS[name] for name in args.targets} if args.targets else TARGETS
+    results = run(targets, args.scale, args.repeat)
+    sys.exit(1 if any(result['failures'] for result in results) else 0)
@@ -0,0 +1,385 @@
+import re
+import pandas as pd
+import numpy as np
+import psycopg2 as psy
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+import argparse
+
+from mimic_fxns import connect, release, copy_frame
+from daily_grid import build_daily_grid, score_daily_grid, prepare_bulk_frames
+from model_registry import registry, RF_MODEL_PATH
+
+
+#Incremental refresh of the daily risk scores.  An event watermark per source table (labevents, chartevents,
+#noteevents) records the highest row_id already looked at, so each refresh reads only the event rows inserted since -
+#back-dated ones included - through the row_id index, and maps them to their stays.  A watermark per ICU stay records
+#the last event time reflected in its scores.  Each refresh rebuilds just the changed stays' daily rows (so the
+#forward-filled carry is correct), extracting only their events, and upserts the scores from the earliest day touched.
+
+WATERMARK_TABLE = 'risk_watermark'
+EVENT_WATERMARK_TABLE = 'event_watermark'
+RISK_TABLE = 'daily_risk'
+SCOPE_TABLE = 'risk_refresh_scope'
+EVENT_SOURCES = ('labevents', 'chartevents', 'noteevents')
+
+LAB_ITEMIDS = (50868, 50862, 50885, 50912, 50931, 50809, 51221, 50810, 51222, 50811, 50813, 51265, 50983, 50824, 51006, 51301, 51300)
+VITAL_ITEMIDS = (223761, 678, 223762, 676, 211, 220045, 220179, 220052)
+
+
+def ensure_tables(conn):
+    """
+    Overview:
+        Creates the watermark and risk output tables if they do not exist.
+    Parameters:
+        conn: connection
+            Active database connection
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("""
+        create table if not exists {wm} (
+            icustay_id integer primary key
+            , last_event timestamp not null
+            , refreshed_at timestamp not null default now())
+        """).format(wm=sql.Identifier(WATERMARK_TABLE)))
+        cur.execute(sql.SQL("""
+        create table if not exists {risk} (
+            subject_id integer not null
+            , hadm_id integer not null
+            , icustay_id integer not null
+            , dos date not null
+            , day_n integer
+            , mortality_risk real
+            , primary key (icustay_id, dos))
+        """).format(risk=sql.Identifier(RISK_TABLE)))
+    ensure_event_watermark_table(conn)
+    conn.commit()
+
+def ensure_event_watermark_table(conn):
+    """
+    Creates the event watermark table shared by the risk refresh and the pivot tables (left uncommitted).
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("""
+        create table if not exists {ewm} (
+            consumer text not null
+            , source text not null
+            , last_row_id bigint not null
+            , refreshed_at timestamp not null default now()
+            , primary key (consumer, source))
+        """).format(ewm=sql.Identifier(EVENT_WATERMARK_TABLE)))
+
+def event_window(conn, consumer, sources=EVENT_SOURCES):
+    """
+    Overview:
+        Row_id window of the events a consumer (the risk refresh, a pivot table) has not looked at yet, per source
+        table.  The upper bound is the table's current max row_id, so rows inserted while the refresh runs are left
+        for the next one.
+    Parameters:
+        conn: connection
+            Active database connection
+        consumer: str
+            Name the consumer's watermarks are kept under
+        sources: iterable
+            Event tables
+    Returns:
+        dict of source -> (after, through), after being None if the consumer has no watermark for the source yet
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('select source, last_row_id from {} where consumer = %s').format(sql.Identifier(EVENT_WATERMARK_TABLE)),
+                    (consumer,))
+        seen = dict(cur.fetchall())
+        window = {}
+        for source in sources:
+            cur.execute(sql.SQL('select coalesce(max(row_id), 0) from {}').format(sql.Identifier(source)))
+            window[source] = (seen.get(source), cur.fetchone()[0])
+    return window
+
+def window_params(window):
+    """
+    Query parameters <source>_after / <source>_through for an event window.
+    """
+    params = {}
+    for source, (after, through) in window.items():
+        params[source + '_after'] = after
+        params[source + '_through'] = through
+    return params
+
+def advance_event_watermarks(conn, consumer, window):
+    """
+    Records the upper bound of the window as the consumer's event watermarks (left uncommitted).
+    """
+    query = sql.SQL("""
+    insert into {ewm} (consumer, source, last_row_id) values %s
+    on conflict (consumer, source) do update
+    set last_row_id = excluded.last_row_id, refreshed_at = now()
+    """).format(ewm=sql.Identifier(EVENT_WATERMARK_TABLE))
+    with conn.cursor() as cur:
+        execute_values(cur, query, [(consumer, source, int(through)) for source, (_, through) in window.items()])
+
+def changed_stays(conn, window):
+    """
+    Overview:
+        Finds cohort/hold-out ICU stays with model-relevant lab, vital or echo/ecg note events in the event window.
+        Only the window's rows are read from the event tables (a row_id range) and joined to the stays.  Stays never
+        scored have no watermark and are always returned.  A source with no event watermark yet (the first refresh)
+        falls back to comparing event times with the stays' watermarks, which reads that table once in full.
+    Parameters:
+        conn: connection
+            Active database connection
+        window: dict
+            Event window from event_window
+    Returns:
+        dataframe of subject_id, hadm_id, icustay_id, first_new_date (earliest day with a new event) and last_event
+    """
+    query = sql.SQL("""
+    with all_pts as (
+        select icustay_id from cohort
+        union
+        select icustay_id from hold_out
+    ),
+    stays as (
+        select ie.subject_id, ie.hadm_id, ie.icustay_id, ie.intime, ie.outtime
+            , coalesce(wm.last_event, '-infinity'::timestamp) as last_event
+        from icustays ie
+        join all_pts ap on ap.icustay_id = ie.icustay_id
+        left join {wm} wm on wm.icustay_id = ie.icustay_id
+    ),
+    new_events as (
+        select st.icustay_id, le.charttime as event_time
+        from labevents le
+        join stays st on st.hadm_id = le.hadm_id and le.charttime between st.intime and st.outtime
+        where le.row_id > coalesce(%(labevents_after)s::bigint, 0) and le.row_id <= %(labevents_through)s
+        and le.itemid in %(lab_items)s and le.valuenum > 0
+        and (%(labevents_after)s::bigint is not null or le.charttime > st.last_event)
+        union all
+        select st.icustay_id, ce.charttime
+        from chartevents ce
+        join stays st on st.icustay_id = ce.icustay_id and ce.charttime between st.intime and st.outtime
+        where ce.row_id > coalesce(%(chartevents_after)s::bigint, 0) and ce.row_id <= %(chartevents_through)s
+        and ce.itemid in %(vital_items)s and ce.valuenum > 0
+        and (%(chartevents_after)s::bigint is not null or ce.charttime > st.last_event)
+        union all
+        select st.icustay_id, coalesce(ne.charttime, ne.chartdate)
+        from noteevents ne
+        join stays st on st.hadm_id = ne.hadm_id and ne.chartdate between st.intime and st.outtime
+        where ne.row_id > coalesce(%(noteevents_after)s::bigint, 0) and ne.row_id <= %(noteevents_through)s
+        and ne.category in ('ECHO', 'ECG') and ne.iserror isnull
+        and (%(noteevents_after)s::bigint is not null or coalesce(ne.charttime, ne.chartdate) > st.last_event)
+    )
+    select st.subject_id, st.hadm_id, st.icustay_id
+        , case when st.last_event = '-infinity'::timestamp then st.intime::date else min(ev.event_time)::date end as first_new_date
+        , coalesce(greatest(max(ev.event_time), nullif(st.last_event, '-infinity'::timestamp)), st.intime) as last_event
+    from stays st
+    left join new_events ev on ev.icustay_id = st.icustay_id
+    group by st.subject_id, st.hadm_id, st.icustay_id, st.intime, st.last_event
+    having st.last_event = '-infinity'::timestamp or count(ev.event_time) > 0
+    """).format(wm=sql.Identifier(WATERMARK_TABLE))
+    with conn.cursor() as cur:
+        cur.execute(query, {'lab_items': LAB_ITEMIDS, 'vital_items': VITAL_ITEMIDS, **window_params(window)})
+        rows = cur.fetchall()
+        columns = [desc[0] for desc in cur.description]
+    return pd.DataFrame(rows, columns=columns)
+
+def scope_last_events(conn, scope_table=SCOPE_TABLE):
+    """
+    Overview:
+        Latest model-relevant lab, vital or echo/ecg note event of each stay in the scope table, regardless of watermark.
+        Used to set the watermarks after a full re-score of the stays.
+    Parameters:
+        conn: connection
+            Active database connection
+        scope_table: str
+            Table of icustay_ids to look up
+    Returns:
+        dataframe of icustay_id and last_event
+    """
+    query = sql.SQL("""
+    with stays as (
+        select ie.icustay_id, ie.hadm_id, ie.intime, ie.outtime
+        from icustays ie
+        join {scope} s on s.icustay_id = ie.icustay_id
+    ),
+    events as (
+        select st.icustay_id, le.charttime as event_time
+        from stays st
+        join labevents le on le.hadm_id = st.hadm_id and le.charttime between st.intime and st.outtime
+        where le.itemid in %(lab_items)s and le.valuenum > 0
+        union all
+        select st.icustay_id, ce.charttime
+        from stays st
+        join chartevents ce on ce.icustay_id = st.icustay_id and ce.charttime between st.intime and st.outtime
+        where ce.itemid in %(vital_items)s and ce.valuenum > 0
+        union all
+        select st.icustay_id, coalesce(ne.charttime, ne.chartdate)
+        from stays st
+        join noteevents ne on ne.hadm_id = st.hadm_id and ne.chartdate between st.intime and st.outtime
+        where ne.category in ('ECHO', 'ECG') and ne.iserror isnull
+    )
+    select st.icustay_id, coalesce(max(ev.event_time), st.intime) as last_event
+    from stays st
+    left join events ev on ev.icustay_id = st.icustay_id
+    group by st.icustay_id, st.intime
+    """).format(scope=sql.Identifier(scope_table))
+    with conn.cursor() as cur:
+        cur.execute(query, {'lab_items': LAB_ITEMIDS, 'vital_items': VITAL_ITEMIDS})
+        rows = cur.fetchall()
+    return pd.DataFrame(rows, columns=['icustay_id', 'last_event'])
+
+def stage_scope(conn, stays):
+    """
+    Loads the ids of the stays being refreshed into a temporary table the scoped extractions join against, and
+    analyzes it - temporary tables are never auto-analyzed, and the planner needs the real (small) stay count to
+    reach the event tables through their indexes.
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('create temporary table if not exists {} (icustay_id integer primary key) on commit drop').format(sql.Identifier(SCOPE_TABLE)))
+        cur.execute(sql.SQL('truncate {}').format(sql.Identifier(SCOPE_TABLE)))
+        execute_values(cur, sql.SQL('insert into {} (icustay_id) values %s').format(sql.Identifier(SCOPE_TABLE)),
+                       [(int(i),) for i in stays['icustay_id']])
+        cur.execute(sql.SQL('analyze {}').format(sql.Identifier(SCOPE_TABLE)))
+
+def scope_query(query_text, scope_table=SCOPE_TABLE):
+    '''
+    Overview:
+        Restricts an extraction query to the stays in the scope table by replacing its icustays relation with the
+        scoped subset of icustays.  Every extraction reads its stays through icustays, so the restriction lands in the
+        query's base CTE, ahead of the joins to the event tables and the daily grouping - a filter on the finished
+        query is not pushed through the grouping and would leave the event tables scanned in full.
+    Parameters:
+        query_text: str
+            Extraction query reading icustays
+        scope_table: str
+            Table of icustay_ids to restrict to
+    Returns:
+        psycopg2 sql Composed
+    '''
+    pieces = re.split(r'\bicustays\b', query_text, flags=re.IGNORECASE)
+    if len(pieces) == 1:
+        raise ValueError('Extraction query does not read icustays, so it cannot be restricted to the scope')
+    scoped = sql.SQL('(select * from icustays where icustay_id in (select icustay_id from {}))').format(sql.Identifier(scope_table))
+    parts = [sql.SQL(pieces[0])]
+    for piece in pieces[1:]:
+        parts += [scoped, sql.SQL(piece)]
+    return sql.Composed(parts)
+
+def scoped_extraction(filepath, conn, scope_table=SCOPE_TABLE):
+    '''
+    Overview:
+        Runs one of the bulk extraction queries restricted to the stays in the scope table (see scope_query), so only
+        those stays' events are read.
+    Parameters:
+        filepath: str
+            Location of the bulk sql file
+        conn: connection
+            Active database connection
+        scope_table: str
+            Table of icustay_ids to restrict to
+    Returns:
+        dataframe of the query results for the scoped stays
+    '''
+    extract_q_f = open(filepath)
+    extract_q = extract_q_f.read().strip().rstrip(';')
+    extract_q_f.close()
+    return pd.read_sql(scope_query(extract_q, scope_table), conn)
+
+def upsert_risk(conn, risk_df):
+    """
+    Overview:
+        Inserts or replaces daily risk scores keyed on (icustay_id, dos) with a bulk COPY upsert.  Left uncommitted so
+        the scores land in the same transaction as the watermarks.
+    Parameters:
+        conn: connection
+            Active database connection
+        risk_df: dataframe
+            subject_id, hadm_id, icustay_id, dos, day_n and mortality_risk columns
+    """
+    cols = ['subject_id', 'hadm_id', 'icustay_id', 'dos', 'day_n', 'mortality_risk']
+    copy_frame(conn, risk_df[cols], RISK_TABLE, upsert_keys=['icustay_id', 'dos'], commit=False)
+
+def advance_watermarks(conn, stays):
+    """
+    Records the last event time now reflected in each refreshed stay's scores.
+    """
+    query = sql.SQL("""
+    insert into {wm} (icustay_id, last_event) values %s
+    on conflict (icustay_id) do update
+    set last_event = excluded.last_event, refreshed_at = now()
+    """).format(wm=sql.Identifier(WATERMARK_TABLE))
+    rows = [(int(i), t) for i, t in zip(stays['icustay_id'], stays['last_event'])]
+    with conn.cursor() as cur:
+        execute_values(cur, query, rows)
+
+def incremental_refresh(conn, model=None, pipeline=None, labsql='bulk_member_model_labs.sql', patientsql='bulk_member_model_extraction.sql', vitalsql='bulk_member_model_chart_events.sql', echoecgsql='bulk_member_echo_ecg_notes.sql'):
+    """
+    Overview:
+        Re-scores only the patient-days whose inputs changed since the last refresh.
+        Changed stays are found from the events inserted since the event watermarks, their bulk extractions are pulled
+        (restricted to those stays), their daily grids rebuilt and scored, and scores from each stay's earliest new
+        event day onward are upserted.  Scores and watermarks are committed together, so a failed refresh is simply retried.
+    Parameters:
+        conn: connection
+            Active database connection
+        model: obj, optional
+            Fit classifier.  Defaults to the random forest pickle served from the model registry.
+        pipeline: FeaturePipeline, optional
+            Fitted feature pipeline saved with the model.  If not given the encoder is fit to each refresh batch.
+        labsql, patientsql, vitalsql, echoecgsql: str
+            Bulk extraction queries
+    Returns:
+        int number of daily rows upserted
+    """
+    if model is None:
+        model = registry.get(RF_MODEL_PATH)
+    id_cols = ['subject_id', 'hadm_id', 'icustay_id']
+    ensure_tables(conn)
+    window = event_window(conn, 'risk')
+    stays = changed_stays(conn, window)
+    print(f'{stays.shape[0]} stays with new events')
+    if stays.empty:
+        advance_event_watermarks(conn, 'risk', window)
+        conn.commit()
+        return 0
+    try:
+        stage_scope(conn, stays)
+        pt_admit = scoped_extraction(patientsql, conn)
+        pt_labs = scoped_extraction(labsql, conn)
+        pt_vitals = scoped_extraction(vitalsql, conn)
+        pt_ee_notes = scoped_extraction(echoecgsql, conn)
+        pt_admit, pt_labs, pt_vitals, pt_ee_docs = prepare_bulk_frames(pt_admit, pt_labs, pt_vitals, pt_ee_notes, id_cols)
+
+        daily_df = build_daily_grid(pt_admit, pt_labs, pt_vitals, pt_ee_docs)
+        X, y, risk = score_daily_grid(daily_df, list(pt_admit.columns), list(pt_labs.columns),
+                                      list(pt_vitals.columns), list(pt_ee_notes.columns), model, pipeline=pipeline)
+        daily_df['mortality_risk'] = risk
+
+        #only days on or after the first new event can have changed, including their carried-forward values
+        first_new = daily_df['icustay_id'].map(stays.set_index('icustay_id')['first_new_date'])
+        touched = daily_df.loc[daily_df['dos'] >= pd.to_datetime(first_new)]
+        upsert_risk(conn, touched)
+        advance_watermarks(conn, stays)
+        advance_event_watermarks(conn, 'risk', window)
+    except (Exception, psy.DatabaseError) as error:
+        print(f'Error: {error}')
+        conn.rollback()
+        raise
+    conn.commit()
+    print(f'{touched.shape[0]} daily risk scores refreshed')
+    return touched.shape[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Incrementally refresh daily ICU mortality risk scores')
+    parser.add_argument('--model', default=RF_MODEL_PATH, help='pickled classifier to score with')
+    parser.add_argument('--pivots', action='store_true', help='refresh the daily lab/vital pivot tables (daily_pivots.py) and extract from them')
+    args = parser.parse_args()
+    conn = connect()
+    try:
+        if args.pivots:
+            from daily_pivots import refresh_pivots, PIVOT_SQL
+            refresh_pivots(conn)
+            incremental_refresh(conn, registry.get(args.model), **PIVOT_SQL)
+        else:
+            incremental_refresh(conn, registry.get(args.model))
+    finally:
+        release(conn)
@@ -1,32 +1,78 @@
-#gensim
-import smart_open
-import gensim
-from gensim.utils import simple_preprocess
-from gensim.parsing.preprocessing import STOPWORDS
-import gensim.corpora as corpora
-from gensim.models import CoherenceModel
+#gensim, the nltk-based tokenizer and the feature cache are imported inside build_lda_model / update_lda_model
+from mimic_fxns import connect, release, data_extraction, data_extraction_chunks
+from model_registry import load_pickle, LDA_MODEL_PATH, LDA_DICTIONARY_PATH, LDA_STATE_PATH
+from pipeline_metrics import stage
 
-#nltk
-from nltk.stem import WordNetLemmatizer, SnowballStemmer
-import nltk
+import os
+import json
+import time
+import pickle
+import argparse
+import numpy as np
 
-from mimic_fxns import connect, data_extraction
 
-import pickle
+#Echo/ecg LDA topic model.  build_lda_model fits the model from scratch on the full training note extraction;
+#update_lda_model keeps it current instead by streaming only the notes added since the model's watermark (the highest
+#noteevents.row_id it has seen, kept in <model>_state.json), growing the dictionary under a vocabulary cap and folding
+#the new documents in with gensim's online update.  The updated model only replaces the saved one if its topic
+#coherence on the new notes has not dropped.
+#   python lda_model_pipeline.py                  full rebuild
+#   python lda_model_pipeline.py --update         incremental update from the watermark
+#   python lda_model_pipeline.py --update --dry-run
+
+UPDATE_NOTES_SQL = 'update_echo_ecg_notes.sql'
+MAX_VOCAB = 50000
+MIN_NEW_TOKEN_DF = 5
+COHERENCE_TOLERANCE = .05
+EVAL_DOCS = 2000
+
+
+def note_watermark(conn):
+    """
+    Highest noteevents.row_id of the echo/ecg notes currently in the database (0 if there are none).
+    """
+    with conn.cursor() as cur:
+        cur.execute("select coalesce(max(row_id), 0) from noteevents where category in ('ECHO', 'ECG')")
+        return int(cur.fetchone()[0])
+
+def load_lda_state(state_path=LDA_STATE_PATH):
+    """
+    The saved model's training state (watermark, documents seen, last coherence), or an empty state if there is none.
+    """
+    if state_path is None or not os.path.exists(state_path):
+        return {'last_row_id': None}
+    with open(state_path) as f:
+        return json.load(f)
 
-def lemmatize_stemming(text):
-    stemmer = SnowballStemmer('english')
-    return stemmer.stem(WordNetLemmatizer().lemmatize(text, pos='v'))
+def replace_file(path, write):
+    """
+    Writes path through a temporary file and an atomic rename, so readers never see a partial file.
+    write is called with the open binary file.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
 
-def preprocess(text):
-    result = []
-    for token in gensim.utils.simple_preprocess(text):
-        if token not in gensim.parsing.preprocessing.STOPWORDS and len(token) > 3:
-            result.append(lemmatize_stemming(token))
-    return result
+def save_lda_model(lda_model, dictionary, state, model_path=LDA_MODEL_PATH, dictionary_path=LDA_DICTIONARY_PATH, state_path=LDA_STATE_PATH):
+    """
+    Overview:
+        Promotes a model: replaces the saved model, dictionary and state files.  The model goes first - until the
+        dictionary follows, scorers pair it with the old dictionary, whose ids are a prefix of the new one's.
+    Parameters:
+        lda_model: obj
+            Fit gensim LDA model
+        dictionary: gensim Dictionary
+            Its training dictionary
+        state: dict
+            Training state to record (see load_lda_state)
+    """
+    replace_file(model_path, lambda f: pickle.dump(lda_model, f, pickle.HIGHEST_PROTOCOL))
+    replace_file(dictionary_path, lambda f: pickle.dump(dictionary, f, pickle.HIGHEST_PROTOCOL))
+    replace_file(state_path, lambda f: f.write(json.dumps(state, indent=1).encode()))
 
 
-def build_lda_model(cn='default', notetype='echo_ecg', topic_n=10, make_pickl=False, pickle_f='lda_echo_ecg_model'):
+def build_lda_model(cn='default', notetype='echo_ecg', topic_n=10, make_pickl=False, pickle_f='lda_echo_ecg_model', processes=None, cache='default', refresh=False):
     """
         LDA model pipeline for echo/ecg notes
         Parameters:
@@ -37,25 +83,43 @@ def build_lda_model(cn='default', notetype='echo_ecg', topic_n=10, make_pickl=Fa
             topic_n: int
                 Integer specifying the number of latent topics to create from the corpus.
             make_pickl: bool
-                Flag for indicating if a pickle file should be made from the fit model.
+                Flag for indicating if a pickle file should be made from the fit model (and its training dictionary).
+            processes: int
+                Worker processes used to tokenize the corpus.  None uses every available core.
+            cache: FeatureCache
+                On-disk cache for the note extraction.  Default value uses the default cache location; None always queries the database.
+            refresh: bool
+                Flag for re-running the note extraction and replacing any cached results.
         Returns:
             lda_model: obj
                 Returns the fit lda model object
             pickel: file
-                Outputs the fit model as a pickel file if make_pickl = True
+                Outputs the fit model as a pickel file if make_pickl = True, with the dictionary alongside as <pickle_f>_dictionary.pickle
     """
-    if cn == 'default':
-        conn = connect()
+    import gensim
+    from note_tokenizer import preprocess_corpus
+    from feature_cache import default_cache
     if notetype == 'echo_ecg':
         notepath = 'train_echo_ecg_notes.sql'
         notecol = 'echo_ecg'
 
-    notes = data_extraction(notepath, conn)
+    if cache == 'default':
+        cache = default_cache()
+    #a connection opened here goes back to the pool once the notes are read; one passed in stays with the caller
+    conn = connect() if cn == 'default' else cn
+    try:
+        #taken before the extraction, so notes added while it runs are left to the next update (a cached extraction may
+        #predate it - use refresh to make the watermark exact)
+        last_row_id = note_watermark(conn)
+        notes = data_extraction(notepath, conn, cache, refresh)
+    finally:
+        if cn == 'default':
+            release(conn)
     notes.dropna(axis=0, inplace=True)
     docs = notes[['subject_id', 'hadm_id', notecol]].groupby(['subject_id','hadm_id']).sum()
     docs.reset_index(inplace=True)
     #stemmer = SnowballStemmer('english')
-    processed_docs = docs[notecol].map(preprocess)
+    processed_docs = preprocess_corpus(docs[notecol], processes=processes)
     #create dictionary
     id2word = gensim.corpora.Dictionary(processed_docs)
     #create corpus
@@ -70,9 +134,221 @@ def build_lda_model(cn='default', notetype='echo_ecg', topic_n=10, make_pickl=Fa
         open(fname,'x')
         with open(fname, 'wb') as f:
             pickle.dump(lda_model, f, pickle.HIGHEST_PROTOCOL)
+        #training vocabulary, so scoring maps tokens to the same ids the model was fit on
+        dict_fname = pickle_f + '_dictionary.pickle'
+        open(dict_fname,'x')
+        with open(dict_fname, 'wb') as f:
+            pickle.dump(id2word, f, pickle.HIGHEST_PROTOCOL)
+        #watermark for update_lda_model
+        with open(pickle_f + '_state.json', 'w') as f:
+            json.dump({'last_row_id': last_row_id, 'documents': len(bow_corpus), 'updates': [],
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S')}, f, indent=1)
 
     return lda_model
 
+def grow_dictionary(dictionary, docs, max_vocab=MAX_VOCAB, min_df=MIN_NEW_TOKEN_DF):
+    """
+    Overview:
+        Adds the new documents to the dictionary in place.  Document frequencies of known tokens are updated; new tokens
+        are kept only if they occur in at least min_df of the documents, most frequent first, while the vocabulary is
+        under max_vocab.  Existing token ids never change, so the model's topic-term matrix can simply be extended.
+    Parameters:
+        dictionary: gensim Dictionary
+            Training dictionary of the model
+        docs: list
+            Token lists of the new documents
+        max_vocab: int
+            Cap on the vocabulary size
+        min_df: int
+            Documents a new token must appear in to be added
+    Returns:
+        int, tokens added
+    """
+    known = len(dictionary)
+    dictionary.add_documents(docs, prune_at=None)
+    new_ids = np.arange(known, len(dictionary))
+    dfs = np.array([dictionary.dfs.get(token_id, 0) for token_id in new_ids], dtype=np.int64)
+    #stable sort keeps first-seen order among equal frequencies, so the result does not depend on hash order
+    ranked = new_ids[np.argsort(-dfs, kind='stable')]
+    ranked = ranked[dfs[ranked - known] >= min_df][:max(max_vocab - known, 0)]
+    dictionary.filter_tokens(bad_ids=np.setdiff1d(new_ids, ranked).tolist())
+    return len(dictionary) - known
+
+def grow_lda_model(lda_model, num_terms):
+    """
+    Overview:
+        Extends a fit LDA model in place to a larger vocabulary (new ids appended, as grow_dictionary adds them).  New
+        terms start with no topic counts, i.e. at the prior, and get their weights from the following updates.
+    Parameters:
+        lda_model: obj
+            Fit gensim LDA model
+        num_terms: int
+            New vocabulary size
+    """
+    added = num_terms - lda_model.num_terms
+    if added <= 0:
+        return
+    #per-term prior; a symmetric eta is padded with its value, an asymmetric one with its mean
+    eta = np.asarray(lda_model.eta, dtype=lda_model.dtype)
+    pad = eta[0] if np.all(eta == eta[0]) else eta.mean()
+    lda_model.eta = np.concatenate([eta, np.full(added, pad, dtype=eta.dtype)])
+    lda_model.state.eta = lda_model.eta
+    lda_model.state.sstats = np.hstack([lda_model.state.sstats,
+                                        np.zeros((lda_model.num_topics, added), dtype=lda_model.state.sstats.dtype)])
+    lda_model.num_terms = num_terms
+    lda_model.sync_state()
+
+def topic_terms(lda_model, dictionary, topn=20):
+    """
+    Top topn tokens of each topic, for scoring coherence independently of the model object.
+    """
+    return [[dictionary[term_id] for term_id, _ in lda_model.get_topic_terms(topic, topn=topn)]
+            for topic in range(lda_model.num_topics)]
+
+def topic_coherence(topics, docs, dictionary, coherence='u_mass', topn=20):
+    """
+    Overview:
+        Coherence of a set of topics on sample documents (higher is better).
+    Parameters:
+        topics: list
+            Token lists, one per topic (see topic_terms)
+        docs: list
+            Token lists of the sample documents
+        dictionary: gensim Dictionary
+            Dictionary covering every topic token
+        coherence: str
+            gensim coherence measure; 'u_mass' needs only the bag-of-words corpus, the others the token lists too
+    Returns:
+        float
+    """
+    from gensim.models import CoherenceModel
+    corpus = [dictionary.doc2bow(doc) for doc in docs]
+    return CoherenceModel(topics=topics, texts=docs, corpus=corpus, dictionary=dictionary, coherence=coherence,
+                          topn=topn, processes=1).get_coherence()
+
+def update_lda_model(conn, model_path=LDA_MODEL_PATH, dictionary_path=LDA_DICTIONARY_PATH, state_path=LDA_STATE_PATH, since_row_id=None, chunksize=20000, max_vocab=MAX_VOCAB, min_df=MIN_NEW_TOKEN_DF, coherence='u_mass', tolerance=COHERENCE_TOLERANCE, eval_docs=EVAL_DOCS, promote=True, processes=None, seed=18):
+    """
+    Overview:
+        Incremental training of the saved LDA model.  Echo/ecg notes with a row_id above the watermark are streamed in
+        chunks; each chunk's admissions are tokenized into documents, the dictionary grown (grow_dictionary) and the
+        model extended (grow_lda_model) and updated in place with gensim's online update - the cost follows the
+        number of new notes, not the corpus.  A sample of the new documents is kept to compare the coherence of the
+        topics before and after; the result is promoted (save_lda_model) with the watermark advanced unless
+        coherence fell by more than tolerance.
+    Parameters:
+        conn: connection
+            Active database connection
+        model_path, dictionary_path, state_path: str
+            Saved model, dictionary and state files (see build_lda_model)
+        since_row_id: int, optional
+            Watermark to start from instead of the saved one (required if there is no state file)
+        chunksize: int
+            Note rows fetched per chunk
+        max_vocab: int
+            Cap on the dictionary size
+        min_df: int
+            Documents of a chunk a new token must appear in to join the dictionary
+        coherence: str
+            gensim coherence measure used for the promotion check
+        tolerance: float
+            Largest relative drop in coherence still promoted
+        eval_docs: int
+            Size of the document sample the coherence is measured on
+        promote: bool
+            If False the update is only evaluated and nothing is saved
+        processes: int
+            Worker processes used to tokenize each chunk.  None uses every available core.
+        seed: int
+            Seed of the evaluation sample
+    Returns:
+        dict summarising the update
+    """
+    from note_tokenizer import preprocess_corpus
+    state = load_lda_state(state_path)
+    last_row_id = state.get('last_row_id') if since_row_id is None else since_row_id
+    if last_row_id is None:
+        raise ValueError(f'No watermark in {state_path} - rebuild the model or pass since_row_id')
+    through_row_id = note_watermark(conn)
+    summary = {'last_row_id': last_row_id, 'through_row_id': through_row_id, 'notes': 0, 'documents': 0,
+               'tokens_added': 0, 'promoted': False}
+    if through_row_id <= last_row_id:
+        print(f'No echo/ecg notes after row {last_row_id}')
+        return summary
+    lda_model = load_pickle(model_path)
+    dictionary = load_pickle(dictionary_path) if os.path.exists(dictionary_path) else lda_model.id2word
+    #the model and dictionary are pickled separately; the model is updated against the one that gets grown
+    lda_model.id2word = dictionary
+    before = topic_terms(lda_model, dictionary)
+    rng = np.random.default_rng(seed)
+    sample = []
+    chunks = data_extraction_chunks(UPDATE_NOTES_SQL, conn, chunksize, key_cols=('subject_id', 'hadm_id'), downcast=False,
+                                    cursor_name='lda_update_notes',
+                                    params={'last_row_id': last_row_id, 'through_row_id': through_row_id})
+    with stage('lda_update') as update_stage:
+        for notes in chunks:
+            with stage('update_chunk', notes) as chunk_stage:
+                docs = notes[['subject_id', 'hadm_id', 'echo_ecg']].groupby(['subject_id', 'hadm_id']).sum()
+                processed_docs = [doc for doc in preprocess_corpus(docs['echo_ecg'], processes=processes) if doc]
+                added = grow_dictionary(dictionary, processed_docs, max_vocab, min_df)
+                grow_lda_model(lda_model, len(dictionary))
+                if processed_docs:
+                    lda_model.update([dictionary.doc2bow(doc) for doc in processed_docs])
+                chunk_stage.output(len(processed_docs))
+                chunk_stage.note(tokens_added=added)
+            #reservoir sample of the new documents for the coherence check
+            for doc in processed_docs:
+                summary['documents'] += 1
+                if len(sample) < eval_docs:
+                    sample.append(doc)
+                else:
+                    slot = rng.integers(summary['documents'])
+                    if slot < eval_docs:
+                        sample[slot] = doc
+            summary['notes'] += len(notes)
+            summary['tokens_added'] += added
+        update_stage.output(summary['documents'])
+    if not sample:
+        print(f'No usable echo/ecg notes in rows {last_row_id + 1}-{through_row_id}')
+        return summary
+    with stage('coherence_check'):
+        summary['coherence_before'] = float(topic_coherence(before, sample, dictionary, coherence))
+        summary['coherence_after'] = float(topic_coherence(topic_terms(lda_model, dictionary), sample, dictionary, coherence))
+    drop = summary['coherence_before'] - summary['coherence_after']
+    accepted = drop <= tolerance * abs(summary['coherence_before'])
+    print(f'{summary["notes"]} notes ({summary["documents"]} documents), {summary["tokens_added"]} tokens added, '
+          f'{coherence} coherence {summary["coherence_before"]:.4f} -> {summary["coherence_after"]:.4f}')
+    if not accepted:
+        print('Coherence dropped beyond tolerance - saved model kept')
+    elif not promote:
+        print('Dry run - saved model kept')
+    else:
+        state['last_row_id'] = through_row_id
+        state['documents'] = state.get('documents', 0) + summary['documents']
+        state.setdefault('updates', []).append({**{key: summary[key] for key in summary if key != 'promoted'},
+                                                'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        save_lda_model(lda_model, dictionary, state, model_path, dictionary_path, state_path)
+        summary['promoted'] = True
+        print(f'Updated model promoted, watermark now row {through_row_id}')
+    return summary
+
 
 if __name__ == '__main__':
-    build_lda_model(make_pickl=True, pickle_f='lda_echo_ecg_model')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Build the echo/ecg LDA topic model')
+    parser.add_argument('--refresh', action='store_true', help='re-run the note extraction instead of using cached results')
+    parser.add_argument('--no-cache', action='store_true', help='bypass the extraction results cache entirely')
+    parser.add_argument('--update', action='store_true', help='update the saved model with the notes added since its watermark')
+    parser.add_argument('--since-row-id', type=int, default=None, help='watermark to update from instead of the saved one')
+    parser.add_argument('--max-vocab', type=int, default=MAX_VOCAB, help='cap on the dictionary size when updating')
+    parser.add_argument('--min-df', type=int, default=MIN_NEW_TOKEN_DF, help='documents a new token needs to join the dictionary')
+    parser.add_argument('--tolerance', type=float, default=COHERENCE_TOLERANCE, help='largest relative coherence drop still promoted')
+    parser.add_argument('--dry-run', action='store_true', help='evaluate the update without saving it')
+    args = parser.parse_args()
+    if args.update:
+        conn = connect()
+        try:
+            update_lda_model(conn, since_row_id=args.since_row_id, max_vocab=args.max_vocab, min_df=args.min_df,
+                             tolerance=args.tolerance, promote=not args.dry_run)
+        finally:
+            release(conn)
+    else:
+        build_lda_model(make_pickl=True, pickle_f='lda_echo_ecg_model', cache=None if args.no_cache else 'default', refresh=args.refresh)
\ No newline at end of file
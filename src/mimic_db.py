@@ -0,0 +1,414 @@
+#the basics
+import numpy as np
+import pandas as pd
+
+#connection and file tools
+import os
+import io
+import atexit
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pipeline_metrics import stage
+#psycopg2 is imported inside the functions that use it, so importing this module stays cheap
+
+
+def connect_details():
+    schema = 'mimiciii'
+    con_details = {"dbname" : 'mimic', 
+               "user" : os.environ['PGSQL_P_USER'], 
+               "password" : os.environ['PGSQL_P_PWD'], 
+               "host" : 'localhost',
+              "options":f'-c search_path={schema}' 
+              }
+    return con_details
+
+def pool_key(connection_details):
+    return tuple(sorted(connection_details.items()))
+
+_pools = {}
+_pool_of = {}
+_pool_lock = threading.Lock()
+POOL_MAX = int(os.environ.get('MIMIC_DB_POOL_MAX', 8))
+
+def get_pool(connection_details=None, maxconn=POOL_MAX):
+    """
+    Overview:
+        Returns the shared, thread-safe psycopg2 connection pool for a database, creating it on first use.  Extraction,
+        loading and scoring all draw connections from the same pool, so a process holds at most maxconn connections
+        per database no matter how many times connect is called.
+    Parameters:
+        connection_details: dict
+            psycopg2 connection parameters, defaults to connect_details()
+        maxconn: int
+            Most connections the pool will open (MIMIC_DB_POOL_MAX env override)
+    Returns:
+        ThreadedConnectionPool
+    """
+    from psycopg2.pool import ThreadedConnectionPool
+    if connection_details is None:
+        connection_details = connect_details()
+    key = pool_key(connection_details)
+    with _pool_lock:
+        if key not in _pools:
+            _pools[key] = ThreadedConnectionPool(1, maxconn, **connection_details)
+        return _pools[key]
+
+def connect(connection_details=None):  
+    """
+    Overview:
+        Establishes connection to PostgreSQL database, drawn from the shared connection pool (see get_pool).
+        Hand it back with release, or use pooled_connection - a pool with POOL_MAX connections out raises PoolError.
+    Parameters:
+        connection_details = dict  
+    Returns:
+        conn: connection
+    """
+    conn = None
+    if connection_details is None:
+        connection_details = connect_details()
+    try:
+        print('Connecting to PostgreSQL database...')
+        pool = get_pool(connection_details)
+        conn = pool.getconn()
+    except Exception as error:
+        print(f'Unable to connect to the database: {error}')
+        raise
+    _pool_of[id(conn)] = pool
+    print('Connection successful')
+    return conn
+
+def release(conn):
+    """
+    Returns a connection from connect to its pool, rolling back anything uncommitted.  Connections not drawn from a pool are closed.
+    """
+    pool = _pool_of.pop(id(conn), None)
+    if pool is None:
+        conn.close()
+        return
+    if not conn.closed:
+        conn.rollback()
+    pool.putconn(conn)
+
+@contextmanager
+def pooled_connection(connection_details=None):
+    """
+    Context manager version of connect/release.
+    """
+    conn = connect(connection_details)
+    try:
+        yield conn
+    finally:
+        release(conn)
+
+def close_pools():
+    with _pool_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+        _pool_of.clear()
+
+atexit.register(close_pools)
+
+def csv_buffer(df):
+    """
+    Overview:
+        Writes a dataframe to an in-memory CSV buffer in the form COPY ... (format csv) reads: no header, nulls as empty
+        fields.  Float columns holding only finite whole numbers (ids that picked up NaNs) are written without a decimal
+        point so they load into integer columns; columns with infinities stay floats.
+    Parameters:
+        df: dataframe
+    Returns:
+        StringIO positioned at the start
+    """
+    out = {}
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_float_dtype(values):
+            present = values.dropna()
+            if np.isfinite(present).all() and (present == np.floor(present)).all():
+                values = values.astype('Int64')
+        out[col] = values
+    buf = io.StringIO()
+    pd.DataFrame(out).to_csv(buf, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S')
+    buf.seek(0)
+    return buf
+
+def upsert_clause(columns, upsert_keys, quote):
+    """
+    ON CONFLICT clause replacing the non-key columns, or ignoring the row if every column is a key.
+    """
+    if upsert_keys is None:
+        return ''
+    keys = ', '.join(quote(col) for col in upsert_keys)
+    updates = [col for col in columns if col not in upsert_keys]
+    if not updates:
+        return f' on conflict ({keys}) do nothing'
+    return f' on conflict ({keys}) do update set ' + ', '.join(f'{quote(col)} = excluded.{quote(col)}' for col in updates)
+
+def copy_frame(conn, data_df, table, upsert_keys=None, batch_rows=100000, commit=True):
+    """
+    Overview:
+        Bulk loads a dataframe into a table.  On Postgres each batch is streamed with COPY FROM STDIN from an in-memory
+        CSV buffer - straight into the table, or, when upserting, into a temporary staging table that is then merged
+        with insert ... on conflict.  On a sqlite3 connection (local testing) the same upsert is run with executemany.
+    Parameters:
+        conn: connection
+            Active database connection (psycopg2 or sqlite3)
+        data_df: dataframe
+            Rows to load - column names must match the target table
+        table: str
+            Target table
+        upsert_keys: list, optional
+            Unique key of the table.  If given, existing rows with the same key are replaced rather than duplicated.
+        batch_rows: int
+            Rows per COPY (and per commit)
+        commit: bool
+            If True each batch is committed as it is loaded; if False the caller owns the transaction
+    Returns:
+        int number of rows loaded
+    """
+    if isinstance(conn, sqlite3.Connection):
+        return sqlite_copy_frame(conn, data_df, table, upsert_keys, batch_rows, commit)
+    from psycopg2 import sql
+    columns = list(data_df.columns)
+    col_list = sql.SQL(', ').join(sql.Identifier(col) for col in columns)
+    target = sql.Identifier(table)
+    with conn.cursor() as cur:
+        if upsert_keys is None:
+            copy_q = sql.SQL('copy {} ({}) from stdin with (format csv)').format(target, col_list)
+        else:
+            stage = sql.Identifier(f'{table}_stage')
+            #on commit delete rows keeps the staging table alive across batch commits
+            cur.execute(sql.SQL('create temporary table if not exists {} (like {} including defaults) on commit delete rows').format(stage, target))
+            copy_q = sql.SQL('copy {} ({}) from stdin with (format csv)').format(stage, col_list)
+            quote = lambda col: sql.Identifier(col).as_string(cur)
+            merge_q = sql.SQL('insert into {} ({}) select {} from {}' + upsert_clause(columns, upsert_keys, quote)).format(
+                target, col_list, col_list, stage)
+            truncate_q = sql.SQL('truncate {}').format(stage)
+        copy_q = copy_q.as_string(cur)
+        for start in range(0, len(data_df), batch_rows):
+            batch = data_df.iloc[start:start + batch_rows]
+            cur.copy_expert(copy_q, csv_buffer(batch))
+            if upsert_keys is not None:
+                cur.execute(merge_q)
+                cur.execute(truncate_q)
+            if commit:
+                conn.commit()
+    return len(data_df)
+
+def sqlite_copy_frame(conn, data_df, table, upsert_keys=None, batch_rows=100000, commit=True):
+    """
+    SQLite fallback for copy_frame - batched executemany with the same upsert semantics.
+    """
+    quote = lambda col: '"' + col.replace('"', '""') + '"'
+    columns = list(data_df.columns)
+    query = (f'insert into {quote(table)} ({", ".join(quote(col) for col in columns)}) '
+             f'values ({", ".join("?" * len(columns))})' + upsert_clause(columns, upsert_keys, quote))
+    for start in range(0, len(data_df), batch_rows):
+        batch = data_df.iloc[start:start + batch_rows].copy()
+        for col in batch.columns:
+            if pd.api.types.is_datetime64_any_dtype(batch[col]):
+                batch[col] = batch[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+        rows = [tuple(None if pd.isna(v) else v.item() if isinstance(v, np.generic) else v for v in row)
+                for row in batch.astype(object).itertuples(index=False, name=None)]
+        conn.executemany(query, rows)
+        if commit:
+            conn.commit()
+    return len(data_df)
+
+def insert_data(con_details, data_df, table, conn, upsert_keys=None):
+    """
+    Overview:
+        Add's data set from dataframe to table in connected database with a bulk COPY (see copy_frame), committed once all
+        batches are loaded.  Rollsback if error in loading and prints the error and returns a value for error handling.
+    Parameters:
+        conn_details: dict
+            Unused - kept for existing callers, the load goes through conn
+        data_df: dataframe
+            Dataset to add to table - assumes schema of dataframe is compatible with schema of target table
+        table: str
+            name of target table in connected database
+        conn: connection
+            Active database connection
+        upsert_keys: list, optional
+            Unique key of the table - rows already present are replaced instead of duplicated
+    Returns:
+        int if error, none if no error.
+        prints status.
+    """
+    try:
+        copy_frame(conn, data_df, table, upsert_keys, commit=False)
+    except Exception as error:
+        print(f'Error: {error}')
+        conn.rollback()
+        return 1
+    conn.commit()
+    print(f'Successful updating of {table}')
+
+def data_extraction(filepath, conn, cache=None, refresh=False):
+    '''
+    Overview:
+        uses file and connection to execute sql query and return results in a dataframe.
+    Parameters:
+        filepath: str
+            Location of desired sql file to execute with the active connection
+        conn: connection
+            Active database connection
+        cache: FeatureCache, optional
+            On-disk results cache (see feature_cache.py).  Results are served from it when the query text and connection
+            target are unchanged, and written to it after a database read.
+        refresh: bool
+            If True the query is re-run against the database and the cached copy replaced.
+    Returns:
+        dataframe contain the query results.
+    '''
+    from psycopg2 import sql
+    extract_q_f = open(filepath)
+    query_text = extract_q_f.read()
+    extract_q_f.close()
+    with stage('data_extraction:' + os.path.basename(filepath)) as current:
+        if cache is not None:
+            key = cache.key_for(query_text, conn)
+            if not refresh:
+                cached = cache.get(key)
+                if cached is not None:
+                    current.note(source='cache')
+                    return current.output(cached)
+        current.note(source='database')
+        results = current.output(pd.read_sql(sql.SQL(query_text), conn))
+        if cache is not None:
+            cache.put(key, results)
+    return results
+
+def downcast_frame(df, id_cols=('subject_id', 'hadm_id', 'icustay_id'), category_cols=()):
+    """
+    Overview:
+        Shrinks an extracted frame in place: float columns to float32, complete id columns to int32 and the given
+        label columns to categoricals.
+    Parameters:
+        df: dataframe
+            Extracted query results
+        id_cols: iterable
+            Id columns to store as int32 (skipped if missing or containing nulls)
+        category_cols: iterable
+            Low-cardinality label columns to store as categoricals
+    Returns:
+        dataframe
+    """
+    for col in df.columns:
+        if col in id_cols:
+            if df[col].notna().all():
+                df[col] = df[col].astype(np.int32)
+        elif col in category_cols:
+            df[col] = df[col].astype('category')
+        elif pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype(np.float32)
+    return df
+
+def stream_key(df, key_cols):
+    """
+    Combines one or two positive integer id columns into a single int64 that sorts the same way as ORDER BY key_cols.
+    """
+    key = np.zeros(len(df), dtype=np.int64)
+    for col in key_cols:
+        key = key * 2**31 + df[col].to_numpy(dtype=np.int64)
+    return key
+
+def data_extraction_chunks(filepath, conn, chunksize=100000, key_cols=('subject_id', 'hadm_id'), downcast=True, category_cols=(), cursor_name='mimic_stream', params=None):
+    '''
+    Overview:
+        Streaming version of data_extraction.  Runs the query on a server-side (named) cursor and yields the results as
+        dataframe chunks, so only about one chunk is held in memory at a time.  Rows for the trailing key of a chunk are
+        held back and emitted with the next one, so no admission is split across chunks - the query must be ordered by key_cols.
+        A query returning no rows yields a single empty dataframe with the query's columns.
+    Parameters:
+        filepath: str
+            Location of desired sql file to execute with the active connection
+        conn: connection
+            Active database connection
+        chunksize: int
+            Rows fetched from the server per round trip
+        key_cols: iterable
+            Id columns the query is ordered by and that chunks must not split
+        downcast: bool
+            If True chunks are passed through downcast_frame
+        category_cols: iterable
+            Label columns converted to categoricals when downcasting
+        cursor_name: str
+            Name of the server-side cursor
+        params: dict, optional
+            Query parameters, for queries with %(name)s placeholders
+    Returns:
+        generator of dataframes
+    '''
+    from psycopg2 import sql
+    extract_q_f = open(filepath)
+    extract_q = sql.SQL(extract_q_f.read())
+    extract_q_f.close()
+    key_cols = list(key_cols)
+    carry = None
+    with conn.cursor(name=cursor_name) as cur:
+        cur.itersize = chunksize
+        cur.execute(extract_q, params)
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+            chunk = pd.DataFrame.from_records(rows, columns=[desc[0] for desc in cur.description], coerce_float=True)
+            if downcast:
+                downcast_frame(chunk, category_cols=category_cols)
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            key = stream_key(chunk, key_cols)
+            tail = key == key[-1]
+            carry = chunk.loc[tail].reset_index(drop=True)
+            if not tail.all():
+                yield chunk.loc[~tail].reset_index(drop=True)
+        #a query with no rows still yields its (empty) frame, so consumers see the query's columns
+        if carry is None and cur.description is not None:
+            carry = pd.DataFrame(columns=[desc[0] for desc in cur.description])
+    if carry is not None:
+        yield carry
+
+class KeyAlignedStream:
+    """
+    Wraps a key-ordered chunk generator (see data_extraction_chunks) so rows can be pulled up to a given key,
+    merge-join style, buffering whatever belongs to later keys.  columns is the schema of the empty frames returned
+    before the stream has produced a chunk (e.g. for a None or empty stream); after that the chunks' own columns are used.
+    """
+
+    def __init__(self, chunks, key_cols=('subject_id', 'hadm_id'), columns=None):
+        self.chunks = iter(chunks) if chunks is not None else iter(())
+        self.key_cols = list(key_cols)
+        self.buffer = []
+        self.exhausted = False
+        self.columns = list(columns) if columns is not None else self.key_cols
+
+    def take_through(self, max_key):
+        """
+        Returns all remaining rows with stream_key <= max_key as one dataframe (empty if there are none).
+        """
+        taken = []
+        while True:
+            if not self.buffer:
+                if self.exhausted:
+                    break
+                try:
+                    self.buffer.append(next(self.chunks))
+                    self.columns = list(self.buffer[0].columns)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+            chunk = self.buffer[0]
+            key = stream_key(chunk, self.key_cols)
+            upto = np.searchsorted(key, max_key, side='right')
+            if upto < len(chunk):
+                taken.append(chunk.iloc[:upto])
+                self.buffer[0] = chunk.iloc[upto:]
+                break
+            taken.append(chunk)
+            self.buffer.pop(0)
+        if not taken:
+            return pd.DataFrame(columns=self.columns)
+        return pd.concat(taken, ignore_index=True)
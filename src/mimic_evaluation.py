@@ -0,0 +1,33 @@
+#model evaluation - sklearn.metrics is imported on first use
+
+
+def print_results(model, X, y, score, precision, recall):
+    """
+    Function for printing out details of confusion matrix analysis for a given model.
+    Parameters:
+    model: model that has been fit with data and has basic functionalaity aligned with SKLearn.
+    X: 2d array - data points as x, features for data points as columns
+    Y: 1d array - labels for data points in X
+    score, precision, recall: float - provided metrics for printing.
+    """
+    from sklearn.metrics import plot_confusion_matrix
+    print(model)
+    print(f'Score is {score}')
+    print(f'Precision is {precision} and recall is {recall}')
+    plot_confusion_matrix(model, X, y)
+
+def produce_results(model, X, y, pprint = True):
+    """
+    creates confusion matrix and calcluates score, precision, recall
+    if pprint is true, also prints colored confusion matrix and string summaries
+    """
+    from sklearn.metrics import precision_score, recall_score
+    yhat = model.predict(X)
+    #cm = confusion_matrix(y, yhat)
+    precision = precision_score(y, yhat)
+    recall = recall_score(y, yhat)
+    score = model.score(X,y)
+    
+    if pprint == True:
+        print_results(model, X, y,score, precision, recall)
+    return score, precision, recall
@@ -0,0 +1,432 @@
+#the basics
+import numpy as np
+import pandas as pd
+
+from mimic_db import stream_key, KeyAlignedStream
+from pipeline_metrics import stage, timed
+#sklearn (encoding) and the topic model stack (echoecg_topics) are imported on first use
+
+
+def normal_lab_vital_ranges():
+    norm_ranges = {
+        'aniongap':[3,10], 
+        'albumin':[3.5,5.5], 
+        'bilirubin':[.3,1.2], 
+        'creatinine':[.7,1.3], 
+        'glucose':[100,200], 
+        'hematocrit':[36,51],
+        'hemoglobin':[12,17], 
+        'lactate':[6,16], 
+        'platelet':[150,350],
+        'sodium':[136,145], 
+        'bun':[8,20], 
+        'wbc':[4.0,10.0],
+        'temperature':[36.0, 37.2],
+        'heartrate':[50.0,100.0],
+        'systolic_bp':[90.0,120.0],
+        'mean_arterial_pressure':[60.0,100.0]}    
+    return norm_ranges
+
+def data_processing_column_refs():
+    ids = ['subject_id', 'hadm_id', 'icustay_id']
+    month_col = ['admit_time_m']
+    age_col = ['age_']
+    cols_for_encoding = ['admission_type', 'first_careunit', 'insurance', 'relig', 'marital']
+    chronic_cols = ['cirrhosis', 'hiv', 'immuno_def', 'hep_fail', 'blood_cncr', 'metastatic_cncr']
+    merge_cols = ['subject_id', 'hadm_id']    
+    return ids, month_col, age_col, cols_for_encoding, chronic_cols, merge_cols
+
+def lab_val_scale(val, rng):
+    """
+    """
+    norm_width = rng[1] - rng[0]
+    sign = 1
+    if val is None:
+        return val
+    if val > rng[1]:
+        diff = val - rng[1]
+    elif val < rng[0]:
+        diff = rng[0] - val
+        sign = -1
+    else:
+        diff = 0
+    return ((diff / norm_width)**2) * sign
+
+def lab_range_bounds(norm_ranges):
+    """
+    Overview:
+        Converts the normal range table into aligned arrays for the vectorized severity transform.
+    Parameters:
+        norm_ranges: dict
+            lab/vital name -> [low, high], as returned by normal_lab_vital_ranges()
+    Returns:
+        labs: list of column names, lows: 1d array, highs: 1d array
+    """
+    labs = list(norm_ranges.keys())
+    bounds = np.array([norm_ranges[lab] for lab in labs], dtype=np.float64)
+    return labs, bounds[:, 0], bounds[:, 1]
+
+def lab_severity(values, lows, highs, out=None):
+    """
+    Overview:
+        Vectorized equivalent of lab_val_scale over a 2d block of lab/vital values (rows x labs).
+        Values above the normal range map to +((val - high) / width)**2, below to -((low - val) / width)**2 and in range to 0.
+        NaN maps to 0, matching lab_val_scale on float columns.  Results match lab_val_scale to floating point
+        tolerance, not bit for bit: numpy squares exactly where python's float pow can round the last bit differently,
+        so a small share of cells differ by one ulp (tests/test_transform_labs.py).
+    Parameters:
+        values: 2d array
+            Raw lab/vital values, one column per entry in lows/highs
+        lows, highs: 1d array
+            Normal range bounds aligned to the columns of values
+        out: 2d float array, optional
+            Destination for the result.  Passing values itself transforms the block in place.
+    Returns:
+        2d array of severity scores
+    """
+    values = np.asarray(values, dtype=np.float64)
+    width = highs - lows
+    over = np.fmax(values - highs, 0) / width
+    under = np.fmax(lows - values, 0) / width
+    np.square(over, out=over)
+    np.square(under, out=under)
+    return np.subtract(over, under, out=out)
+
+@timed()
+def transform_labs(df, norm_ranges, inplace=True):
+    """
+    Overview:
+        Applies the lab/vital severity transform to every column in norm_ranges in a single vectorized pass.  Matches
+        lab_val_scale applied per cell to floating point tolerance (see lab_severity).
+    Parameters:
+        df: dataframe
+            Data containing a column for each lab/vital in norm_ranges
+        norm_ranges: dict
+            lab/vital name -> [low, high]
+        inplace: bool
+            If True the columns of df are overwritten, otherwise a transformed copy is returned.
+    Returns:
+        dataframe with transformed lab/vital columns
+    """
+    labs, lows, highs = lab_range_bounds(norm_ranges)
+    if not inplace:
+        df = df.copy()
+    df[labs] = lab_severity(df[labs].to_numpy(dtype=np.float64, na_value=np.nan), lows, highs)
+    return df
+
+@timed(in_place=True)
+def month_transform(df, month_col):
+    """
+    """
+    shift, squish, stretch = 1, .5, 1.5
+    s = squish * np.sin((df[month_col].copy() + shift) * 2*np.pi/(12*stretch))
+    c = squish * np.cos((df[month_col].copy() + shift) * 2*np.pi/(12*stretch))
+    df['admit_month_transform'] = s*c
+    
+
+def one_hot_encoder(handle_unknown='error'):
+    """
+    Dense OneHotEncoder for the installed sklearn - the dense flag is sparse before 1.2 and sparse_output from 1.2 on.
+    """
+    import inspect
+    from sklearn.preprocessing import OneHotEncoder
+    dense = 'sparse_output' if 'sparse_output' in inspect.signature(OneHotEncoder).parameters else 'sparse'
+    return OneHotEncoder(handle_unknown=handle_unknown, **{dense: False})
+
+def hot_feature_names(enc):
+    """
+    Output column names of a fitted encoder in the x<i>_<category> form of sklearn's old get_feature_names, which the
+    saved models' feature columns use, whichever sklearn is installed.
+    """
+    if hasattr(enc, 'get_feature_names'):
+        return list(enc.get_feature_names())
+    return [f'x{i}_{category}' for i, categories in enumerate(enc.categories_) for category in categories]
+
+@timed(in_place=True)
+def hot_coding(df, data_cols, enc=None):
+    """
+    Overview:
+        One-hot encodes data_cols into new columns of df.  A fitted encoder is applied as is (no refit), otherwise one is fit to df.
+    Parameters:
+        df: dataframe
+        data_cols: list
+            Categorical columns to encode
+        enc: OneHotEncoder, optional
+            Previously fit encoder, e.g. from a saved FeaturePipeline
+    Returns:
+        the encoder used
+    """
+    if enc is None:
+        enc = one_hot_encoder()
+        hot_codes = enc.fit_transform(df[data_cols])
+    else:
+        hot_codes = enc.transform(df[data_cols])
+    hot_names = hot_feature_names(enc)
+    df[hot_names] = hot_codes
+    return enc
+
+@timed(in_place=True)
+def age_bands(df, age_col, band_width):
+    """
+    """
+    df['age_deci'] = (df[age_col] / band_width).astype('int')
+
+KEY_COLUMNS = ('subject_id', 'hadm_id', 'icustay_id', 'dos', 'stay_id')
+
+def key_codes(frames, key_cols):
+    """
+    Overview:
+        Integer codes for the key_cols tuples of several frames, shared across the frames and ordered like the sorted
+        keys, so rows of different sources can be matched by comparing one int64 per row.  Missing key values get
+        their own code and match each other, as they do in a pandas merge.
+    Parameters:
+        frames: list of dataframes
+            Each holding all of key_cols
+        key_cols: list
+    Returns:
+        list of 1d int64 arrays, one per frame
+    """
+    lengths = [len(df) for df in frames]
+    codes = np.zeros(sum(lengths), dtype=np.int64)
+    for col in key_cols:
+        col_codes, uniques = pd.factorize(np.concatenate([df[col].to_numpy() for df in frames]), sort=True)
+        codes *= len(uniques) + 1
+        codes += col_codes + 1
+    return np.split(codes, np.cumsum(lengths)[:-1])
+
+def align_rows(target_codes, source_codes):
+    """
+    Overview:
+        For each target key, the position of the first source row with the same key (-1 if there is none) -
+        a left join of target to source done with one sort of the source keys.
+    Parameters:
+        target_codes, source_codes: 1d int64 array
+            From key_codes
+    Returns:
+        1d intp array of source row positions
+    """
+    if len(source_codes) == 0:
+        return np.full(len(target_codes), -1, dtype=np.intp)
+    order = np.argsort(source_codes, kind='stable')
+    sorted_codes = source_codes[order]
+    pos = np.searchsorted(sorted_codes, target_codes)
+    np.minimum(pos, len(sorted_codes) - 1, out=pos)
+    return np.where(sorted_codes[pos] == target_codes, order[pos], -1)
+
+def assemble_features(admit_df, lab_frames, topics_df, merge_cols, drop_cols, norm_ranges, label_col='death_4_days', topic_fill=-1, block_rows=65536):
+    """
+    Overview:
+        Builds data_processing's feature frame without merges.  Every source is aligned to the admission rows on a
+        shared sorted key index and its columns are written straight into one preallocated float64 matrix, which the
+        returned frame wraps without copying; key and non-numeric columns are carried alongside as they are.  Column
+        layout is that of the old left-merge chain (admission, lab, vital then topic columns) except that a column
+        already taken from an earlier source is not repeated with a suffix.  Each admission row gets the first matching
+        row of each source; later lab frames (vitals) only fill rows the first one matched, as the lab-vital merge did.
+        Lab/vital columns in norm_ranges get the severity transform in place, block_rows rows at a time; admission rows
+        no lab/vital row matched are left NaN.
+    Parameters:
+        admit_df: dataframe
+            Featurized admission rows, one output row each
+        lab_frames: list of dataframes
+            Labs, then vitals if there are any
+        topics_df: dataframe
+            echoecg_topics output - missing topics are topic_fill
+        merge_cols: list
+            Key columns the sources are aligned on
+        drop_cols: iterable
+            Columns left out of the features
+        norm_ranges: dict
+            lab/vital name -> [low, high]
+    Returns:
+        X: dataframe with a RangeIndex, y: label series or None
+    """
+    n = len(admit_df)
+    with stage('align_keys', admit_df):
+        admit_codes, *codes = key_codes([admit_df] + lab_frames + [topics_df], merge_cols)
+        rows = [align_rows(admit_codes, source_codes) for source_codes in codes]
+        for later in rows[1:-1]:
+            later[rows[0] < 0] = -1
+
+    #layout: (column, source number, row positions) - source 0 is the admission frame itself
+    sources = [admit_df] + lab_frames + [topics_df]
+    skip = set(drop_cols) | {label_col}
+    seen = set(admit_df.columns) | set(merge_cols)
+    layout = [(col, 0, None) for col in admit_df.columns if col not in skip]
+    for i, (df, source_rows) in enumerate(zip(sources[1:], rows), 1):
+        for col in df.columns:
+            if col not in seen:
+                seen.add(col)
+                if col not in skip:
+                    layout.append((col, i, source_rows))
+    carried = set(KEY_COLUMNS) | set(merge_cols)
+    is_feature = [col not in carried and pd.api.types.is_numeric_dtype(sources[i][col].dtype) for col, i, _ in layout]
+    feature_layout = [entry for entry, feature in zip(layout, is_feature) if feature]
+
+    with stage('assemble_features', admit_df) as current:
+        matrix = np.empty((n, len(feature_layout)), dtype=np.float64, order='F')
+        for j, (col, i, source_rows) in enumerate(feature_layout):
+            values = sources[i][col].to_numpy(dtype=np.float64, na_value=np.nan)
+            if source_rows is None:
+                matrix[:, j] = values
+                continue
+            if len(values) == 0:
+                matrix[:, j] = np.nan
+            else:
+                np.take(values, source_rows, out=matrix[:, j], mode='clip')
+                matrix[source_rows < 0, j] = np.nan
+            if i == len(sources) - 1:
+                column = matrix[:, j]
+                np.copyto(column, topic_fill, where=np.isnan(column))
+
+        #severity transform on each contiguous run of lab/vital columns
+        ranged = [j for j, (col, i, _) in enumerate(feature_layout) if 0 < i < len(sources) - 1 and col in norm_ranges]
+        with stage('transform_labs', n):
+            for run in np.split(np.asarray(ranged, dtype=np.intp), np.flatnonzero(np.diff(ranged) != 1) + 1):
+                if len(run) == 0:
+                    continue
+                a, b = run[0], run[-1] + 1
+                lows = np.array([norm_ranges[feature_layout[j][0]][0] for j in run], dtype=np.float64)
+                highs = np.array([norm_ranges[feature_layout[j][0]][1] for j in run], dtype=np.float64)
+                for start in range(0, n, block_rows):
+                    block = matrix[start:start + block_rows, a:b]
+                    lab_severity(block, lows, highs, out=block)
+                #admissions without a lab/vital row stay NaN, as after the old merge - only missing values within a
+                #matched row score 0
+                for j in run:
+                    matrix[feature_layout[j][2] < 0, j] = np.nan
+
+        X = pd.DataFrame(matrix, columns=[col for col, _, _ in feature_layout], copy=False)
+        for loc, ((col, i, source_rows), feature) in enumerate(zip(layout, is_feature)):
+            if feature:
+                continue
+            if source_rows is None:
+                X.insert(loc, col, admit_df[col].array)
+            else:
+                X.insert(loc, col, sources[i][col].reset_index(drop=True).reindex(source_rows).array)
+        current.output(X)
+    y = pd.Series(admit_df[label_col].to_numpy(), name=label_col) if label_col in admit_df.columns else None
+    return X, y
+
+def admission_features(admit_df, month_col, cols_for_encoding, age_col, chronic_cols, encoder=None):
+    """
+    Overview:
+        Derives the admission feature columns (month transform, one-hot codes, age band, chronic count) on a shallow
+        copy of the admissions, so the caller's frame is left as it was.
+    Parameters:
+        admit_df: dataframe
+            Admission rows
+        month_col, cols_for_encoding, age_col, chronic_cols: list
+            Column references (see data_processing_column_refs)
+        encoder: OneHotEncoder, optional
+            Fitted encoder to apply - one is fit to admit_df if not given
+    Returns:
+        dataframe with the derived columns added, the encoder used
+    """
+    admits = admit_df.copy(deep=False)
+    month_transform(admits, month_col)
+    encoder = hot_coding(admits, cols_for_encoding, encoder)
+    age_bands(admits, age_col, 10)
+    admits['chronic'] = admits[chronic_cols].sum(axis=1)
+    return admits, encoder
+
+@timed(rows_in_arg=2, output=lambda result: result[0])
+def data_processing(labs_df, norm_ranges, admit_df, month_col, cols_for_encoding, age_col, chronic_cols, merge_cols, id_cols, vitals_df, echoecg_notes_df, encoder=None, lda_model=None, dictionary=None):
+    """
+    Overview:
+        Featurizes and combines admission, lab, vital and echo/ecg note data into model features and labels.
+        Passing a fitted encoder applies it instead of fitting one to this batch.  y is None if the admission data carries no label.
+        lda_model/dictionary are passed to echoecg_topics (default: the registry's saved topic model).
+        Sources are combined by assemble_features, one output row per admission row.  The input frames are not modified.
+    """
+    from mimic_text import echoecg_topics
+    admits, encoder = admission_features(admit_df, month_col, cols_for_encoding, age_col, chronic_cols, encoder)
+    echoecg_topics_df = echoecg_topics(echoecg_notes_df, lda_model=lda_model, dictionary=dictionary)
+    lab_frames = [labs_df] if vitals_df.empty else [labs_df, vitals_df]
+    drop_cols = list(cols_for_encoding) + list(month_col) + list(age_col) + list(id_cols) + list(chronic_cols)
+    return assemble_features(admits, lab_frames, echoecg_topics_df, list(merge_cols), drop_cols, norm_ranges)
+
+def align_to_model(X, model, drop_cols=()):
+    """
+    Overview:
+        Lines a feature frame up with the columns a classifier was trained on.  Models fit on dataframes carry
+        feature_names_in_ - missing columns (e.g. one-hot categories absent from a batch) are added as 0 and extras dropped.
+        Otherwise only the listed non-feature columns are dropped.
+    Parameters:
+        X: dataframe
+            Feature data
+        model: obj
+            Fit sklearn classifier
+        drop_cols: iterable
+            Id/helper columns to remove when the model does not record its training columns
+    Returns:
+        dataframe
+    """
+    if hasattr(model, 'feature_names_in_'):
+        return X.reindex(columns=model.feature_names_in_, fill_value=0)
+    return X.drop([col for col in drop_cols if col in X.columns], axis=1)
+
+def data_processing_stream(admit_df, labs_chunks, vitals_chunks, echoecg_chunks, norm_ranges, month_col, cols_for_encoding, age_col, chronic_cols, merge_cols, id_cols, admits_per_chunk=50000, key_cols=('subject_id', 'hadm_id'), note_group_cols=None, model=None, pipeline=None, encoder=None):
+    """
+    Overview:
+        Generator version of data_processing for extractions too large to hold at once.  Admissions are processed in
+        blocks; for each block only the lab, vital and note rows up to the block's last (subject_id, hadm_id) are pulled
+        from the key-ordered chunk streams, featurized and (optionally) scored before the next block is fetched.
+    Parameters:
+        admit_df: dataframe
+            Patient/admission data (small enough to hold in memory)
+        labs_chunks, vitals_chunks, echoecg_chunks: iterables of dataframes
+            Key-ordered chunk streams, e.g. from data_extraction_chunks.  vitals_chunks may be None.
+        norm_ranges ... id_cols:
+            As for data_processing
+        admits_per_chunk: int
+            Approximate number of admission rows per block (blocks are extended so a key is never split)
+        key_cols: iterable
+            Id columns the streams are ordered by
+        note_group_cols: list, optional
+            If given, note rows are cleaned and concatenated per group (as build_x_y does) before topic mapping
+        model: obj, optional
+            Fit classifier - if given, each block's features are aligned to the model's training columns and scored
+        pipeline: FeaturePipeline, optional
+            Fitted feature pipeline - if given, every block is featurized with it into the training column layout
+        encoder: OneHotEncoder, optional
+            Fitted encoder applied to every block when there is no pipeline.  If neither is given one encoder is fit to
+            all of admit_df up front, so every block is coded with the same categories.
+    Returns:
+        generator of (X, y) per block, or (X, y, risk) if a model is given
+    """
+    key_cols = list(key_cols)
+    admit_df = admit_df.sort_values(key_cols, kind='mergesort').reset_index(drop=True)
+    admit_keys = stream_key(admit_df, key_cols)
+    if pipeline is None and encoder is None:
+        encoder = one_hot_encoder(handle_unknown='ignore').fit(admit_df[cols_for_encoding])
+    labs_stream = KeyAlignedStream(labs_chunks, key_cols)
+    vitals_stream = KeyAlignedStream(vitals_chunks, key_cols)
+    #the note columns used below, for a stream that ends before producing a chunk
+    notes_stream = KeyAlignedStream(echoecg_chunks, key_cols,
+                                    columns=list(dict.fromkeys(key_cols + list(note_group_cols or merge_cols) + ['echo_ecg'])))
+    start = 0
+    while start < len(admit_df):
+        end = min(start + admits_per_chunk, len(admit_df))
+        end = np.searchsorted(admit_keys, admit_keys[end - 1], side='right')
+        max_key = admit_keys[end - 1]
+        admits = admit_df.iloc[start:end].copy()
+        labs = labs_stream.take_through(max_key)
+        vitals = vitals_stream.take_through(max_key)
+        notes = notes_stream.take_through(max_key)
+        if note_group_cols is not None:
+            notes = notes.dropna(axis=0)
+            notes = notes[note_group_cols + ['echo_ecg']].groupby(note_group_cols).sum().reset_index()
+        if pipeline is not None:
+            features, y, _ = pipeline.transform(labs, admits, vitals, notes, merge_cols, id_cols)
+            X = pd.DataFrame(features, columns=pipeline.columns)
+        else:
+            X, y = data_processing(labs, norm_ranges, admits, month_col, cols_for_encoding, age_col, chronic_cols,
+                                   merge_cols, id_cols, vitals, notes, encoder=encoder)
+        if model is None:
+            yield X, y
+        else:
+            X = align_to_model(X, model)
+            with stage('predict', X) as current:
+                risk = current.output(model.predict_proba(X)[:, 1])
+            yield X, y, risk
+        start = end
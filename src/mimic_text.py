@@ -0,0 +1,119 @@
+#the basics
+import numpy as np
+import pandas as pd
+
+#connection and file tools
+import os
+from itertools import chain
+from model_registry import registry, LDA_MODEL_PATH
+from pipeline_metrics import timed
+#gensim, scipy and the nltk-based tokenizer are imported on first use
+
+
+def topic_dictionary_path(model_path):
+    """
+    Location of the training dictionary build_lda_model writes alongside a model: <model>_dictionary.pickle.
+    """
+    root, ext = os.path.splitext(model_path)
+    return root + '_dictionary' + ext
+
+def load_topic_dictionary(lda_model, dictionary_path=None):
+    """
+    Overview:
+        Returns the dictionary the LDA model was trained with - the persisted copy at dictionary_path if given and
+        present, otherwise the id2word the model carries.
+    Parameters:
+        lda_model: obj
+            Fit gensim LDA model
+        dictionary_path: str, optional
+            Location of the model's pickled training dictionary (see topic_dictionary_path)
+    Returns:
+        gensim Dictionary
+    """
+    if dictionary_path is not None and os.path.exists(dictionary_path):
+        return registry.get(dictionary_path)
+    return lda_model.id2word
+
+def docs_to_bow(processed_docs, token2id, num_terms):
+    """
+    Overview:
+        Vectorized doc2bow against a fixed vocabulary.  All tokens are looked up in one pass, counts are accumulated
+        in a sparse term x document matrix and tokens missing from the vocabulary are dropped, as doc2bow does.
+    Parameters:
+        processed_docs: series or list
+            Token lists, one per document
+        token2id: dict
+            Vocabulary hash index (token -> id) of the training dictionary
+        num_terms: int
+            Vocabulary size
+    Returns:
+        gensim streamed corpus with one bag-of-words per document, in input order
+    """
+    import gensim
+    from scipy import sparse
+    lengths = np.fromiter((len(doc) for doc in processed_docs), dtype=np.int64, count=len(processed_docs))
+    doc_idx = np.repeat(np.arange(len(lengths)), lengths)
+    ids = pd.Series(list(chain.from_iterable(processed_docs)), dtype=object).map(token2id).to_numpy()
+    known = pd.notna(ids)
+    counts = sparse.csc_matrix((np.ones(known.sum()), (ids[known].astype(np.int64), doc_idx[known])),
+                               shape=(num_terms, len(lengths)))
+    counts.sum_duplicates()
+    return gensim.matutils.Sparse2Corpus(counts, documents_columns=True)
+
+@timed()
+def echoecg_topics(eenotes_df, lda_model=None, model_path=LDA_MODEL_PATH, dictionary=None, dictionary_path=None, processes=1):
+    """
+    Overview:
+        Maps each echo/ecg document to its two most likely LDA topics.
+    Parameters:
+        eenotes_df: dataframe
+            Id columns plus the 'echo_ecg' text column
+        lda_model: obj, optional
+            Fit gensim LDA model.  If not provided the model at model_path is served from the process-wide model registry,
+            so it is only unpickled once per process (and again only if the file changes).
+        model_path: str
+            Location of the pickled LDA model
+        dictionary: gensim Dictionary, optional
+            Training dictionary of the model.  If not provided it is loaded via load_topic_dictionary.
+        dictionary_path: str, optional
+            Location of the pickled training dictionary.  Defaults to the one saved alongside model_path when the model
+            is loaded from there; a model passed in uses its own id2word.
+        processes: int
+            Worker processes used for tokenizing the notes (see note_tokenizer.preprocess_corpus)
+    Returns:
+        dataframe of id columns with 'top1' and 'top2' topic columns
+    """
+    import gensim
+    from note_tokenizer import preprocess_corpus
+    if eenotes_df.empty:
+        return eenotes_df.drop('echo_ecg', axis=1).assign(top1=pd.Series(dtype='int64'), top2=pd.Series(dtype='int64'))
+    if eenotes_df.shape[0] == 1 and eenotes_df['echo_ecg'].isnull().values.any():
+        ecgecho_topics = eenotes_df.copy()
+        ecgecho_topics['top1'] = -1
+        ecgecho_topics['top2'] = -1
+        ecgecho_topics.drop('echo_ecg', axis=1, inplace=True)
+        return ecgecho_topics
+    if lda_model is None:
+        lda_model = registry.get(model_path)
+        if dictionary_path is None:
+            dictionary_path = topic_dictionary_path(model_path)
+    if dictionary is None:
+        dictionary = load_topic_dictionary(lda_model, dictionary_path)
+
+    #lem, stem and create lists of tokens for each chart record, creating DF of these for each row provided.
+    processed_docs = preprocess_corpus(eenotes_df['echo_ecg'], processes=processes)
+
+    #Term Document Frequency against the vocabulary the model was trained on, so token ids line up with the model.
+    bow_corpus = docs_to_bow(processed_docs, dictionary.token2id, len(dictionary))
+    
+    mapping = lda_model.get_document_topics(bow_corpus)
+    map_csr = gensim.matutils.corpus2csc(mapping, num_terms=lda_model.num_topics, num_docs=len(eenotes_df))
+    map_np = map_csr.T.toarray()
+    #row-wise argsort on the array - np.argsort no longer hands a DataFrame back for a DataFrame.  Topic rows are in
+    #document order, so they take the notes' own index labels (which need not be a RangeIndex) for the merge.
+    order = np.argsort(map_np, axis=1)
+    toptopics = pd.DataFrame({'top2': order[:, -2], 'top1': order[:, -1]}, index=eenotes_df.index)
+    #print(toptopics)
+    ecgecho_topics = eenotes_df.merge(toptopics,how='inner',left_index=True, right_index=True)
+    ecgecho_topics.drop('echo_ecg', axis=1, inplace=True)
+    return ecgecho_topics
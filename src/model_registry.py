@@ -0,0 +1,121 @@
+import os
+import pickle
+import threading
+import time
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+LDA_MODEL_PATH = os.path.join(SRC_DIR, 'lda_echo_ecg_model.pickle')
+#build_lda_model saves the training dictionary next to the model as <model>_dictionary.pickle
+LDA_DICTIONARY_PATH = os.path.join(SRC_DIR, 'lda_echo_ecg_model_dictionary.pickle')
+LDA_STATE_PATH = os.path.join(SRC_DIR, 'lda_echo_ecg_model_state.json')
+RF_MODEL_PATH = os.path.join(SRC_DIR, 'icu_model_rf.pickle')
+RF_FLAT_PATH = os.path.join(SRC_DIR, 'icu_model_rf_flat')
+LR_MODEL_PATH = os.path.join(SRC_DIR, 'icu_model_lr.pickle')
+RF_FEATURES_PATH = os.path.join(SRC_DIR, 'icu_model_rf_features.pickle')
+LR_FEATURES_PATH = os.path.join(SRC_DIR, 'icu_model_lr_features.pickle')
+
+
+def load_pickle(path):
+    """
+    Overview:
+        Plain unpickling of a model file - the default loader used by the registry.
+    Parameters:
+        path: str
+            Location of the pickle file
+    Returns:
+        unpickled object
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def load_model(path):
+    """
+    Overview:
+        Default loader used by the registry: a directory is a flat forest export (see forest_export.py) and is
+        memory-mapped, anything else is unpickled.
+    Parameters:
+        path: str
+            Location of the model file or flat forest directory
+    Returns:
+        loaded object
+    """
+    if os.path.isdir(path):
+        from forest_export import load_flat_forest
+        return load_flat_forest(path)
+    return load_pickle(path)
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of fitted model files (LDA topic model, RF/LR classifiers, dictionaries).
+    Each file is loaded lazily on first request and then served from memory.  The file's
+    modification time is checked on every request so a re-trained model dropped in place is picked up.
+    Counters for hits, misses, loads and cumulative load time are kept in stats.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'loads': 0, 'reloads': 0, 'load_seconds': 0.0}
+
+    def get(self, path, loader=load_model):
+        """
+        Overview:
+            Returns the object stored at path, loading it only if it is not cached or the file has changed.
+        Parameters:
+            path: str
+                Location of the model file
+            loader: callable
+                Function taking the path and returning the loaded object.  Defaults to load_model.
+        Returns:
+            loaded object
+        """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+            start = time.perf_counter()
+            obj = loader(path)
+            self.stats['load_seconds'] += time.perf_counter() - start
+            self.stats['loads'] += 1
+            if entry is not None:
+                self.stats['reloads'] += 1
+            self._entries[path] = (mtime, obj)
+            return obj
+
+    def preload(self, *paths):
+        """
+        Loads each of the given model files so the first scoring call does not pay for it.
+        """
+        for path in paths:
+            self.get(path)
+
+    def evict(self, path=None):
+        """
+        Drops a single cached file, or everything if no path is given.
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(path), None)
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self.stats:
+                self.stats[key] = 0.0 if key == 'load_seconds' else 0
+
+
+registry = ModelRegistry()
+
+
+def get_model(path):
+    """
+    Convenience accessor for the shared process-wide registry.
+    """
+    return registry.get(path)
@@ -0,0 +1,236 @@
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from icu_mortality_model import build_x_y, make_model, save_model
+
+
+#Hyperparameter search for the ICU mortality models.  The training data is extracted and featurized once (build_x_y,
+#through the extraction cache), written to .npy files and memory-mapped by every worker, so the feature matrix is
+#never pickled to the pool.  Each (candidate, fold) pair is one pool task; the per-fold fit/score times and metrics
+#are averaged into a leaderboard and the best candidate is refit on all the data and saved like build_icu_model does.
+#   python model_search.py --model rf                     grid search over RF_SPACE
+#   python model_search.py --model rf --random 20         20 random candidates from the same space
+
+RF_SPACE = {'max_depth': [6, 9, 12], 'n_estimators': [100, 250, 500], 'max_features': ['sqrt', 0.3],
+            'min_samples_leaf': [1, 5]}
+LR_SPACE = {'C': [0.01, 0.1, 1.0, 10.0], 'penalty': ['l1', 'l2'], 'class_weight': [None, 'balanced']}
+SPACES = {'rf': RF_SPACE, 'lr': LR_SPACE}
+METRICS = ['auc', 'score', 'precision', 'recall', 'fit_s', 'score_s']
+
+
+def candidates(space, n_random=None, seed=18):
+    """
+    Overview:
+        Candidate parameter sets from a search space - every combination, or n_random sampled combinations.
+    Parameters:
+        space: dict
+            Parameter name -> list of values
+        n_random: int, optional
+            Number of random candidates; all combinations if None
+        seed: int
+    Returns:
+        list of dict
+    """
+    from sklearn.model_selection import ParameterGrid, ParameterSampler
+    if n_random is None:
+        return list(ParameterGrid(space))
+    return list(ParameterSampler(space, n_random, random_state=seed))
+
+def share_arrays(X, y, directory):
+    """
+    Writes the features (float32) and labels to .npy files workers can memory-map.  Returns the two paths.
+    """
+    x_path = os.path.join(directory, 'X.npy')
+    y_path = os.path.join(directory, 'y.npy')
+    np.save(x_path, np.ascontiguousarray(X, dtype=np.float32))
+    np.save(y_path, np.asarray(y).ravel())
+    return x_path, y_path
+
+
+_shared = {}
+
+def init_worker(x_path, y_path):
+    """
+    Process pool initializer - memory-maps the shared feature matrix and labels once per worker.
+    """
+    _shared['X'] = np.load(x_path, mmap_mode='r')
+    _shared['y'] = np.load(y_path, mmap_mode='r')
+
+def evaluate_fold(model_type, params, train_idx, test_idx):
+    """
+    Overview:
+        Fits one candidate on one fold's training rows and scores it on the fold's test rows with produce_results,
+        plus AUC from predict_proba.  Runs in a pool worker (see init_worker).
+    Parameters:
+        model_type: str
+            'lr' or 'rf'
+        params: dict
+            Candidate estimator parameters
+        train_idx, test_idx: array of int
+            Row indices of the fold
+    Returns:
+        dict of metrics and timings
+    """
+    from sklearn.metrics import roc_auc_score
+    from mimic_fxns import produce_results
+    X, y = _shared['X'], _shared['y']
+    #one process per task already, so the forest itself runs single threaded
+    model = make_model(model_type, {**params, 'n_jobs': 1} if model_type == 'rf' else params)
+    start = time.perf_counter()
+    model.fit(X[train_idx], y[train_idx])
+    fit_s = time.perf_counter() - start
+    X_test, y_test = X[test_idx], y[test_idx]
+    start = time.perf_counter()
+    score, precision, recall = produce_results(model, X_test, y_test, pprint=False)
+    auc = roc_auc_score(y_test, model.predict_proba(X_test)[:, 1])
+    score_s = time.perf_counter() - start
+    return {'auc': auc, 'score': score, 'precision': precision, 'recall': recall, 'fit_s': fit_s, 'score_s': score_s}
+
+def leaderboard(params_list, fold_results):
+    """
+    Overview:
+        Averages the per-fold results of each candidate into a leaderboard ordered by mean AUC.
+    Parameters:
+        params_list: list of dict
+            Candidates, by candidate number
+        fold_results: list of (candidate number, fold, metrics dict)
+    Returns:
+        dataframe with one row per candidate: its parameters, mean and std of each metric and the folds completed
+    """
+    folds = pd.DataFrame([{'candidate': c, 'fold': f, **m} for c, f, m in fold_results])
+    board = folds.groupby('candidate')[METRICS].agg(['mean', 'std'])
+    board.columns = [f'{metric}_{stat}' for metric, stat in board.columns]
+    board['folds'] = folds.groupby('candidate').size()
+    board['params'] = [params_list[c] for c in board.index]
+    board = board.sort_values('auc_mean', ascending=False).reset_index()
+    return board[['candidate', 'params', 'folds'] + [col for col in board.columns if col.endswith(('_mean', '_std'))]]
+
+def search(X, y, model_type='rf', params_list=None, n_folds=5, workers=None, seed=18):
+    """
+    Overview:
+        Cross-validates every candidate across a process pool that shares X and y through memory-mapped files.
+    Parameters:
+        X: 2d array-like
+            Features
+        y: 1d array-like
+            Labels
+        model_type: str
+            'lr' or 'rf'
+        params_list: list of dict, optional
+            Candidates, defaults to the full grid of the model type's search space
+        n_folds: int
+            Stratified cross-validation folds
+        workers: int, optional
+            Worker processes, defaults to the CPU count
+        seed: int
+            Fold shuffling seed
+    Returns:
+        leaderboard dataframe (see leaderboard)
+    """
+    from sklearn.model_selection import StratifiedKFold
+    if params_list is None:
+        params_list = candidates(SPACES[model_type])
+    if workers is None:
+        workers = os.cpu_count()
+    y = np.asarray(y).ravel()
+    folds = list(StratifiedKFold(n_folds, shuffle=True, random_state=seed).split(np.zeros(len(y)), y))
+    print(f'{len(params_list)} candidates x {n_folds} folds on {workers} workers')
+    share_dir = tempfile.mkdtemp(prefix='icu_model_search_')
+    results = []
+    try:
+        x_path, y_path = share_arrays(X, y, share_dir)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(x_path, y_path)) as pool:
+            futures = {pool.submit(evaluate_fold, model_type, params, train_idx, test_idx): (c, f)
+                       for c, params in enumerate(params_list) for f, (train_idx, test_idx) in enumerate(folds)}
+            for done, future in enumerate(as_completed(futures), 1):
+                c, f = futures[future]
+                try:
+                    metrics = future.result()
+                except Exception as error:
+                    print(f'Candidate {c} {params_list[c]} fold {f} failed: {error}')
+                    continue
+                results.append((c, f, metrics))
+                print(f'[{done}/{len(futures)}] candidate {c} fold {f}: auc {metrics["auc"]:.4f} fit {metrics["fit_s"]:.1f} s')
+    finally:
+        shutil.rmtree(share_dir, ignore_errors=True)
+    if not results:
+        print('No candidate completed.')
+        return None
+    return leaderboard(params_list, results)
+
+def refit(model_type, params, X, y):
+    """
+    Overview:
+        Fits a candidate on all the data, as the same float32 values the folds were scored on.  A dataframe keeps its
+        columns, so the model records feature_names_in_ and scoring can line features up with it (align_to_model).
+    Parameters:
+        model_type: str
+            'lr' or 'rf'
+        params: dict
+            Candidate estimator parameters
+        X: dataframe or 2d array-like
+            Features
+        y: 1d array-like
+            Labels
+    Returns:
+        fit model
+    """
+    cm = make_model(model_type, params)
+    X = X.astype(np.float32) if isinstance(X, pd.DataFrame) else np.ascontiguousarray(X, dtype=np.float32)
+    cm.fit(X, np.asarray(y).ravel())
+    return cm
+
+def run_search(model_type='rf', n_random=None, n_folds=5, workers=None, out='icu_model_search', cache='default', refresh=False):
+    """
+    Overview:
+        Extracts and featurizes the training data once, cross-validates the candidates, writes the leaderboard to
+        <out>_<model_type>_leaderboard.csv and refits the best candidate on all the data, saved as <out>_<model_type>.pickle
+        (with its feature pipeline, see save_model).
+    Parameters:
+        model_type: str
+            'lr' or 'rf'
+        n_random: int, optional
+            Number of random candidates instead of the full grid
+        n_folds: int
+            Cross-validation folds
+        workers: int, optional
+            Worker processes
+        out: str
+            Output file prefix
+        cache, refresh:
+            Extraction cache settings, passed to build_x_y
+    Returns:
+        leaderboard dataframe, best fit model
+    """
+    X, y, pipeline = build_x_y(cache=cache, refresh=refresh, return_pipeline=True)
+    board = search(X, y, model_type, candidates(SPACES[model_type], n_random), n_folds, workers)
+    if board is None:
+        return None, None
+    board.to_csv(f'{out}_{model_type}_leaderboard.csv', index=False)
+    print(board.head(10).to_string())
+    best = board.loc[0, 'params']
+    print(f'Refitting best candidate {best} on all {X.shape[0]} rows...')
+    cm = refit(model_type, best, X, y)
+    save_model(cm, pipeline, model_type, out)
+    return board, cm
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cross-validated hyperparameter search for the ICU mortality model')
+    parser.add_argument('--model', default='rf', choices=['rf', 'lr'])
+    parser.add_argument('--random', type=int, default=None, help='number of random candidates instead of the full grid')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default='icu_model_search', help='prefix for the leaderboard and best model files')
+    parser.add_argument('--refresh', action='store_true', help='re-run extraction queries instead of using cached results')
+    args = parser.parse_args()
+    run_search(args.model, args.random, args.folds, args.workers, args.out, refresh=args.refresh)
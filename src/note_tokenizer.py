@@ -0,0 +1,153 @@
+#gensim
+from gensim.utils import simple_preprocess
+from gensim.parsing.preprocessing import STOPWORDS
+
+#nltk
+from nltk.stem import WordNetLemmatizer, SnowballStemmer
+
+from functools import lru_cache
+import multiprocessing
+import os
+import time
+import argparse
+
+
+#Shared tokenizer for chart notes, used by LDA model training and topic scoring.
+#The lemmatizer/stemmer are built once per process and token -> stem results are cached, since
+#echo/ecg notes repeat the same clinical vocabulary over and over.
+TOKEN_CACHE_SIZE = 2**18
+STEM_ONLY_ENV = 'MIMIC_STEM_ONLY'
+
+
+def load_lemmatizer(stem_only=None):
+    '''
+    Overview:
+        WordNet lemmatizer, checked against the nltk wordnet data (nltk.download('wordnet')).  Tokens are only stemmed
+        when stem-only is asked for explicitly, since a topic model trained on lemmatized tokens should not be scored
+        with stemmed ones.
+    Parameters:
+        stem_only: bool, optional
+            Skip the lemmatizer.  None reads the MIMIC_STEM_ONLY env var (set by use_stem_only, and inherited by pool workers).
+    Returns:
+        WordNetLemmatizer, or None when stem-only
+    Raises:
+        LookupError if the wordnet data is missing
+    '''
+    if stem_only is None:
+        stem_only = os.environ.get(STEM_ONLY_ENV, '0') not in ('', '0')
+    if stem_only:
+        return None
+    lemmatizer = WordNetLemmatizer()
+    try:
+        lemmatizer.lemmatize('notes', pos='v')
+    except LookupError as e:
+        raise LookupError(f"nltk wordnet data not found - run nltk.download('wordnet'), or set {STEM_ONLY_ENV}=1 to "
+                          "stem note tokens without lemmatizing") from e
+    return lemmatizer
+
+def use_stem_only():
+    '''
+    Stems note tokens without lemmatizing in this process and any pool workers it starts (e.g. for benchmarks without the wordnet data).
+    '''
+    global lemmatizer
+    os.environ[STEM_ONLY_ENV] = '1'
+    lemmatizer = None
+    lemmatize_stemming.cache_clear()
+
+#loaded on the first token, so importing the module never needs the wordnet data
+lemmatizer = UNLOADED = object()
+stemmer = SnowballStemmer('english')
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def lemmatize_stemming(token):
+    '''
+    Lemmatizes (as a verb, unless stem-only) then stems a single token.  Results are memoized in a bounded LRU cache.
+    '''
+    global lemmatizer
+    if lemmatizer is UNLOADED:
+        lemmatizer = load_lemmatizer()
+    if lemmatizer is None:
+        return stemmer.stem(token)
+    return stemmer.stem(lemmatizer.lemmatize(token, pos='v'))
+
+def preprocess(text):
+    '''
+    Overview:
+        Tokenizes a note, drops stopwords and short tokens and returns the lemmatized/stemmed tokens.
+    Parameters:
+        text: str
+            Raw note text
+    Returns:
+        list of tokens
+    '''
+    return [lemmatize_stemming(token) for token in simple_preprocess(text)
+            if token not in STOPWORDS and len(token) > 3]
+
+def preprocess_corpus(texts, processes=1, chunksize=256):
+    '''
+    Overview:
+        Runs preprocess over a collection of notes, optionally fanned out over a multiprocessing pool in chunks.
+    Parameters:
+        texts: iterable of str
+            Raw note texts
+        processes: int
+            Number of worker processes.  1 runs in-process; None uses every available core.
+        chunksize: int
+            Number of notes handed to a worker at a time.  Corpora smaller than one chunk are always run in-process.
+    Returns:
+        list of token lists, in input order
+    '''
+    texts = list(texts)
+    if processes == 1 or len(texts) <= chunksize:
+        return [preprocess(text) for text in texts]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(preprocess, texts, chunksize=chunksize)
+
+def cache_info():
+    '''
+    Hit/miss counts and current size of the token -> stem cache in this process.
+    '''
+    return lemmatize_stemming.cache_info()
+
+def benchmark_throughput(texts, processes=(1,), chunksize=256, repeat=2):
+    '''
+    Overview:
+        Measures tokenizer throughput in documents per second.  The first pass of each configuration runs against a cold
+        token cache, later passes against a warm one (in-process runs only - pool workers always start cold).
+    Parameters:
+        texts: list of str
+            Notes to tokenize
+        processes: iterable of int
+            Worker counts to benchmark
+        chunksize: int
+            Chunk size handed to pool workers
+        repeat: int
+            Number of passes per configuration
+    Returns:
+        list of dicts with processes, pass number, seconds and docs_per_sec
+    '''
+    results = []
+    for n in processes:
+        lemmatize_stemming.cache_clear()
+        for rep in range(repeat):
+            start = time.perf_counter()
+            preprocess_corpus(texts, processes=n, chunksize=chunksize)
+            elapsed = time.perf_counter() - start
+            results.append({'processes': n, 'pass': rep + 1, 'seconds': elapsed, 'docs_per_sec': len(texts) / elapsed})
+            print(f'processes={n} pass={rep + 1}: {len(texts) / elapsed:,.0f} docs/sec')
+    return results
+
+
+if __name__ == '__main__':
+    #Throughput benchmark against a note extraction query, e.g. python note_tokenizer.py --sql train_echo_ecg_notes.sql --processes 1 4
+    from mimic_fxns import pooled_connection, data_extraction
+    parser = argparse.ArgumentParser(description='Note tokenizer throughput benchmark (docs/sec)')
+    parser.add_argument('--sql', default='train_echo_ecg_notes.sql')
+    parser.add_argument('--col', default='echo_ecg')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, multiprocessing.cpu_count()])
+    parser.add_argument('--chunksize', type=int, default=256)
+    args = parser.parse_args()
+    with pooled_connection() as conn:
+        notes = data_extraction(args.sql, conn)
+    benchmark_throughput(notes[args.col].dropna().tolist(), args.processes, args.chunksize)
@@ -0,0 +1,243 @@
+import os
+import gc
+import sys
+import json
+import time
+import resource
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from synthetic_mimic import synthetic_mimic, stays_for_patient_days, VITAL_COLS
+from mimic_features import (normal_lab_vital_ranges, data_processing_column_refs, transform_labs, hot_coding,
+                            data_processing, KEY_COLUMNS)
+from daily_grid import prepare_bulk_frames, build_daily_grid, daily_model_inputs
+from model_registry import LDA_MODEL_PATH
+from pipeline_metrics import metrics
+
+
+#End-to-end benchmark of the scoring pipeline stages on synthetic MIMIC-shaped data (synthetic_mimic.py) at several
+#sizes, measured in patient-days.  Each stage is timed, then (unless --no-memory) run again under tracemalloc for its
+#peak allocation; the process high-water RSS after each stage is recorded too.  Results are written to JSON with the
+#commit and library versions, and --compare prints the time ratio per stage against an earlier results file.
+#A stage that fails (e.g. a library version the code does not support) is recorded with its error and the stages
+#depending on it are skipped.  Without a saved LDA model a small one is fit to the synthetic notes, and without the
+#nltk wordnet data the benchmark opts in to stemming the notes only (note_tokenizer.use_stem_only), so no downloads
+#are needed - the tokenizer itself raises without the data.
+#   python pipeline_benchmark.py                                  10k, 100k and 1M patient-days
+#   python pipeline_benchmark.py --sizes 10000 --out new.json --compare old.json
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEPENDS = {'fit': 'data_processing', 'predict_proba': 'fit'}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def library_versions():
+    versions = {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__}
+    for name in ('sklearn', 'gensim', 'nltk'):
+        try:
+            versions[name] = __import__(name).__version__
+        except ImportError:
+            versions[name] = None
+    return versions
+
+def max_rss_mb():
+    #ru_maxrss is in KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def error_text(error):
+    """
+    The error's type and the first line of its message, for the results file.
+    """
+    lines = [line.strip() for line in str(error).splitlines() if line.strip(' *')]
+    return f'{type(error).__name__}: {lines[0] if lines else ""}'
+
+def measure(fn, setup=None, memory=True):
+    """
+    Overview:
+        Times one call of fn(*setup()) and, if memory is set, repeats it under tracemalloc for the peak allocation.
+        setup builds fresh inputs for each call (stages that modify their input in place) and is not timed.
+    Returns:
+        fn's result, dict of seconds, peak_traced_mb and max_rss_mb
+    """
+    args = setup() if setup is not None else ()
+    gc.collect()
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        args = setup() if setup is not None else ()
+        gc.collect()
+        tracemalloc.start()
+        fn(*args)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, {'seconds': round(seconds, 4), 'peak_traced_mb': None if peak is None else round(peak, 1),
+                    'max_rss_mb': round(max_rss_mb(), 1)}
+
+def topic_model(notes, max_docs=2000, num_topics=10):
+    """
+    Overview:
+        The saved LDA model if there is one, otherwise a small model fit to a sample of the synthetic notes.
+    Returns:
+        lda model, dictionary (None for the saved model - echoecg_topics loads its own), description
+    """
+    if os.path.exists(LDA_MODEL_PATH):
+        from model_registry import registry
+        return registry.get(LDA_MODEL_PATH), None, 'saved'
+    import gensim
+    from note_tokenizer import preprocess_corpus
+    docs = preprocess_corpus(notes['echo_ecg'].dropna().iloc[:max_docs])
+    dictionary = gensim.corpora.Dictionary(docs)
+    corpus = [dictionary.doc2bow(doc) for doc in docs]
+    lda = gensim.models.LdaModel(corpus, num_topics=num_topics, id2word=dictionary, passes=1, random_state=18)
+    return lda, dictionary, f'fit to {len(docs)} synthetic notes'
+
+def benchmark_size(patient_days, memory=True, rf_params=None, seed=18):
+    """
+    Overview:
+        Generates synthetic data for about patient_days ICU days and measures every stage on it.
+    Parameters:
+        patient_days: int
+            Target number of daily rows
+        memory: bool
+            If True each stage is also run under tracemalloc
+        rf_params: dict, optional
+            Overrides of the production random forest settings for the fit stage
+        seed: int
+    Returns:
+        list of result dicts, one per stage
+    """
+    norm_ranges = normal_lab_vital_ranges()
+    id_cols, month_col, age_col, encoding_cols, chronic_cols, merge_cols = data_processing_column_refs()
+    n_stays = stays_for_patient_days(patient_days)
+    print(f'--- {patient_days} patient-days ({n_stays} stays)')
+    frames = synthetic_mimic(n_stays, 'bulk', seed)
+    raw_cols = {name: list(frame.columns) for name, frame in frames.items()}
+    pt_admit, pt_labs, pt_vitals, pt_ee_docs = prepare_bulk_frames(frames['admits'], frames['labs'], frames['vitals'],
+                                                                   frames['notes'], id_cols)
+    results = []
+    state = {}
+
+    def record(stage, rows_in, run, setup=None, rows_out=len):
+        dependency = DEPENDS.get(stage)
+        entry = {'patient_days': patient_days, 'stays': n_stays, 'stage': stage, 'rows_in': int(rows_in)}
+        if dependency is not None and dependency not in state:
+            entry['error'] = f'skipped: {dependency} did not complete'
+        else:
+            try:
+                result, stats = measure(run, setup, memory)
+                state[stage] = result
+                entry.update(stats, rows_out=int(rows_out(result)))
+            except Exception as error:
+                entry['error'] = error_text(error)
+        results.append(entry)
+        status = entry.get('error') or f'{entry["seconds"]:.3f} s, peak {entry["peak_traced_mb"]} MB'
+        print(f'{stage:<16} {status}')
+
+    record('daily_grid', pt_admit.shape[0], lambda: build_daily_grid(pt_admit, pt_labs, pt_vitals, pt_ee_docs))
+    if 'daily_grid' not in state:
+        return results
+    daily_df = state['daily_grid']
+    labs, admits, vitals, echoecg = daily_model_inputs(daily_df, raw_cols['admits'], raw_cols['labs'],
+                                                       raw_cols['vitals'], raw_cols['notes'])
+    record('transform_labs', labs.shape[0], lambda df: transform_labs(df, norm_ranges),
+           setup=lambda: (pd.concat([labs, vitals[VITAL_COLS]], axis=1),))
+    record('hot_coding', admits.shape[0], lambda df: (hot_coding(df, encoding_cols), df)[1], setup=lambda: (admits.copy(),))
+
+    try:
+        lda, dictionary, source = topic_model(frames['notes'])
+        print(f'topic model: {source}')
+    except Exception as error:
+        lda = dictionary = None
+        source = error_text(error)
+    topics_error = None if lda is not None else f'topic model unavailable - {source}'
+    if topics_error is None:
+        from mimic_text import echoecg_topics
+        record('echoecg_topics', echoecg.shape[0], lambda df: echoecg_topics(df, lda_model=lda, dictionary=dictionary),
+               setup=lambda: (echoecg.copy(),))
+        record('data_processing', admits.shape[0],
+               lambda l, a, v, e: data_processing(l, norm_ranges, a, month_col, encoding_cols, age_col, chronic_cols,
+                                                  merge_cols + ['dos'], [], v, e, lda_model=lda, dictionary=dictionary),
+               setup=lambda: (labs.copy(), admits.copy(), vitals.copy(), echoecg.copy()), rows_out=lambda r: len(r[0]))
+    else:
+        for stage in ('echoecg_topics', 'data_processing'):
+            results.append({'patient_days': patient_days, 'stays': n_stays, 'stage': stage, 'error': topics_error})
+            print(f'{stage:<16} {topics_error}')
+
+    if 'data_processing' in state:
+        X, y = state['data_processing']
+        X = X.drop([col for col in KEY_COLUMNS if col in X.columns], axis=1)
+        X = np.ascontiguousarray(X.to_numpy(dtype=np.float32, na_value=0))
+        y = np.asarray(y)
+    else:
+        X = y = None
+
+    def fit():
+        from icu_mortality_model import make_model
+        return make_model('rf', rf_params).fit(X, y)
+    record('fit', 0 if X is None else X.shape[0], fit, rows_out=lambda model: X.shape[0])
+    record('predict_proba', 0 if X is None else X.shape[0], lambda: state['fit'].predict_proba(X))
+    return results
+
+def compare(old, new):
+    """
+    Prints each stage's time in new as a ratio of its time in old (above 1 is slower).
+    """
+    before = {(r['patient_days'], r['stage']): r.get('seconds') for r in old['results']}
+    print(f'{"patient_days":>12} {"stage":<16} {"old s":>9} {"new s":>9} {"ratio":>7}')
+    for r in new['results']:
+        then, now = before.get((r['patient_days'], r['stage'])), r.get('seconds')
+        if then and now:
+            print(f'{r["patient_days"]:>12} {r["stage"]:<16} {then:9.3f} {now:9.3f} {now / then:7.2f}')
+
+def run(sizes=DEFAULT_SIZES, memory=True, rf_params=None, out='pipeline_benchmark.json', seed=18):
+    """
+    Overview:
+        Benchmarks every size and writes the results with the commit and library versions to out.
+    Returns:
+        dict as written
+    """
+    report = {'commit': git_commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'versions': library_versions(),
+              'seed': seed, 'memory_profiled': memory, 'rf_params': rf_params or {}, 'results': []}
+    for size in sizes:
+        report['results'].extend(benchmark_size(size, memory, rf_params, seed))
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=1)
+    print(f'Results written to {out}')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic MIMIC-shaped data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='patient-days per run')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run of each stage')
+    parser.add_argument('--rf-params', default='{}', help='JSON overrides of the random forest settings for the fit stage')
+    parser.add_argument('--out', default='pipeline_benchmark.json')
+    parser.add_argument('--compare', default=None, help='earlier results file to compare against')
+    parser.add_argument('--seed', type=int, default=18)
+    args = parser.parse_args()
+    #the stages report their own timings here
+    metrics.echo = 0
+    import note_tokenizer
+    try:
+        note_tokenizer.load_lemmatizer()
+    except LookupError:
+        print('nltk wordnet data not found - benchmarking with stemmed note tokens')
+        note_tokenizer.use_stem_only()
+    report = run(args.sizes, not args.no_memory, json.loads(args.rf_params), args.out, args.seed)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
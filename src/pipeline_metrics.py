@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import functools
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+#Per-stage instrumentation of the featurization and scoring pipeline.  Stages (extraction queries, the featurization
+#steps, the merges in data_processing, model fit/predict) are wrapped in metrics.stage(...) or decorated with
+#timed(...); each records wall time, rows in and out, the memory of the frame it produced and the process peak RSS.
+#Nested stages are named by their path, e.g. 'data_processing/transform_labs'.
+#Configured from the environment (or metrics.configure):
+#   MIMIC_METRICS_PATH      file to write records to - unset keeps them in memory only
+#   MIMIC_METRICS_FORMAT    'jsonl' (one JSON record per stage, appended) or 'prom' (Prometheus text file of totals)
+#   MIMIC_METRICS_PROFILE   'cprofile' (dump a .prof file per stage) or 'tracemalloc' (record each stage's traced peak)
+#   MIMIC_METRICS_ECHO      nesting depth of the stages printed as they finish (default 1, top level only; 0 is silent)
+
+FORMATS = ('jsonl', 'prom')
+PROFILERS = ('cprofile', 'tracemalloc')
+
+
+def frame_rows(obj):
+    """
+    Rows of a dataframe/array (or an int passed through); None for anything else.
+    """
+    if obj is None:
+        return None
+    if isinstance(obj, int):
+        return obj
+    shape = getattr(obj, 'shape', None)
+    return int(shape[0]) if shape else None
+
+def frame_bytes(obj):
+    """
+    Memory held by a dataframe, series or array (shallow - object column contents are not measured); None otherwise.
+    """
+    usage = getattr(obj, 'memory_usage', None)
+    if usage is not None:
+        total = usage(index=True, deep=False)
+        return int(total.sum()) if hasattr(total, 'sum') else int(total)
+    nbytes = getattr(obj, 'nbytes', None)
+    return int(nbytes) if nbytes is not None else None
+
+def max_rss_bytes():
+    """
+    Peak resident set size of the process so far (ru_maxrss is KiB on Linux, bytes on macOS).
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def label_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Stage:
+    """
+    A running stage, as yielded by PipelineMetrics.stage.  output() records what the stage produced, note() adds
+    fields to its record.
+    """
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.record = {'stage': name, 'rows_in': frame_rows(rows_in)}
+        self.tracing = False
+        self.traced_peak = 0
+
+    def output(self, obj):
+        """
+        Records the rows and frame memory of the stage's result and returns it unchanged.
+        """
+        self.record['rows_out'] = frame_rows(obj)
+        self.record['frame_bytes'] = frame_bytes(obj)
+        return obj
+
+    def note(self, **fields):
+        self.record.update(fields)
+
+
+class PipelineMetrics:
+    """
+    Process-wide collector of stage records.  Records go to a JSON lines log or a Prometheus text file (rewritten after
+    each stage with per-stage totals and the latest values) if a path is configured.  An optional profiler runs
+    around each stage, or only the named ones.
+    """
+
+    def __init__(self, path=None, fmt='jsonl', profile=None, profile_stages=None, profile_dir=None, echo=1):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cprofile_active = False
+        self.totals = {}
+        self.configure(path, fmt, profile, profile_stages, profile_dir, echo)
+
+    def configure(self, path=None, fmt='jsonl', profile=None, profile_stages=None, profile_dir=None, echo=1):
+        """
+        Overview:
+            Sets where and how stage records are written.
+        Parameters:
+            path: str, optional
+                Output file; None keeps records in memory (totals) only
+            fmt: str
+                'jsonl' or 'prom'
+            profile: str, optional
+                'cprofile' or 'tracemalloc'
+            profile_stages: iterable, optional
+                Stage names (full path or last part) to profile - all stages if None
+            profile_dir: str, optional
+                Where cProfile .prof files are written, defaults to the directory of path (or the working directory)
+            echo: int
+                Nesting depth of the stages printed when they finish; 0 prints nothing
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown metrics format {fmt!r}, expected one of {FORMATS}')
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError(f'Unknown profiler {profile!r}, expected one of {PROFILERS}')
+        self.path = path
+        self.fmt = fmt
+        self.profile = profile
+        self.profile_stages = set(profile_stages) if profile_stages is not None else None
+        if profile_dir is None:
+            profile_dir = os.path.dirname(os.path.abspath(path)) if path else os.getcwd()
+        self.profile_dir = profile_dir
+        self.echo = echo
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _profiled(self, name):
+        if self.profile is None:
+            return False
+        return self.profile_stages is None or name in self.profile_stages or name.rsplit('/', 1)[-1] in self.profile_stages
+
+    def _claim_cprofile(self):
+        #one cProfile profiler at a time per process - the check and the claim happen under the lock, so two threads
+        #starting profiled stages together cannot both get one
+        with self._lock:
+            if self._cprofile_active:
+                return False
+            self._cprofile_active = True
+            return True
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Overview:
+            Context manager timing one pipeline stage.  Yields a Stage - call its output() with the stage's result
+            to record rows out and frame memory.  A stage that raises is recorded with the error and the error re-raised.
+        Parameters:
+            name: str
+                Stage name; nested stages are recorded as parent/name
+            rows_in: dataframe, array or int, optional
+                Input to the stage, for its row count
+        """
+        import tracemalloc
+        stack = self._stack()
+        current = Stage('/'.join([s.name for s in stack[-1:]] + [name]), rows_in)
+        profiled = self._profiled(current.name)
+        profiler = started_tracing = None
+        if profiled and self.profile == 'cprofile' and self._claim_cprofile():
+            import cProfile
+            profiler = cProfile.Profile()
+        elif profiled and self.profile == 'tracemalloc' or stack and stack[-1].tracing:
+            #peaks are reset per stage, so a parent's peak so far is saved first and merged back when the child ends
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            if stack:
+                stack[-1].traced_peak = max(stack[-1].traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            current.tracing = True
+        stack.append(current)
+        rss_before = max_rss_bytes()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield current
+        except BaseException as error:
+            current.record['error'] = f'{type(error).__name__}: {error}'
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                with self._lock:
+                    self._cprofile_active = False
+                prof_path = os.path.join(self.profile_dir, current.name.replace('/', '.').replace(':', '_') + '.prof')
+                profiler.dump_stats(prof_path)
+                current.record['profile'] = prof_path
+            stack.pop()
+            if current.tracing and tracemalloc.is_tracing():
+                peak = max(current.traced_peak, tracemalloc.get_traced_memory()[1])
+                current.record['traced_peak_bytes'] = peak
+                if stack:
+                    stack[-1].traced_peak = max(stack[-1].traced_peak, peak)
+                if started_tracing:
+                    tracemalloc.stop()
+            rss_after = max_rss_bytes()
+            current.record.update(seconds=round(seconds, 6), max_rss_bytes=rss_after,
+                                  rss_growth_bytes=None if rss_after is None else rss_after - rss_before,
+                                  depth=len(stack), pid=os.getpid(), time=round(time.time(), 3))
+            self.emit(current.record)
+
+    def emit(self, record):
+        """
+        Adds a finished stage's record to the totals, prints it (see echo) and writes it out.
+        """
+        with self._lock:
+            total = self.totals.setdefault(record['stage'], {'calls': 0, 'errors': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            total['errors'] += 'error' in record
+            total['seconds'] += record['seconds']
+            total['last'] = record
+            if self.path is not None:
+                if self.fmt == 'jsonl':
+                    with open(self.path, 'a') as f:
+                        f.write(json.dumps(record) + '\n')
+                else:
+                    tmp = self.path + '.tmp'
+                    with open(tmp, 'w') as f:
+                        f.write(self.prometheus_text())
+                    os.replace(tmp, self.path)
+        if record['depth'] < self.echo:
+            print(stage_summary(record))
+
+    def prometheus_text(self):
+        """
+        Prometheus text exposition of the per-stage totals and latest values (for the node exporter textfile collector).
+        """
+        metrics = [('mimic_stage_calls_total', 'counter', 'Runs of the stage', lambda t: t['calls']),
+                   ('mimic_stage_errors_total', 'counter', 'Runs of the stage that raised', lambda t: t['errors']),
+                   ('mimic_stage_seconds_total', 'counter', 'Wall time spent in the stage', lambda t: t['seconds']),
+                   ('mimic_stage_last_seconds', 'gauge', 'Wall time of the latest run', lambda t: t['last']['seconds']),
+                   ('mimic_stage_last_rows_in', 'gauge', 'Rows into the latest run', lambda t: t['last'].get('rows_in')),
+                   ('mimic_stage_last_rows_out', 'gauge', 'Rows out of the latest run', lambda t: t['last'].get('rows_out')),
+                   ('mimic_stage_last_frame_bytes', 'gauge', 'Memory of the frame the latest run produced',
+                    lambda t: t['last'].get('frame_bytes')),
+                   ('mimic_stage_last_max_rss_bytes', 'gauge', 'Process peak RSS after the latest run',
+                    lambda t: t['last'].get('max_rss_bytes'))]
+        lines = []
+        for metric, kind, help_text, value in metrics:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for name, total in sorted(self.totals.items()):
+                if value(total) is not None:
+                    lines.append(f'{metric}{{stage="{label_escape(name)}"}} {value(total)}')
+        return '\n'.join(lines) + '\n'
+
+    def timed(self, name=None, rows_in_arg=0, in_place=False, output=None):
+        """
+        Overview:
+            Decorator running a function as a stage.  Rows in are taken from the positional argument rows_in_arg and
+            rows out from the return value.
+        Parameters:
+            name: str, optional
+                Stage name, defaults to the function name
+            rows_in_arg: int
+                Index of the positional argument holding the input frame
+            in_place: bool
+                If True the function modifies that argument in place, which is then also measured as its output
+            output: callable, optional
+                Picks the output frame out of the return value, e.g. the features of an (X, y) tuple
+        """
+        def decorate(fn):
+            stage_name = name or fn.__name__
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                frame = args[rows_in_arg] if len(args) > rows_in_arg else None
+                with self.stage(stage_name, frame) as current:
+                    result = fn(*args, **kwargs)
+                    if in_place:
+                        current.output(frame)
+                    else:
+                        current.output(result if output is None else output(result))
+                return result
+            return wrapper
+        return decorate
+
+
+def stage_summary(record):
+    """
+    One line describing a finished stage record.
+    """
+    rows = f'{record.get("rows_in")} -> {record.get("rows_out")} rows'
+    memory = f', {record["frame_bytes"] / 2**20:.1f} MB' if record.get('frame_bytes') is not None else ''
+    status = f' FAILED {record["error"]}' if 'error' in record else ''
+    return f'{record["stage"]}: {record["seconds"]:.2f} s, {rows}{memory}{status}'
+
+
+metrics = PipelineMetrics(os.environ.get('MIMIC_METRICS_PATH'), os.environ.get('MIMIC_METRICS_FORMAT', 'jsonl'),
+                          os.environ.get('MIMIC_METRICS_PROFILE') or None, echo=int(os.environ.get('MIMIC_METRICS_ECHO', 1)))
+stage = metrics.stage
+timed = metrics.timed
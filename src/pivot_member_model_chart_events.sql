@@ -0,0 +1,7 @@
+-- daily vital pivot from the daily_vital_pivot table (daily_pivots.py) in the column layout of
+-- bulk_member_model_chart_events.sql; stays are read through the ICU stay table, so scoped extractions restrict it by stay
+select p.subject_id, p.hadm_id, p.icustay_id, p.chartdate
+  , p.temperature, p.heartrate, p.systolic_bp, p.mean_arterial_pressure
+from icustays ie
+join daily_vital_pivot p on p.icustay_id = ie.icustay_id
+order by p.subject_id, p.hadm_id;
@@ -0,0 +1,8 @@
+-- daily lab pivot from the daily_lab_pivot table (daily_pivots.py) in the column layout of bulk_member_model_labs.sql;
+-- stays are read through the ICU stay table, so scoped extractions (incremental_scoring.scope_query) restrict it by stay
+select p.subject_id, p.hadm_id, p.icustay_id, p.chartdate
+  , p.aniongap, p.albumin, p.bilirubin, p.creatinine, p.glucose, p.hematocrit, p.hemoglobin, p.lactate, p.platelet
+  , p.sodium, p.bun, p.wbc
+from icustays ie
+join daily_lab_pivot p on p.icustay_id = ie.icustay_id
+order by p.subject_id, p.hadm_id;
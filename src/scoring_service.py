@@ -0,0 +1,249 @@
+import asyncio
+import json
+import time
+import argparse
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from model_registry import registry, RF_MODEL_PATH, RF_FEATURES_PATH, LDA_MODEL_PATH, LDA_DICTIONARY_PATH
+from mimic_fxns import load_topic_dictionary
+from pipeline_metrics import metrics, stage
+
+
+#Local online scoring service.  Per-patient requests carry raw admission attributes, labs, vitals and echo/ecg note
+#text; concurrent requests are micro-batched into one featurization pass and one predict_proba call.
+#
+#   POST /score   {"admission": {...}, "labs": {...}, "vitals": {...}, "notes": "..."}  ->  {"mortality_risk": 0.12}
+#   GET  /stats   latency percentiles, throughput and batch sizes
+#   GET  /health
+
+ADMISSION_FIELDS = ['age_', 'gender', 'admit_time_m', 'admission_type', 'first_careunit', 'insurance', 'relig', 'marital',
+                    'readmit_thirty', 'cirrhosis', 'hiv', 'immuno_def', 'hep_fail', 'blood_cncr', 'metastatic_cncr']
+VITAL_FIELDS = ['temperature', 'heartrate', 'systolic_bp', 'mean_arterial_pressure']
+
+
+def payload_frames(payloads, lab_cols, vital_cols):
+    """
+    Overview:
+        Converts a batch of request payloads into the admission, lab, vital and note frames the feature pipeline expects.
+        Each request gets its own synthetic subject/admission id (its position in the batch), so feature rows come back
+        in request order.
+    Parameters:
+        payloads: list of dict
+            Request bodies
+        lab_cols, vital_cols: list
+            Lab and vital columns (missing values are left null)
+    Returns:
+        labs, admits, vitals, notes dataframes
+    """
+    ids = np.arange(len(payloads))
+    admits = pd.DataFrame([{field: p['admission'].get(field) for field in ADMISSION_FIELDS} for p in payloads])
+    admits.insert(0, 'hadm_id', ids)
+    admits.insert(0, 'subject_id', ids)
+    labs = pd.DataFrame([{col: p.get('labs', {}).get(col) for col in lab_cols} for p in payloads], columns=lab_cols, dtype=float)
+    labs.insert(0, 'hadm_id', ids)
+    labs.insert(0, 'subject_id', ids)
+    vitals = pd.DataFrame([{col: p.get('vitals', {}).get(col) for col in vital_cols} for p in payloads], columns=vital_cols, dtype=float)
+    vitals.insert(0, 'hadm_id', ids)
+    vitals.insert(0, 'subject_id', ids)
+    notes = pd.DataFrame({'subject_id': ids, 'hadm_id': ids, 'icustay_id': ids,
+                          'echo_ecg': [' '.join(p['notes']) if isinstance(p.get('notes'), list) else p.get('notes') for p in payloads]})
+    notes = notes.dropna(axis=0).reset_index(drop=True)
+    return labs, admits, vitals, notes
+
+
+def validate_payload(payload):
+    """
+    Overview:
+        Checks one request body before it joins a micro-batch, so a malformed request is rejected on its own instead of
+        failing the batch it would have been scored with.
+    Parameters:
+        payload: obj
+            Decoded request body
+    Raises:
+        ValueError describing the first problem found
+    """
+    if not isinstance(payload, dict):
+        raise ValueError('payload must be a JSON object')
+    if not isinstance(payload.get('admission'), dict):
+        raise ValueError('payload requires an admission object')
+    for field, value in payload['admission'].items():
+        if isinstance(value, (dict, list)):
+            raise ValueError(f'admission.{field} must be a single value')
+    for group in ('labs', 'vitals'):
+        values = payload.get(group, {})
+        if not isinstance(values, dict):
+            raise ValueError(f'{group} must be an object of numeric values')
+        for col, value in values.items():
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                raise ValueError(f'{group}.{col} must be a number or null, got {value!r}')
+    notes = payload.get('notes')
+    if notes is not None and not isinstance(notes, str) and not (isinstance(notes, list) and all(isinstance(note, str) for note in notes)):
+        raise ValueError('notes must be a string or a list of strings')
+
+
+class ScoringService:
+    """
+    Holds the preloaded model, feature pipeline and topic model and micro-batches concurrent score requests:
+    requests queue up for at most max_wait_ms (or until max_batch are waiting) and are then featurized and scored together.
+    """
+
+    def __init__(self, model_path=RF_MODEL_PATH, pipeline_path=RF_FEATURES_PATH, max_batch=64, max_wait_ms=5.0):
+        self.model = registry.get(model_path)
+        self.pipeline = registry.get(pipeline_path)
+        #topic model and dictionary are loaded now rather than on the first request
+        load_topic_dictionary(registry.get(LDA_MODEL_PATH), LDA_DICTIONARY_PATH)
+        self.lab_cols = [col for col in self.pipeline.norm_ranges if col not in VITAL_FIELDS]
+        self.vital_cols = [col for col in self.pipeline.norm_ranges if col in VITAL_FIELDS]
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.latencies = deque(maxlen=100000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.completed = 0
+        self.started = time.perf_counter()
+
+    def score_batch(self, payloads):
+        """
+        Featurizes and scores a batch of payloads in one pass.  Returns the mortality risk per payload, in order.
+        """
+        labs, admits, vitals, notes = payload_frames(payloads, self.lab_cols, self.vital_cols)
+        features, y, keys = self.pipeline.transform(labs, admits, vitals, notes)
+        #models fit on a dataframe are given one, with the pipeline's training column names
+        if hasattr(self.model, 'feature_names_in_'):
+            features = pd.DataFrame(features, columns=self.pipeline.columns, copy=False)
+        with stage('predict', features) as current:
+            return current.output(self.model.predict_proba(features)[:, 1]).tolist()
+
+    async def score(self, payload):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((payload, future, time.perf_counter()))
+        return await future
+
+    async def batch_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                risks = await loop.run_in_executor(None, self.score_batch, [payload for payload, _, _ in batch])
+            except Exception:
+                #a request that passed validation but still fails scoring must not take the rest of its batch with it
+                await self.score_singly(batch)
+                continue
+            done = time.perf_counter()
+            self.batch_sizes.append(len(batch))
+            for (_, future, start), risk in zip(batch, risks):
+                self.latencies.append(done - start)
+                self.completed += 1
+                if not future.done():
+                    future.set_result(risk)
+
+    async def score_singly(self, batch):
+        """
+        Scores the requests of a failed micro-batch one at a time, so only the failing ones get the error.
+        """
+        loop = asyncio.get_running_loop()
+        for payload, future, start in batch:
+            try:
+                risk = (await loop.run_in_executor(None, self.score_batch, [payload]))[0]
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+                continue
+            self.batch_sizes.append(1)
+            self.latencies.append(time.perf_counter() - start)
+            self.completed += 1
+            if not future.done():
+                future.set_result(risk)
+
+    def stats(self):
+        """
+        Latency percentiles (ms) over recent requests, throughput since start and mean batch size.
+        """
+        lat = np.array(self.latencies) * 1000
+        elapsed = time.perf_counter() - self.started
+        return {'requests': self.completed,
+                'p50_ms': float(np.percentile(lat, 50)) if lat.size else None,
+                'p99_ms': float(np.percentile(lat, 99)) if lat.size else None,
+                'throughput_rps': self.completed / elapsed if elapsed > 0 else 0.0,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+                'registry': dict(registry.stats)}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                writer.close()
+                return
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, response = await self.route(method, path, body)
+        except (ValueError, KeyError, asyncio.IncompleteReadError) as error:
+            status, response = 400, {'error': str(error)}
+        except Exception as error:
+            status, response = 500, {'error': str(error)}
+        data = json.dumps(response).encode('utf-8')
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + data)
+        await writer.drain()
+        writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/score':
+            payload = json.loads(body)
+            validate_payload(payload)
+            return 200, {'mortality_risk': await self.score(payload)}
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats()
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f'no route for {method} {path}'}
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        self.queue = asyncio.Queue()
+        worker = asyncio.create_task(self.batch_worker())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Scoring service listening on {host}:{port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online ICU mortality risk scoring service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model', default=RF_MODEL_PATH, help='pickled classifier, or a flat forest directory (forest_export.py)')
+    parser.add_argument('--pipeline', default=RF_FEATURES_PATH)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--metrics', default=None, help='Prometheus text file of per-stage metrics')
+    parser.add_argument('--echo', type=int, default=0,
+                        help='nesting depth of the per-stage timings printed for every micro-batch (default 0, none - see /stats)')
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.configure(args.metrics, 'prom', metrics.profile, metrics.profile_stages, echo=args.echo)
+    else:
+        metrics.echo = args.echo
+    service = ScoringService(args.model, args.pipeline, args.max_batch, args.max_wait_ms)
+    asyncio.run(service.serve(args.host, args.port))
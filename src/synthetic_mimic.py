@@ -0,0 +1,211 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from mimic_features import normal_lab_vital_ranges
+
+
+#Deterministic synthetic stand-in for the MIMIC extractions, for benchmarking and trying the pipeline without a
+#licensed database.  Frames have the columns the SQL files return (lower case, as Postgres folds the unquoted aliases)
+#with per-measure missingness, multi-day stays and echo/ecg note text.
+#A latent severity per stay drives abnormal labs/vitals, note findings and death_4_days, so models have signal to fit.
+#   train:  v_two_data_set_extraction.sql, train_lab_values.sql, train_chart_events.sql, train_echo_ecg_notes.sql
+#   bulk:   bulk_member_model_extraction.sql, bulk_member_model_labs.sql, bulk_member_model_chart_events.sql,
+#           bulk_member_echo_ecg_notes.sql
+#   python synthetic_mimic.py --stays 1000 --kind bulk     print frame shapes and missingness
+
+LAB_COLS = ['aniongap', 'albumin', 'bilirubin', 'creatinine', 'glucose', 'hematocrit', 'hemoglobin', 'lactate',
+            'platelet', 'sodium', 'bun', 'wbc']
+VITAL_COLS = ['temperature', 'heartrate', 'systolic_bp', 'mean_arterial_pressure']
+#share of lab rows missing each measure - albumin, lactate and bilirubin are drawn far less often than a basic panel
+LAB_MISSING = {'aniongap': .10, 'albumin': .65, 'bilirubin': .45, 'creatinine': .05, 'glucose': .05, 'hematocrit': .05,
+               'hemoglobin': .07, 'lactate': .55, 'platelet': .06, 'sodium': .05, 'bun': .05, 'wbc': .06}
+VITAL_MISSING = {'temperature': .08, 'heartrate': .02, 'systolic_bp': .04, 'mean_arterial_pressure': .05}
+#share of stay days with any lab / any vital / an echo or ecg note (first ICU day is always charted)
+LAB_DAY_RATE, VITAL_DAY_RATE, NOTE_DAY_RATE = .75, .92, .15
+#ICU days per stay is 1 + poisson(MEAN_EXTRA_DAYS)
+MEAN_EXTRA_DAYS = 3.5
+
+CATEGORIES = {
+    'admission_type': (['EMERGENCY', 'ELECTIVE', 'URGENT'], [.80, .15, .05]),
+    'first_careunit': (['MICU', 'SICU', 'CCU', 'CSRU', 'TSICU'], [.35, .15, .15, .20, .15]),
+    'insurance': (['Medicare', 'Private', 'Medicaid', 'Government', 'Self Pay'], [.55, .30, .10, .03, .02]),
+    'relig': (['RELIGIOUS', 'RELIGIOUS_NOT_SPEC', 'RELIGIOUS_NO_MED'], [.60, .39, .01]),
+    'marital': (['PARTNERED', 'SINGLE', 'WIDOWED', 'OTHER'], [.45, .25, .15, .15]),
+}
+CHRONIC_RATES = {'cirrhosis': .02, 'hiv': .005, 'immuno_def': .01, 'hep_fail': .01, 'blood_cncr': .02, 'metastatic_cncr': .02}
+
+NORMAL_FINDINGS = [
+    'Sinus rhythm.', 'Normal ECG.', 'Normal axis.', 'The left atrium is normal in size.',
+    'Left ventricular wall thickness, cavity size and regional/global systolic function are normal (LVEF >55%).',
+    'Right ventricular chamber size and free wall motion are normal.', 'The aortic valve leaflets (3) appear structurally normal.',
+    'The mitral valve appears structurally normal with trivial mitral regurgitation.', 'There is no pericardial effusion.',
+    'Compared to the previous tracing there is no significant change.', 'Estimated pulmonary artery systolic pressure is normal.',
+]
+ABNORMAL_FINDINGS = [
+    'Sinus tachycardia.', 'Atrial fibrillation with rapid ventricular response.', 'Left axis deviation.',
+    'Nonspecific ST-T wave changes.', 'Q waves in the inferior leads consistent with prior inferior myocardial infarction.',
+    'Right bundle branch block.', 'Low QRS voltages in the limb leads.', 'Prolonged QT interval.',
+    'The left atrium is moderately dilated.', 'Severe global left ventricular hypokinesis (LVEF 20%).',
+    'Moderate (2+) mitral regurgitation is seen.', 'There is a moderate sized pericardial effusion without tamponade physiology.',
+    'The right ventricular cavity is dilated with depressed free wall contractility.', 'Moderate pulmonary artery systolic hypertension.',
+    'Diffuse ST segment elevation consistent with acute pericarditis or injury.',
+]
+
+
+def stays_for_patient_days(patient_days):
+    """
+    Number of stays whose expected total ICU days is patient_days.
+    """
+    return max(int(round(patient_days / (1 + MEAN_EXTRA_DAYS))), 1)
+
+def choose(rng, categories, n):
+    values, probs = categories
+    return np.array(values, dtype=object)[rng.choice(len(values), size=n, p=probs)]
+
+def synthetic_stays(n_stays, rng):
+    """
+    Overview:
+        One row per ICU stay (one stay per admission, some patients with several admissions) with the admission
+        attributes of the extraction queries, the stay dates, the latent severity and death_4_days.
+    Returns:
+        dataframe
+    """
+    repeat_patient = rng.random(n_stays) < .15
+    repeat_patient[0] = False
+    subject_id = 10000 + np.cumsum(~repeat_patient)
+    stays = pd.DataFrame({'subject_id': subject_id, 'hadm_id': 100000 + np.arange(n_stays),
+                          'icustay_id': 200000 + np.arange(n_stays)})
+    n_days = 1 + rng.poisson(MEAN_EXTRA_DAYS, n_stays)
+    intime = np.datetime64('2100-01-01') + rng.integers(0, 100 * 365, n_stays).astype('timedelta64[D]')
+    stays['intime'] = intime.astype('datetime64[ns]')
+    stays['outtime'] = (intime + (n_days - 1).astype('timedelta64[D]')).astype('datetime64[ns]')
+    age = np.clip(rng.normal(64, 16, n_stays), 20, 89)
+    stays['age_'] = np.where(age >= 89, 91.4, np.round(age, 2))
+    stays['gender'] = (rng.random(n_stays) < .56).astype(np.int64)
+    stays['admit_time_m'] = pd.DatetimeIndex(stays['intime']).month.astype(np.float64)
+    for col, categories in CATEGORIES.items():
+        stays[col] = choose(rng, categories, n_stays)
+    stays['readmit_thirty'] = (rng.random(n_stays) < .06).astype(np.int64)
+    for col, rate in CHRONIC_RATES.items():
+        stays[col] = (rng.random(n_stays) < rate).astype(np.int64)
+    severity = rng.gamma(1.2, .6, n_stays) + .4 * stays[list(CHRONIC_RATES)].sum(axis=1).to_numpy()
+    stays['severity'] = severity
+    logit = -4.2 + 1.6 * severity + .03 * (stays['age_'].to_numpy() - 64)
+    stays['death_4_days'] = (rng.random(n_stays) < 1 / (1 + np.exp(-logit))).astype(np.int64)
+    stays['n_days'] = n_days
+    return stays
+
+def measure_values(rng, severity, cols, missing, norm_ranges):
+    """
+    Overview:
+        Lab or vital values for rows with the given severities: normal-range centred noise pushed out of range in a
+        per-measure direction as severity rises, rounded to 2 places as the queries do, with per-measure missingness.
+    Returns:
+        dict of column -> float array
+    """
+    n = len(severity)
+    values = {}
+    for col in cols:
+        low, high = norm_ranges[col]
+        mid, width = (low + high) / 2, high - low
+        direction = -1 if col in ('albumin', 'hematocrit', 'hemoglobin', 'platelet', 'systolic_bp', 'mean_arterial_pressure') else 1
+        v = mid + width * (.3 * rng.standard_normal(n) + direction * .5 * severity * rng.random(n))
+        v = np.round(np.maximum(v, .1 * low if low > 0 else .01), 2)
+        v[rng.random(n) < missing[col]] = np.nan
+        values[col] = v
+    return values
+
+def note_text(rng, severity):
+    """
+    Echo/ecg report text for each severity: a handful of findings, more of them abnormal the sicker the stay.
+    """
+    n_findings = rng.integers(3, 9, len(severity))
+    p_abnormal = np.clip(.15 + .3 * severity, 0, .9)
+    texts = []
+    for k, p in zip(n_findings, p_abnormal):
+        abnormal = rng.random(k) < p
+        findings = [ABNORMAL_FINDINGS[i] if a else NORMAL_FINDINGS[j] for a, i, j in
+                    zip(abnormal, rng.integers(0, len(ABNORMAL_FINDINGS), k), rng.integers(0, len(NORMAL_FINDINGS), k))]
+        texts.append(' '.join(findings))
+    return texts
+
+def stay_days(stays):
+    """
+    Expands stays to one row per ICU day (chartdate) carrying the ids, severity and day number.
+    """
+    idx = np.repeat(np.arange(len(stays)), stays['n_days'].to_numpy())
+    day_n = np.arange(len(idx)) - np.repeat(np.cumsum(stays['n_days'].to_numpy()) - stays['n_days'].to_numpy(), stays['n_days'].to_numpy())
+    days = stays.iloc[idx][['subject_id', 'hadm_id', 'icustay_id', 'severity']].reset_index(drop=True)
+    days['chartdate'] = stays['intime'].to_numpy()[idx] + day_n.astype('timedelta64[D]')
+    days['day_n'] = day_n
+    return days
+
+def synthetic_mimic(n_stays, kind='bulk', seed=18):
+    """
+    Overview:
+        Generates the four extraction frames for n_stays ICU stays.  The same arguments always give the same data.
+    Parameters:
+        n_stays: int
+            Number of ICU stays (see stays_for_patient_days to size by patient-days)
+        kind: str
+            'bulk' - daily rows keyed on icustay_id and chartdate, as the bulk_member queries return
+            'train' - one lab/vital row per admission and undated notes, as the train/v_two queries return
+        seed: int
+    Returns:
+        dict of dataframes: admits, labs, vitals, notes
+    """
+    rng = np.random.default_rng(seed)
+    norm_ranges = normal_lab_vital_ranges()
+    stays = synthetic_stays(n_stays, rng)
+    all_days = stay_days(stays)
+    #the train queries take labs and vitals from the first ICU day only
+    days = all_days.loc[all_days['day_n'] == 0].reset_index(drop=True) if kind == 'train' else all_days
+    first_day = days['day_n'].to_numpy() == 0
+
+    lab_days = days.loc[first_day | (rng.random(len(days)) < LAB_DAY_RATE)].reset_index(drop=True)
+    labs = lab_days[['subject_id', 'hadm_id', 'icustay_id', 'chartdate']].copy()
+    for col, v in measure_values(rng, lab_days['severity'].to_numpy(), LAB_COLS, LAB_MISSING, norm_ranges).items():
+        labs[col] = v
+    labs = labs.loc[labs[LAB_COLS].notna().any(axis=1)].reset_index(drop=True)
+
+    vital_days = days.loc[first_day | (rng.random(len(days)) < VITAL_DAY_RATE)].reset_index(drop=True)
+    vitals = vital_days[['subject_id', 'hadm_id', 'icustay_id', 'chartdate']].copy()
+    for col, v in measure_values(rng, vital_days['severity'].to_numpy(), VITAL_COLS, VITAL_MISSING, norm_ranges).items():
+        vitals[col] = v
+    vitals = vitals.loc[vitals[VITAL_COLS].notna().any(axis=1)].reset_index(drop=True)
+
+    #some note days have two reports (an echo and an ecg); a few report rows carry no text
+    note_days = all_days.loc[rng.random(len(all_days)) < NOTE_DAY_RATE]
+    note_days = note_days.iloc[np.repeat(np.arange(len(note_days)), 1 + (rng.random(len(note_days)) < .3))].reset_index(drop=True)
+    notes = note_days[['subject_id', 'hadm_id', 'icustay_id', 'chartdate']].copy()
+    notes['echo_ecg'] = pd.Series(note_text(rng, note_days['severity'].to_numpy()), dtype=object)
+    notes.loc[rng.random(len(notes)) < .03, 'echo_ecg'] = None
+
+    admit_cols = ['subject_id', 'hadm_id', 'icustay_id', 'intime', 'outtime', 'age_', 'gender', 'admit_time_m'] + \
+        list(CATEGORIES) + ['readmit_thirty'] + list(CHRONIC_RATES) + ['death_4_days']
+    admits = stays[admit_cols].copy()
+    if kind == 'train':
+        admits = admits.drop(columns=['icustay_id', 'intime', 'outtime'])
+        labs = labs.drop(columns=['icustay_id', 'chartdate'])
+        vitals = vitals.drop(columns=['icustay_id', 'chartdate'])
+        notes = notes.drop(columns=['chartdate'])
+    else:
+        for frame in (labs, vitals, notes):
+            frame['chartdate'] = frame['chartdate'].dt.date
+        admits['intime'] = admits['intime'].dt.date
+        admits['outtime'] = admits['outtime'].dt.date
+    return {'admits': admits, 'labs': labs, 'vitals': vitals, 'notes': notes}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic MIMIC-shaped extraction frames')
+    parser.add_argument('--stays', type=int, default=1000)
+    parser.add_argument('--kind', default='bulk', choices=['bulk', 'train'])
+    parser.add_argument('--seed', type=int, default=18)
+    args = parser.parse_args()
+    frames = synthetic_mimic(args.stays, args.kind, args.seed)
+    for name, frame in frames.items():
+        print(f'{name}: {frame.shape[0]} rows x {frame.shape[1]} columns, {frame.isna().mean().mean():.1%} missing')
+        print(frame.head(3).to_string())
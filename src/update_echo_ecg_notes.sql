@@ -0,0 +1,19 @@
+-- echo/ecg notes added since the topic model's watermark (noteevents.row_id), with the same stay matching as
+-- train_echo_ecg_notes.sql.  Used by lda_model_pipeline.update_lda_model.
+SELECT ne.row_id, ie.subject_id, ie.hadm_id, ie.icustay_id
+  , ne."text" as ECHO_ECG
+FROM icustays ie
+JOIN noteevents ne
+  ON ne.subject_id = ie.subject_id
+  AND ne.hadm_id = ie.hadm_id
+  AND ne.chartdate between (ie.intime - interval '12' hour) AND (ie.outtime + interval '12' hour)
+  AND ne.category IN
+  (
+    'ECG', --ECG read notes
+    'ECHO' --ECHO read notes
+  )
+  AND ne.iserror isnull
+WHERE ne.row_id > %(last_row_id)s
+  AND ne.row_id <= %(through_row_id)s
+  AND ne."text" is not null
+ORDER BY ie.subject_id, ie.hadm_id, ie.icustay_id;
@@ -0,0 +1,23 @@
+import os
+import sys
+
+from psycopg2 import sql
+
+
+#the modules under src/ are run as scripts from that directory and import each other as siblings
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+def render(composable):
+    #enough of psycopg2's quoting to read a composed query without a connection
+    if isinstance(composable, sql.Composed):
+        return ''.join(render(part) for part in composable.seq)
+    if isinstance(composable, sql.Identifier):
+        return '"' + '"."'.join(composable.strings) + '"'
+    if isinstance(composable, sql.Placeholder):
+        return f'%({composable.name})s'
+    if isinstance(composable, sql.Literal):
+        return repr(composable.wrapped)
+    return composable.string
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+from mimic_features import assemble_features
+
+
+def test_unmatched_admissions_keep_nan_labs():
+    norm_ranges = {'lactate': [6, 16], 'sodium': [136, 145], 'heartrate': [50.0, 100.0]}
+    admits = pd.DataFrame({'subject_id': [1, 2, 3], 'hadm_id': [10, 20, 30], 'age_': [50.0, 60.0, 70.0],
+                           'death_4_days': [0, 1, 0]})
+    #admission 2 has a lab row with a missing sodium, admission 3 has no lab row and only admission 1 has vitals
+    labs = pd.DataFrame({'subject_id': [1, 2], 'hadm_id': [10, 20], 'lactate': [26.0, 11.0], 'sodium': [130.0, np.nan]})
+    vitals = pd.DataFrame({'subject_id': [1], 'hadm_id': [10], 'heartrate': [110.0]})
+    topics = pd.DataFrame({'subject_id': [1], 'hadm_id': [10], 'top2': [3], 'top1': [5]})
+    X, y = assemble_features(admits, [labs, vitals], topics, ['subject_id', 'hadm_id'], [], norm_ranges)
+
+    np.testing.assert_allclose(X['lactate'], [1.0, 0.0, np.nan])
+    np.testing.assert_allclose(X['sodium'], [-(6 / 9) ** 2, 0.0, np.nan])
+    np.testing.assert_allclose(X['heartrate'], [(10 / 50) ** 2, np.nan, np.nan])
+    #missing topics get the fill value rather than NaN
+    assert X['top1'].tolist() == [5, -1, -1]
+    assert y.tolist() == [0, 1, 0]
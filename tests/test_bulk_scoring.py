@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from bulk_scoring import shard_of, load_manifest, save_manifest, run_shards
+
+#(subject_id * 2654435761) mod 2**32 mod n_shards
+KNOWN_SHARDS = {1: 17, 2: 2, 3: 19, 10006: 22, 23052: 12, 99999: 15}
+
+
+def test_shard_of_is_stable():
+    ids = list(KNOWN_SHARDS)
+    assert shard_of(ids, 32).tolist() == list(KNOWN_SHARDS.values())
+    #ids coming back from the database as floats, or in another order, land in the same shards
+    assert shard_of(np.array(ids[::-1], dtype=float), 32).tolist() == list(KNOWN_SHARDS.values())[::-1]
+    shards = shard_of(np.arange(1, 100001), 32)
+    assert shards.min() == 0 and shards.max() == 31
+    #spread over every shard without any one taking much more than its share
+    assert np.bincount(shards).max() < 1.1 * 100000 / 32
+
+
+def no_setup():
+    pass
+
+def fake_score(shard, stays):
+    if shard == 3:
+        raise RuntimeError('lost connection')
+    return {'shard': shard, 'stays': int(stays.shape[0]), 'rows': 10 * int(stays.shape[0]), 'seconds': 0.0}
+
+
+def test_resume_skips_finished_shards(tmp_path, capsys):
+    path = str(tmp_path / 'manifest.json')
+    model_path = str(tmp_path / 'model.pkl')
+    shard_stays = {shard: pd.DataFrame({'subject_id': range(shard + 1)}) for shard in range(4)}
+    manifest = load_manifest(path, 4, model_path)
+    #shard 0 finished in an earlier run and is kept as it was
+    manifest['shards']['0'] = {'shard': 0, 'stays': 1, 'rows': -1, 'seconds': 0.0}
+    save_manifest(manifest, path)
+
+    manifest = load_manifest(path, 4, model_path)
+    failed = run_shards(shard_stays, manifest, path, 2, (), task=fake_score, initializer=no_setup)
+    assert failed == [3]
+    with open(path) as f:
+        saved = json.load(f)
+    assert {shard: result['rows'] for shard, result in saved['shards'].items()} == {'0': -1, '1': 20, '2': 30}
+
+    #the next run only retries the failed shard
+    capsys.readouterr()
+    assert run_shards(shard_stays, load_manifest(path, 4, model_path), path, 1, (), task=fake_score,
+                      initializer=no_setup) == [3]
+    assert '3 shards already done, 1 to score' in capsys.readouterr().out
+    #a manifest for another shard count starts over
+    assert load_manifest(path, 8, model_path)['shards'] == {}
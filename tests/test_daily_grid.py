@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+from daily_grid import daily_model_inputs
+
+
+def test_note_inputs_are_renumbered_after_dropping_empty_days():
+    daily = pd.DataFrame({'subject_id': [1, 1, 1, 2], 'hadm_id': [10, 10, 10, 20], 'icustay_id': [100, 100, 100, 200],
+                          'dos': pd.to_datetime(['2130-01-01', '2130-01-02', '2130-01-03', '2130-02-01']),
+                          'stay_id': ['1_10_100'] * 3 + ['2_20_200'], 'lactate': [1.0, 2.0, 3.0, 4.0],
+                          'echo_ecg': [None, 'sinus rhythm', None, 'valve']})
+    labs, admits, vitals, echoecg = daily_model_inputs(daily, ['subject_id', 'hadm_id', 'icustay_id'],
+                                                       ['subject_id', 'hadm_id', 'lactate', 'chartdate'],
+                                                       ['subject_id', 'hadm_id', 'chartdate'],
+                                                       ['subject_id', 'hadm_id', 'icustay_id', 'chartdate', 'echo_ecg'])
+    assert echoecg.index.tolist() == [0, 1]
+    assert echoecg['echo_ecg'].tolist() == ['sinus rhythm', 'valve']
+    assert echoecg['dos'].tolist() == list(pd.to_datetime(['2130-01-02', '2130-02-01']))
+
+
+ID_COLS = ['subject_id', 'hadm_id', 'icustay_id']
+
+
+def notebook_daily_grid(pt_admit, labs, vitals, notes):
+    #the per-stay loops of the bulk modeling notebook that build_daily_grid replaces
+    dailies = []
+    for admission in pt_admit['icustay_id']:
+        adm_data = pt_admit[pt_admit['icustay_id'] == admission]
+        dates_of_service = pd.date_range(adm_data['intime'].iloc[0], adm_data['outtime'].iloc[0], freq='D')
+        daily = pd.DataFrame({'dos': dates_of_service, 'day_n': range(1, len(dates_of_service) + 1)})
+        for col in ID_COLS:
+            daily[col] = adm_data[col].iloc[0]
+        dailies.append(daily)
+    daily_df = pd.concat(dailies)
+    daily_df['stay_id'] = daily_df['subject_id'].astype('str') + '_' + daily_df['hadm_id'].astype('str') + '_' + daily_df['icustay_id'].astype('str')
+    for events in (labs, vitals, notes):
+        daily_df = daily_df.merge(events, how='left', left_on=ID_COLS + ['dos'], right_on=ID_COLS + ['chartdate'])
+        daily_df.drop('chartdate', axis=1, inplace=True)
+    stays = [daily_df[daily_df['icustay_id'] == stay].ffill() for stay in daily_df['icustay_id'].unique()]
+    return pd.concat(stays).merge(pt_admit, how='inner', on=ID_COLS)
+
+
+def test_daily_grid_matches_the_notebook_loops():
+    from daily_grid import build_daily_grid
+    pt_admit = pd.DataFrame({'subject_id': [1, 2, 3, 4], 'hadm_id': [10, 20, 30, 40], 'icustay_id': [100, 200, 300, 400],
+                             #midnight-aligned, non-midnight over three calendar days, under a day, and out before in
+                             'intime': pd.to_datetime(['2130-01-01 00:00', '2130-02-01 14:30', '2130-03-05 08:00', '2130-04-02 10:00']),
+                             'outtime': pd.to_datetime(['2130-01-04 00:00', '2130-02-03 09:15', '2130-03-05 20:00', '2130-04-01 10:00']),
+                             'age': [60, 70, 80, 90]})
+    labs = pd.DataFrame({'subject_id': [1, 1, 2, 3], 'hadm_id': [10, 10, 20, 30], 'icustay_id': [100, 100, 200, 300],
+                         'chartdate': pd.to_datetime(['2130-01-01 00:00', '2130-01-03 00:00', '2130-02-01 14:30', '2130-03-05 00:00']),
+                         'lactate': [1.0, np.nan, 2.0, 3.0], 'sodium': [140.0, 150.0, np.nan, 135.0]})
+    vitals = pd.DataFrame({'subject_id': [1, 2], 'hadm_id': [10, 20], 'icustay_id': [100, 200],
+                           'chartdate': pd.to_datetime(['2130-01-02 00:00', '2130-02-02 14:30']), 'heartrate': [90.0, 110.0]})
+    notes = pd.DataFrame({'subject_id': [1], 'hadm_id': [10], 'icustay_id': [100],
+                          'chartdate': pd.to_datetime(['2130-01-02']), 'echo_ecg': ['sinus rhythm']})
+    daily = build_daily_grid(pt_admit, labs, vitals, notes)
+    expected = notebook_daily_grid(pt_admit, labs, vitals, notes)
+    pd.testing.assert_frame_equal(daily.reset_index(drop=True), expected.reset_index(drop=True))
+    assert daily.groupby('icustay_id')['day_n'].max().to_dict() == {100: 4, 200: 2, 300: 1}
+    #stay 1 carries the day 1 lactate over the day 3 gap and the note forward from day 2
+    stay = daily[daily['icustay_id'] == 100]
+    assert stay['lactate'].tolist() == [1.0, 1.0, 1.0, 1.0]
+    assert stay['echo_ecg'].isna().tolist() == [True, False, False, False]
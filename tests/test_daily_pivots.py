@@ -0,0 +1,208 @@
+import datetime
+import json
+import re
+import sqlite3
+
+import pytest
+from psycopg2 import sql
+
+import incremental_scoring
+from conftest import render, SRC_DIR
+from daily_pivots import PIVOTS, new_event_condition, pivot_consumer, ensure_pivot_tables, refresh_pivot
+from incremental_scoring import window_params
+
+
+@pytest.mark.parametrize('pivot', list(PIVOTS))
+def test_new_events_come_from_the_row_id_window(pivot):
+    spec = PIVOTS[pivot]
+    source, alias = spec['event_table'], spec['alias']
+    events = render(sql.SQL(spec['events']).format(new=new_event_condition(spec)))
+    #only the pivot's own event table is read, bounded by its window
+    assert re.findall(r'\b(labevents|chartevents|noteevents)\b', events) == [source]
+    assert f'"{alias}".row_id > coalesce(%({source}_after)s::bigint, 0)' in events
+    assert f'"{alias}".row_id <= %({source}_through)s' in events
+    #every placeholder is filled by the window parameters of the pivot's source plus the item list
+    params = {'items': spec['items'], **window_params({source: (None, 100)})}
+    assert set(re.findall(r'%\((\w+)\)s', events)) == set(params)
+
+
+def test_since_also_takes_events_from_that_date():
+    spec = PIVOTS['labs']
+    since = datetime.date(2150, 6, 1)
+    condition = render(new_event_condition(spec, since))
+    assert condition.startswith('((') and condition.endswith(f'or "le".charttime >= {since!r})')
+
+
+def test_each_pivot_keeps_its_own_event_watermark():
+    consumers = {pivot_consumer(pivot) for pivot in PIVOTS}
+    assert len(consumers) == len(PIVOTS) and 'risk' not in consumers
+
+
+#--- refresh against sqlite.  SqliteConnection runs the module's Postgres statements after rewriting the few
+#Postgres-only constructs they use, so refresh_pivot's own delete/insert/watermark statements and the real pivot
+#source query are what get executed.
+
+def greatest(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+TRANSLATIONS = [
+    (r'create temporary table (\S+) on commit drop as', r'create temporary table \1 as'),
+    (r"'-infinity'::timestamp", "'-infinity'"),
+    (r'array\[\]::integer\[\]', "'[]'"),
+    (r'array_agg\(', 'json_group_array('),
+    (r'(\w+\([\w."]+\)|[\w."]+)::date', r'date(\1)'),
+    (r'::(bigint|numeric)', ''),
+    (r'= any\(%\((\w+)\)s\)', r'in (select value from json_each(:\1))'),
+    (r'in %\((\w+)\)s', r'in (select value from json_each(:\1))'),
+    (r'%\((\w+)\)s', r':\1'),
+    (r'%s', '?'),
+    (r'%%', '%'),
+    (r'delete from (\S+) (\w+) using (\S+) (\w+) where (.*)', r'delete from \1 as \2 where exists (select 1 from \3 \4 where \5)'),
+    (r'default now\(\)', 'default current_timestamp'),
+    #sqlite needs a where clause to tell an upsert's on conflict from a join constraint
+    (r'(from "pivot_refresh_scope")\s+on conflict', r'\1 where true on conflict'),
+]
+
+
+class SqliteCursor:
+    def __init__(self, conn):
+        self.cur = conn.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        text = query if isinstance(query, str) else render(query)
+        for pattern, replacement in TRANSLATIONS:
+            text = re.sub(pattern, replacement, text, flags=re.DOTALL | re.IGNORECASE)
+        if isinstance(params, dict):
+            params = {key: json.dumps(list(value)) if isinstance(value, (list, tuple)) else value
+                      for key, value in params.items()}
+        self.cur.execute(text, params if params is not None else ())
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+
+class SqliteConnection:
+    def __init__(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.create_function('greatest', -1, greatest)
+        self.conn.create_function('now', 0, lambda: datetime.datetime.now().isoformat(' '))
+
+    def cursor(self):
+        return SqliteCursor(self.conn)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def query(self, text, params=()):
+        return self.conn.execute(text, params).fetchall()
+
+
+def sqlite_execute_values(cur, query, argslist):
+    for args in argslist:
+        cur.execute(render(query).replace('values %s', 'values (' + ', '.join(['%s'] * len(args)) + ')'), args)
+
+
+LACTATE, SODIUM = 50813, 50824
+
+
+@pytest.fixture
+def mimic(monkeypatch):
+    monkeypatch.setattr(incremental_scoring, 'execute_values', sqlite_execute_values)
+    monkeypatch.chdir(SRC_DIR)
+    conn = SqliteConnection()
+    conn.conn.executescript("""
+    create table icustays (subject_id integer, hadm_id integer, icustay_id integer, intime text, outtime text);
+    create table admissions (subject_id integer, hadm_id integer);
+    create table cohort (icustay_id integer);
+    create table hold_out (icustay_id integer);
+    create table labevents (row_id integer primary key, subject_id integer, hadm_id integer, itemid integer,
+                            charttime text, valuenum real);
+    insert into icustays values (1, 10, 100, '2130-01-01 08:00:00', '2130-01-05 12:00:00'),
+                                (2, 20, 200, '2130-02-01 22:00:00', '2130-02-03 06:00:00'),
+                                (3, 30, 300, '2130-03-01 09:00:00', '2130-03-02 18:00:00');
+    insert into admissions values (1, 10), (2, 20), (3, 30);
+    insert into cohort values (100);
+    insert into hold_out values (200);
+    """)
+    add_labs(conn, [(1, 10, LACTATE, '2130-01-01 09:00:00', 2.0), (1, 10, SODIUM, '2130-01-01 10:00:00', 140.0),
+                    (1, 10, LACTATE, '2130-01-02 09:00:00', 3.0), (1, 10, LACTATE, '2130-01-03 09:00:00', 4.0),
+                    (2, 20, SODIUM, '2130-02-02 01:00:00', 135.0),
+                    #stay 300 is not in the cohort yet
+                    (3, 30, LACTATE, '2130-03-01 12:00:00', 1.5)])
+    ensure_pivot_tables(conn)
+    return conn
+
+
+def add_labs(conn, rows):
+    conn.conn.executemany('insert into labevents (subject_id, hadm_id, itemid, charttime, valuenum) values (?, ?, ?, ?, ?)', rows)
+    conn.commit()
+
+
+def pivot_rows(conn):
+    return conn.query('select icustay_id, chartdate, lactate, sodium from daily_lab_pivot order by icustay_id, chartdate')
+
+
+def source_rows(conn):
+    #the pivot query run in full over the cohort and hold-out stays
+    with open(PIVOTS['labs']['source']) as f:
+        source = f.read().strip().rstrip(';')
+    cur = conn.cursor()
+    cur.execute(f"""select q.icustay_id, q.chartdate, q.lactate, q.sodium from ({source}) q
+                    where q.chartdate is not null
+                    and q.icustay_id in (select icustay_id from cohort union select icustay_id from hold_out)
+                    order by q.icustay_id, q.chartdate""")
+    return cur.fetchall()
+
+
+def test_refresh_recomputes_touched_days_from_new_events(mimic):
+    first = refresh_pivot(mimic, 'labs')
+    assert first['stays'] == 2
+    assert pivot_rows(mimic) == source_rows(mimic) == [
+        (100, '2130-01-01', 2.0, 140.0), (100, '2130-01-02', 3.0, None), (100, '2130-01-03', 4.0, None),
+        (200, '2130-02-02', None, 135.0)]
+    assert mimic.query("select source, last_row_id from event_watermark where consumer = 'pivot:labs'") == [('labevents', 6)]
+    assert mimic.query("select icustay_id, last_event from daily_pivot_watermark order by icustay_id") == [
+        (100, '2130-01-03 09:00:00'), (200, '2130-02-02 01:00:00')]
+
+    #a marker on stay 100's first day shows which days the next refresh recomputes
+    mimic.query("update daily_lab_pivot set sodium = -1 where icustay_id = 100 and chartdate = '2130-01-01'")
+    #a back-dated lactate for day 2, a first value on day 4, and stay 300 joins the cohort with its old events
+    add_labs(mimic, [(1, 10, LACTATE, '2130-01-02 20:00:00', 5.0), (1, 10, LACTATE, '2130-01-04 09:00:00', 6.0)])
+    mimic.query('insert into cohort values (300)')
+    mimic.commit()
+    second = refresh_pivot(mimic, 'labs')
+
+    assert second == {'stays': 2, 'rows': 4}
+    rows = pivot_rows(mimic)
+    #every (stay, day) once - nothing duplicated, nothing lost
+    assert len({row[:2] for row in rows}) == len(rows)
+    #day 1 predates stay 100's first new event and is left alone; days 2 on are recomputed
+    assert rows == [(100, '2130-01-01', 2.0, -1.0), (100, '2130-01-02', 4.0, None), (100, '2130-01-03', 4.0, None),
+                    (100, '2130-01-04', 6.0, None), (200, '2130-02-02', None, 135.0), (300, '2130-03-01', 1.5, None)]
+    assert [row for row in rows if row[:2] != (100, '2130-01-01')] == \
+        [row for row in source_rows(mimic) if row[:2] != (100, '2130-01-01')]
+    assert mimic.query("select last_row_id from event_watermark where consumer = 'pivot:labs'") == [(8,)]
+    assert mimic.query("select icustay_id, last_event from daily_pivot_watermark order by icustay_id") == [
+        (100, '2130-01-04 09:00:00'), (200, '2130-02-02 01:00:00'), (300, '2130-03-01 09:00:00')]
+
+    #nothing new: nothing recomputed
+    assert refresh_pivot(mimic, 'labs') == {'stays': 0, 'rows': 0}
+    assert pivot_rows(mimic) == rows
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+from data_prep_pipeline import hold_out_bucket, split_cohort, drop_assigned, EXCLUSION_COLS, COHORT_COLS
+
+#md5 of the decimal subject_id -> first 7 hex digits -> int % 10000; the hold-out pool is buckets below 4000
+KNOWN_BUCKETS = {2: ('c81e728', 9912), 3: ('eccbc87', 8631), 10006: ('19b1b73', 2323), 23052: ('eaebf0b', 3195),
+                 99999: ('d3eb9a9', 4569)}
+
+
+def exclusions(subject_ids, excluded=()):
+    df = pd.DataFrame({'hadm_id': [100000 + i for i in range(len(subject_ids))], 'subject_id': subject_ids,
+                       'icustay_id': [200000 + i for i in range(len(subject_ids))]})
+    for col in EXCLUSION_COLS:
+        df[col] = 0
+    df.loc[df['subject_id'].isin(excluded), 'excl_age'] = 1
+    return df
+
+
+def test_hold_out_bucket_known_prefixes():
+    for subject_id, (prefix, bucket) in KNOWN_BUCKETS.items():
+        assert int(prefix, 16) % 10000 == bucket
+    assert hold_out_bucket(list(KNOWN_BUCKETS)).tolist() == [bucket for _, bucket in KNOWN_BUCKETS.values()]
+    #ids coming back from the database as floats hash the same
+    assert hold_out_bucket(np.array(list(KNOWN_BUCKETS), dtype=float)).tolist() == hold_out_bucket(list(KNOWN_BUCKETS)).tolist()
+
+
+def test_split_cohort_by_bucket():
+    #subject 3 has a second stay, and subject 99999 is excluded
+    admits = exclusions([2, 3, 10006, 23052, 99999, 3], excluded=[99999])
+    c_train, c_hold_out = split_cohort(admits)
+    assert list(c_train.columns) == COHORT_COLS
+    assert c_train['subject_id'].tolist() == [2, 3, 3]
+    assert c_hold_out['subject_id'].tolist() == [10006, 23052]
+    #a larger hold-out share moves every bucket below the new cut
+    c_train, c_hold_out = split_cohort(admits, hold_out_fraction=.9)
+    assert c_train['subject_id'].tolist() == [2] and sorted(c_hold_out['subject_id']) == [3, 3, 10006, 23052]
+
+
+def test_rerun_only_adds_new_stays():
+    admits = exclusions([2, 3, 10006, 23052])
+    c_train, c_hold_out = split_cohort(admits)
+    #the first run assigned everything but subject 3's stay and 23052's stay
+    assigned = pd.concat([c_train, c_hold_out]).loc[lambda df: ~df['subject_id'].isin([3, 23052]), ['hadm_id', 'icustay_id']]
+    assert drop_assigned(c_train, assigned)['subject_id'].tolist() == [3]
+    assert drop_assigned(c_hold_out, assigned)['subject_id'].tolist() == [23052]
+    everything = pd.concat([c_train, c_hold_out])[['hadm_id', 'icustay_id']]
+    assert drop_assigned(c_train, everything).empty and drop_assigned(c_hold_out, everything).empty
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+from feature_cache import FeatureCache
+
+
+def extraction_frame(rows=1000):
+    rng = np.random.default_rng(18)
+    return pd.DataFrame({'subject_id': np.arange(rows, dtype=np.int64) + 10000,
+                         'hadm_id': np.arange(rows, dtype=np.int32) + 100000,
+                         'valuenum': rng.random(rows),
+                         'sparse_lab': np.where(np.arange(rows) % 5 == 0, np.nan, rng.random(rows)),
+                         'label': rng.choice(['HR', 'TEMP'], rows),
+                         'charttime': pd.date_range('2150-01-01', periods=rows, freq='h'),
+                         'flag': np.arange(rows) % 2 == 0})
+
+
+def owner(values):
+    while getattr(values, 'base', None) is not None:
+        values = values.base
+    return values
+
+
+def test_round_trip(tmp_path):
+    for memory_map in (True, False):
+        cache = FeatureCache(str(tmp_path / str(memory_map)), memory_map=memory_map)
+        df = extraction_frame()
+        assert cache.put('key', df)
+        pd.testing.assert_frame_equal(cache.get('key'), df)
+        assert cache.get('missing') is None
+        assert cache.stats['hits'] == 1 and cache.stats['misses'] == 1
+
+
+def test_empty_frame(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    df = extraction_frame().iloc[:0].reset_index(drop=True)
+    cache.put('key', df)
+    pd.testing.assert_frame_equal(cache.get('key'), df)
+
+
+def test_hit_maps_numeric_columns_without_copying(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    cache.put('key', extraction_frame())
+    hit = cache.get('key')
+    for col in ('subject_id', 'hadm_id', 'valuenum'):
+        assert not isinstance(owner(hit[col].to_numpy()), np.ndarray), col
+
+
+def test_writes_to_a_hit_stay_private(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    df = extraction_frame()
+    cache.put('key', df)
+    hit = cache.get('key')
+    hit.loc[3, 'valuenum'] = -1.0
+    hit['subject_id'] += 1
+    assert hit.loc[3, 'valuenum'] == -1.0
+    pd.testing.assert_frame_equal(cache.get('key'), df)
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from synthetic_mimic import synthetic_mimic
+from feature_pipeline import FeaturePipeline
+from mimic_features import normal_lab_vital_ranges, data_processing_column_refs, data_processing
+
+
+@pytest.fixture(scope='module')
+def frames():
+    data = synthetic_mimic(300, 'train', 18)
+    #no notes, so no topic model is needed - every admission gets the missing-topic fill
+    data['notes'] = data['notes'].iloc[:0]
+    return data
+
+
+def inputs(frames, rows=slice(None)):
+    admits = frames['admits'].iloc[rows].reset_index(drop=True)
+    return frames['labs'], admits, frames['vitals'], frames['notes']
+
+
+def test_transform_leaves_inputs_unchanged(frames):
+    pipeline = FeaturePipeline()
+    originals = [df.copy() for df in inputs(frames)]
+    pipeline.fit_transform(*inputs(frames))
+    batch = inputs(frames, slice(0, 50))
+    batch_originals = [df.copy() for df in batch]
+    pipeline.transform(*batch)
+    for df, original in zip(inputs(frames), originals):
+        pd.testing.assert_frame_equal(df, original)
+    for df, original in zip(batch, batch_originals):
+        pd.testing.assert_frame_equal(df, original)
+
+
+def test_transform_matches_training_features(frames):
+    pipeline = FeaturePipeline()
+    X, y = pipeline.fit_transform(*inputs(frames))
+    features, batch_y, keys = pipeline.transform(*inputs(frames, slice(0, 50)))
+    assert features.dtype == np.float32 and features.shape == (50, len(pipeline.columns))
+    expected = X[pipeline.columns].iloc[:50].to_numpy(dtype=np.float32, na_value=np.nan)
+    np.testing.assert_array_equal(features, expected)
+    np.testing.assert_array_equal(batch_y.to_numpy(), y.iloc[:50].to_numpy())
+
+
+def test_unseen_categories_keep_the_training_layout(frames):
+    pipeline = FeaturePipeline()
+    pipeline.fit_transform(*inputs(frames))
+    labs, admits, vitals, notes = inputs(frames, slice(0, 5))
+    admits = admits.assign(admission_type='NEVER SEEN')
+    features, _, _ = pipeline.transform(labs, admits, vitals, notes)
+    hot = [j for j, col in enumerate(pipeline.columns) if col.startswith('x0_')]
+    assert features.shape[1] == len(pipeline.columns)
+    assert (features[:, hot] == 0).all()
+
+
+def test_data_processing_leaves_admissions_unchanged(frames):
+    labs, admits, vitals, notes = inputs(frames)
+    original = admits.copy()
+    id_cols, month_col, age_col, encoding_cols, chronic_cols, merge_cols = data_processing_column_refs()
+    data_processing(labs, normal_lab_vital_ranges(), admits, month_col, encoding_cols, age_col, chronic_cols,
+                    merge_cols, id_cols, vitals, notes)
+    pd.testing.assert_frame_equal(admits, original)
+
+
+def key_sorted(df):
+    return df.sort_values(['subject_id', 'hadm_id'], kind='mergesort').reset_index(drop=True)
+
+
+def test_stream_blocks_share_one_encoding_without_notes(frames):
+    from mimic_features import data_processing_stream
+    labs, admits, vitals, _ = inputs(frames)
+    id_cols, month_col, age_col, encoding_cols, chronic_cols, merge_cols = data_processing_column_refs()
+    args = (normal_lab_vital_ranges(), month_col, encoding_cols, age_col, chronic_cols, merge_cols, id_cols)
+    #the note stream ends without producing a chunk
+    blocks = list(data_processing_stream(admits, [key_sorted(labs)], [key_sorted(vitals)], None, *args,
+                                         admits_per_chunk=40, note_group_cols=['subject_id', 'hadm_id']))
+    assert len(blocks) > 1 and sum(len(X) for X, _ in blocks) == len(admits)
+    #one encoder fit to every admission, so the blocks have the same columns even if a category is missing from one
+    assert all(list(X.columns) == list(blocks[0][0].columns) for X, _ in blocks)
+
+    pipeline = FeaturePipeline()
+    pipeline.fit_transform(labs, admits, vitals, frames['notes'])
+    blocks = list(data_processing_stream(admits, [key_sorted(labs)], [key_sorted(vitals)], None, *args,
+                                         admits_per_chunk=40, note_group_cols=['subject_id', 'hadm_id'], pipeline=pipeline))
+    streamed = pd.concat([X for X, _ in blocks], ignore_index=True)
+    assert list(streamed.columns) == pipeline.columns
+    features, _, _ = pipeline.transform(labs, key_sorted(admits), vitals, frames['notes'])
+    np.testing.assert_array_equal(streamed.to_numpy(), features)
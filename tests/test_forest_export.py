@@ -0,0 +1,61 @@
+import pickle
+
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from forest_export import export_forest, load_flat_forest, float32_threshold, check_parity
+
+
+@pytest.fixture(scope='module')
+def forest():
+    rng = np.random.default_rng(18)
+    X = rng.normal(size=(2000, 12)).astype(np.float32)
+    y = (X[:, :3].sum(axis=1) + rng.normal(scale=0.5, size=len(X)) > 0).astype(int)
+    #missing values, so the export carries each split's missing-value direction
+    X[rng.random(X.shape) < 0.05] = np.nan
+    #trees of uneven depth, so shallow leaves are padded out to the full depth
+    model = RandomForestClassifier(n_estimators=25, max_depth=7, min_samples_leaf=20, random_state=18).fit(X, y)
+    return model, X
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_exported_forest_matches_predict_proba(forest, tmp_path, mmap):
+    model, X = forest
+    flat = load_flat_forest(export_forest(model, str(tmp_path / 'flat')), mmap=mmap)
+    assert flat.n_trees == 25 and flat.depth == max(est.tree_.max_depth for est in model.estimators_)
+    np.testing.assert_allclose(flat.predict_proba(X), model.predict_proba(X), atol=1e-6)
+    #row blocks smaller than the batch, and a pickled copy as sent to a worker
+    flat.block_rows = 97
+    np.testing.assert_allclose(flat.predict_risk(X), model.predict_proba(X)[:, 1], atol=1e-6)
+    np.testing.assert_allclose(pickle.loads(pickle.dumps(flat)).predict_risk(X[:5]), model.predict_proba(X[:5])[:, 1], atol=1e-6)
+    assert check_parity(model, flat, X) <= 1e-6
+    with pytest.raises(ValueError):
+        flat.predict_risk(X[:, :5])
+
+
+def test_float32_threshold_rounds_down():
+    below = np.float32(0.1)
+    above = np.nextafter(below, np.float32(1))
+    #float64 midpoints between adjacent float32 values, which round to nearest (half of them upwards) as float32
+    thresholds = np.array([(float(below) + float(above)) / 2, 2.5, -(float(below) + float(above)) / 2, np.inf])
+    t32 = float32_threshold(thresholds)
+    assert np.all(t32.astype(np.float64) <= thresholds)
+    assert np.all(np.nextafter(t32[:3], np.float32(np.inf)).astype(np.float64) > thresholds[:3])
+    assert t32[1] == np.float32(2.5) and np.isinf(t32[3])
+
+
+def test_split_between_adjacent_float32_values(tmp_path):
+    #the only split falls halfway between two neighbouring float32 values, and (lower having an odd mantissa) the
+    #float64 midpoint rounds to nearest-even as upper, which would then go down the left branch
+    lower = np.nextafter(np.float32(16), np.float32(17))
+    upper = np.nextafter(lower, np.float32(17))
+    X = np.array([[lower], [upper]] * 10, dtype=np.float32)
+    y = np.array([0, 1] * 10)
+    model = RandomForestClassifier(n_estimators=3, bootstrap=False, random_state=18).fit(X, y)
+    threshold = model.estimators_[0].tree_.threshold[0]
+    assert lower < threshold < upper and np.float32(threshold) == upper
+    flat = load_flat_forest(export_forest(model, str(tmp_path / 'flat')))
+    probe = np.array([[lower], [upper], [np.nextafter(lower, np.float32(0))], [np.nextafter(upper, np.float32(17))]], dtype=np.float32)
+    np.testing.assert_array_equal(flat.predict_risk(probe), [0.0, 1.0, 0.0, 1.0])
+    np.testing.assert_array_equal(flat.predict_risk(probe), model.predict_proba(probe)[:, 1])
@@ -0,0 +1,24 @@
+import pandas as pd
+
+from mimic_features import one_hot_encoder, hot_feature_names, hot_coding
+
+
+def admissions():
+    return pd.DataFrame({'admission_type': ['EMERGENCY', 'ELECTIVE', 'EMERGENCY'],
+                         'first_careunit': ['MICU', 'SICU', 'CCU']})
+
+
+def test_hot_coding_uses_the_saved_column_names():
+    df = admissions()
+    enc = hot_coding(df, ['admission_type', 'first_careunit'])
+    names = ['x0_ELECTIVE', 'x0_EMERGENCY', 'x1_CCU', 'x1_MICU', 'x1_SICU']
+    assert hot_feature_names(enc) == names
+    assert df[names].to_numpy().tolist() == [[0, 1, 0, 1, 0], [1, 0, 0, 0, 1], [0, 1, 1, 0, 0]]
+
+
+def test_fitted_encoder_is_applied_without_refit():
+    enc = one_hot_encoder(handle_unknown='ignore')
+    enc.fit(admissions())
+    batch = pd.DataFrame({'admission_type': ['URGENT'], 'first_careunit': ['MICU']})
+    assert hot_coding(batch, ['admission_type', 'first_careunit'], enc) is enc
+    assert batch[hot_feature_names(enc)].to_numpy().tolist() == [[0, 0, 0, 1, 0]]
@@ -0,0 +1,37 @@
+import os
+import re
+
+import pytest
+
+from conftest import SRC_DIR, render
+from incremental_scoring import scope_query, window_params, SCOPE_TABLE
+from bulk_scoring import BULK_SQL
+from daily_pivots import PIVOT_SQL
+
+
+SCOPED = f'(select * from icustays where icustay_id in (select icustay_id from "{SCOPE_TABLE}"))'
+#every query a bulk scoring shard or an incremental refresh runs, with and without --pivots
+EXTRACTIONS = sorted(set(BULK_SQL.values()) | set(PIVOT_SQL.values()))
+
+
+@pytest.mark.parametrize('filename', EXTRACTIONS)
+def test_scope_restricts_the_base_relation(filename):
+    with open(os.path.join(SRC_DIR, filename)) as f:
+        query_text = f.read()
+    scoped = render(scope_query(query_text))
+    #every read of icustays is replaced, so no stay outside the scope reaches the event joins
+    assert scoped.count(SCOPED) == len(re.findall(r'\bicustays\b', query_text, flags=re.IGNORECASE))
+    assert re.findall(r'\bicustays\b', scoped.replace(SCOPED, '')) == []
+    #and the restriction sits ahead of the grouping, inside the base CTE
+    grouping = scoped.lower().find('group by')
+    assert grouping == -1 or scoped.find(SCOPED) < grouping
+
+
+def test_unscopable_query_is_rejected():
+    with pytest.raises(ValueError):
+        scope_query('select * from daily_lab_pivot')
+
+
+def test_window_params():
+    params = window_params({'labevents': (None, 120), 'noteevents': (40, 55)})
+    assert params == {'labevents_after': None, 'labevents_through': 120, 'noteevents_after': 40, 'noteevents_through': 55}
@@ -0,0 +1,158 @@
+import json
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lda_model_pipeline
+import note_tokenizer
+from lda_model_pipeline import grow_dictionary, grow_lda_model, topic_terms, topic_coherence, update_lda_model
+
+CARDIAC = ['ventricle', 'atrium', 'valve', 'mitral', 'aortic', 'systolic']
+RHYTHM = ['sinus', 'rhythm', 'tachycardia', 'bradycardia', 'interval', 'axis']
+
+
+def synthetic_docs(n, vocab, seed=18, length=8):
+    rng = np.random.default_rng(seed)
+    return [list(rng.choice(vocab, size=length)) for _ in range(n)]
+
+
+def fit_lda(docs, num_topics=2):
+    import gensim
+    dictionary = gensim.corpora.Dictionary(docs)
+    corpus = [dictionary.doc2bow(doc) for doc in docs]
+    lda = gensim.models.LdaModel(corpus, num_topics=num_topics, id2word=dictionary, passes=5, random_state=18)
+    return lda, dictionary
+
+
+def test_grow_dictionary_keeps_ids_and_caps_vocabulary():
+    from gensim.corpora import Dictionary
+    dictionary = Dictionary(synthetic_docs(20, CARDIAC))
+    ids = dict(dictionary.token2id)
+    valve_df = dictionary.dfs[ids['valve']]
+    #'effusion' and 'sinus' are in 3 new documents, 'pericardium' in 2 and 'murmur' in only 1
+    new_docs = [['valve', 'effusion', 'pericardium'], ['effusion', 'pericardium', 'mitral'], ['effusion', 'murmur'],
+                ['sinus', 'rhythm'], ['sinus', 'valve'], ['sinus']]
+    added = grow_dictionary(dictionary, new_docs, max_vocab=len(ids) + 2, min_df=2)
+    assert added == 2 and len(dictionary) == len(ids) + 2
+    #known tokens keep their ids, and the most frequent new tokens take the free slots
+    assert all(dictionary.token2id[token] == token_id for token, token_id in ids.items())
+    assert set(dictionary.token2id) - set(ids) == {'sinus', 'effusion'}
+    assert dictionary.dfs[dictionary.token2id['valve']] == valve_df + 2
+    #at the cap nothing more is added
+    assert grow_dictionary(dictionary, new_docs * 3, max_vocab=len(dictionary), min_df=1) == 0
+    assert set(dictionary.token2id) - set(ids) == {'sinus', 'effusion'}
+
+
+def test_grow_lda_model_extends_every_term_array():
+    lda, dictionary = fit_lda(synthetic_docs(40, CARDIAC))
+    known = lda.num_terms
+    topics_before = lda.get_topics().copy()
+    grow_dictionary(dictionary, synthetic_docs(10, RHYTHM), min_df=1)
+    grow_lda_model(lda, len(dictionary))
+    assert lda.num_terms == len(dictionary) == known + len(RHYTHM)
+    assert lda.eta.shape == (len(dictionary),)
+    assert lda.state.eta.shape == (len(dictionary),)
+    assert lda.state.sstats.shape == (lda.num_topics, len(dictionary))
+    assert lda.expElogbeta.shape == (lda.num_topics, len(dictionary))
+    #new terms start at the prior with no counts
+    assert np.all(lda.eta[known:] == lda.eta[0])
+    assert not lda.state.sstats[:, known:].any()
+    #the known terms keep their relative weights within each topic
+    topics = lda.get_topics()
+    np.testing.assert_allclose(topics[:, :known] / topics[:, :known].sum(axis=1, keepdims=True), topics_before, rtol=1e-5)
+    #the grown model takes documents with the new ids
+    lda.id2word = dictionary
+    lda.update([dictionary.doc2bow(doc) for doc in synthetic_docs(10, RHYTHM, seed=5)])
+    assert lda.get_topics().shape == (lda.num_topics, len(dictionary))
+    #growing to the same size is a no-op
+    grow_lda_model(lda, len(dictionary))
+    assert lda.num_terms == len(dictionary)
+
+
+def test_coherent_topics_score_higher():
+    from gensim.corpora import Dictionary
+    docs = synthetic_docs(50, CARDIAC) + synthetic_docs(50, RHYTHM, seed=5)
+    dictionary = Dictionary(docs)
+    coherent = [CARDIAC[:4], RHYTHM[:4]]
+    mixed = [CARDIAC[:2] + RHYTHM[:2], CARDIAC[2:4] + RHYTHM[2:4]]
+    assert topic_coherence(coherent, docs, dictionary, topn=4) > topic_coherence(mixed, docs, dictionary, topn=4)
+
+
+class FakeConn:
+    #answers note_watermark's max(row_id) query
+    def __init__(self, through_row_id):
+        self.through_row_id = through_row_id
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchone(self):
+        return (self.through_row_id,)
+
+
+@pytest.fixture
+def saved_model(tmp_path, monkeypatch):
+    monkeypatch.setattr(note_tokenizer, 'lemmatizer', None)
+    note_tokenizer.lemmatize_stemming.cache_clear()
+    docs = note_tokenizer.preprocess_corpus([' '.join(doc) for doc in synthetic_docs(40, CARDIAC)])
+    lda, dictionary = fit_lda(docs)
+    paths = {'model_path': str(tmp_path / 'lda.pickle'), 'dictionary_path': str(tmp_path / 'lda_dictionary.pickle'),
+             'state_path': str(tmp_path / 'lda_state.json')}
+    lda_model_pipeline.save_lda_model(lda, dictionary, {'last_row_id': 100, 'documents': 40}, **paths)
+    notes = pd.DataFrame({'subject_id': range(20), 'hadm_id': range(100, 120),
+                          'echo_ecg': [' '.join(doc) for doc in synthetic_docs(20, RHYTHM)]})
+    monkeypatch.setattr(lda_model_pipeline, 'data_extraction_chunks', lambda *args, **kwargs: iter([notes[:12], notes[12:]]))
+    yield paths, len(dictionary)
+    note_tokenizer.lemmatize_stemming.cache_clear()
+
+
+def coherence_scores(monkeypatch, before, after):
+    scores = iter([before, after])
+    monkeypatch.setattr(lda_model_pipeline, 'topic_coherence', lambda *args, **kwargs: next(scores))
+
+
+def test_update_promotes_when_coherence_holds(saved_model, monkeypatch):
+    paths, known = saved_model
+    coherence_scores(monkeypatch, -2.0, -2.05)
+    summary = update_lda_model(FakeConn(150), min_df=1, processes=1, **paths)
+    assert summary['promoted'] and summary['notes'] == 20 and summary['tokens_added'] == len(RHYTHM)
+    with open(paths['state_path']) as f:
+        state = json.load(f)
+    assert state['last_row_id'] == 150 and state['documents'] == 60
+    with open(paths['model_path'], 'rb') as f:
+        lda = pickle.load(f)
+    with open(paths['dictionary_path'], 'rb') as f:
+        dictionary = pickle.load(f)
+    assert lda.num_terms == len(dictionary) == known + len(RHYTHM)
+
+
+def test_update_is_rejected_when_coherence_drops(saved_model, monkeypatch):
+    paths, known = saved_model
+    coherence_scores(monkeypatch, -2.0, -2.5)
+    with open(paths['model_path'], 'rb') as f:
+        saved = f.read()
+    summary = update_lda_model(FakeConn(150), min_df=1, processes=1, **paths)
+    assert not summary['promoted'] and summary['documents'] == 20
+    #the saved model, dictionary and watermark are left as they were
+    with open(paths['model_path'], 'rb') as f:
+        assert f.read() == saved
+    with open(paths['state_path']) as f:
+        assert json.load(f)['last_row_id'] == 100
+
+
+def test_update_without_new_notes_does_nothing(saved_model, monkeypatch):
+    paths, _ = saved_model
+    monkeypatch.setattr(lda_model_pipeline, 'data_extraction_chunks', None)
+    summary = update_lda_model(FakeConn(100), **paths)
+    assert summary['documents'] == 0 and not summary['promoted']
@@ -0,0 +1,167 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import mimic_db
+from mimic_db import csv_buffer, copy_frame, insert_data, connect, release, pooled_connection
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table labs (subject_id integer not null, hadm_id integer not null, lactate real, '
+                 'primary key (subject_id, hadm_id))')
+    yield conn
+    conn.close()
+
+
+def rows(conn):
+    return conn.execute('select subject_id, hadm_id, lactate from labs order by subject_id, hadm_id').fetchall()
+
+
+def test_csv_buffer_integers_nulls_and_infinities():
+    df = pd.DataFrame({'icustay_id': [200001.0, np.nan], 'ratio': [np.inf, -np.inf], 'mixed': [1.0, np.inf],
+                       'lactate': [1.5, np.nan], 'charttime': pd.to_datetime(['2130-01-02 03:04:05', None])})
+    assert csv_buffer(df).read().splitlines() == ['200001,inf,1.0,1.5,2130-01-02 03:04:05',
+                                                   ',-inf,inf,,']
+
+
+def test_copy_frame_batches_and_upserts(conn):
+    df = pd.DataFrame({'subject_id': [1, 2, 3], 'hadm_id': [10, 20, 30], 'lactate': [1.0, np.nan, 3.0]})
+    assert copy_frame(conn, df, 'labs', batch_rows=2) == 3
+    assert rows(conn) == [(1, 10, 1.0), (2, 20, None), (3, 30, 3.0)]
+    update = pd.DataFrame({'subject_id': [2, 4], 'hadm_id': [20, 40], 'lactate': [2.0, 4.0]})
+    copy_frame(conn, update, 'labs', upsert_keys=['subject_id', 'hadm_id'], batch_rows=1)
+    assert rows(conn) == [(1, 10, 1.0), (2, 20, 2.0), (3, 30, 3.0), (4, 40, 4.0)]
+
+
+def test_copy_frame_without_commit_leaves_the_transaction_to_the_caller(conn):
+    df = pd.DataFrame({'subject_id': [1, 2, 3], 'hadm_id': [10, 20, 30], 'lactate': [1.0, 2.0, 3.0]})
+    copy_frame(conn, df, 'labs', batch_rows=1, commit=False)
+    conn.rollback()
+    assert rows(conn) == []
+
+
+def test_insert_data_rolls_back_a_partial_load(conn):
+    conn.execute('insert into labs values (1, 10, 1.0)')
+    conn.commit()
+    #the last row duplicates the key, after the first two have been loaded
+    df = pd.DataFrame({'subject_id': [2, 3, 1], 'hadm_id': [20, 30, 10], 'lactate': [2.0, 3.0, 9.0]})
+    assert insert_data(None, df, 'labs', conn) == 1
+    assert rows(conn) == [(1, 10, 1.0)]
+    assert insert_data(None, df.iloc[:2], 'labs', conn) is None
+    assert rows(conn) == [(1, 10, 1.0), (2, 20, 2.0), (3, 30, 3.0)]
+
+
+class FakePool:
+    def __init__(self, size):
+        self.free = [object.__new__(FakeConnection) for _ in range(size)]
+
+    def getconn(self):
+        if not self.free:
+            raise RuntimeError('connection pool exhausted')
+        return self.free.pop()
+
+    def putconn(self, conn):
+        self.free.append(conn)
+
+
+class FakeConnection:
+    closed = 0
+
+    def rollback(self):
+        pass
+
+
+def test_connect_raises_instead_of_exiting_and_connections_go_back(monkeypatch):
+    pool = FakePool(1)
+    monkeypatch.setattr(mimic_db, 'get_pool', lambda connection_details=None: pool)
+    details = {'dbname': 'mimic'}
+    for _ in range(3):
+        with pooled_connection(details) as conn:
+            assert isinstance(conn, FakeConnection)
+    held = connect(details)
+    with pytest.raises(RuntimeError, match='exhausted'):
+        connect(details)
+    release(held)
+    assert pool.free == [held]
+
+
+class FakeNamedCursor:
+    #server-side cursor over fixed rows; like psycopg2, description is only known once the query has run
+    def __init__(self, rows, columns):
+        self.rows = list(rows)
+        self.columns = columns
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.description = [(col,) for col in self.columns]
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+
+class FakeStreamConnection:
+    def __init__(self, rows, columns=('subject_id', 'hadm_id', 'lactate')):
+        self.rows = rows
+        self.columns = list(columns)
+
+    def cursor(self, name=None):
+        return FakeNamedCursor(self.rows, self.columns)
+
+
+@pytest.fixture
+def query_file(tmp_path):
+    path = tmp_path / 'labs.sql'
+    path.write_text('select subject_id, hadm_id, lactate from labs order by subject_id, hadm_id')
+    return str(path)
+
+
+def test_chunks_carry_a_key_across_chunk_boundaries(query_file):
+    #admission (2, 20) spans the first three fetches of two rows
+    rows = [(1, 10, 1.0), (2, 20, 2.0), (2, 20, 2.5), (2, 20, 3.0), (2, 21, 4.0), (3, 30, 5.0)]
+    chunks = list(mimic_db.data_extraction_chunks(query_file, FakeStreamConnection(rows), chunksize=2, downcast=False))
+    assert [chunk['hadm_id'].tolist() for chunk in chunks] == [[10], [20, 20, 20, 21], [30]]
+    assert pd.concat(chunks)['lactate'].tolist() == [row[2] for row in rows]
+
+
+def test_chunks_of_an_empty_query_keep_its_columns(query_file):
+    chunks = list(mimic_db.data_extraction_chunks(query_file, FakeStreamConnection([]), downcast=False))
+    assert len(chunks) == 1 and chunks[0].empty
+    assert list(chunks[0].columns) == ['subject_id', 'hadm_id', 'lactate']
+
+
+def key_frame(keys):
+    return pd.DataFrame({'subject_id': [k[0] for k in keys], 'hadm_id': [k[1] for k in keys],
+                         'lactate': np.arange(len(keys), dtype=float)})
+
+
+def test_take_through_splits_and_buffers_chunks():
+    chunks = [key_frame([(1, 10), (1, 11), (2, 20)]), key_frame([(2, 21), (4, 40)])]
+    stream = mimic_db.KeyAlignedStream(chunks)
+    key = lambda subject_id, hadm_id: subject_id * 2**31 + hadm_id
+    assert stream.take_through(key(1, 11))['hadm_id'].tolist() == [10, 11]
+    #a block can reach into the next chunk, taking the rest of the buffered one first
+    assert stream.take_through(key(3, 30))['hadm_id'].tolist() == [20, 21]
+    #nothing up to the key: an empty frame with the stream's columns
+    empty = stream.take_through(key(3, 99))
+    assert empty.empty and list(empty.columns) == ['subject_id', 'hadm_id', 'lactate']
+    assert stream.take_through(key(9, 90))['hadm_id'].tolist() == [40]
+    assert stream.take_through(key(9, 99)).empty
+
+
+def test_take_through_without_chunks_uses_the_given_columns():
+    stream = mimic_db.KeyAlignedStream(None, columns=['subject_id', 'hadm_id', 'echo_ecg'])
+    assert list(stream.take_through(2**40).columns) == ['subject_id', 'hadm_id', 'echo_ecg']
+    #an empty first chunk (see data_extraction_chunks) supplies the schema itself
+    stream = mimic_db.KeyAlignedStream([key_frame([])])
+    assert list(stream.take_through(2**40).columns) == ['subject_id', 'hadm_id', 'lactate']
@@ -0,0 +1,49 @@
+import os
+import pickle
+
+from model_registry import ModelRegistry
+
+
+def write_pickle(path, obj, mtime_ns=None):
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_get_caches_and_reloads_a_rewritten_file(tmp_path):
+    path = str(tmp_path / 'model.pickle')
+    write_pickle(path, {'version': 1}, mtime_ns=1_000_000_000_000_000_000)
+    registry = ModelRegistry()
+
+    first = registry.get(path)
+    assert first == {'version': 1}
+    assert registry.stats['misses'] == 1 and registry.stats['loads'] == 1 and registry.stats['hits'] == 0
+    #the same object is served from memory, also for a relative spelling of the path
+    assert registry.get(path) is first
+    assert registry.get(os.path.relpath(path)) is first
+    assert registry.stats['hits'] == 2 and registry.stats['loads'] == 1
+
+    #a re-trained model dropped in place, with a newer modification time
+    write_pickle(path, {'version': 2}, mtime_ns=1_000_000_001_000_000_000)
+    second = registry.get(path)
+    assert second == {'version': 2} and second is not first
+    assert registry.get(path) is second
+    assert {key: registry.stats[key] for key in ('hits', 'misses', 'loads', 'reloads')} == \
+        {'hits': 3, 'misses': 2, 'loads': 2, 'reloads': 1}
+    assert registry.stats['load_seconds'] > 0
+
+
+def test_evict_and_reset_stats(tmp_path):
+    path = str(tmp_path / 'model.pickle')
+    write_pickle(path, [1, 2, 3])
+    loads = []
+    registry = ModelRegistry()
+    loader = lambda p: loads.append(p) or [1, 2, 3]
+    registry.get(path, loader)
+    registry.evict(path)
+    #an evicted file is loaded again, as a first load rather than a reload
+    registry.get(path, loader)
+    assert len(loads) == 2 and registry.stats['reloads'] == 0
+    registry.reset_stats()
+    assert registry.stats == {'hits': 0, 'misses': 0, 'loads': 0, 'reloads': 0, 'load_seconds': 0.0}
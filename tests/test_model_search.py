@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from model_search import refit
+from mimic_features import align_to_model
+
+
+@pytest.mark.parametrize('model_type, params', [('rf', {'n_estimators': 20, 'max_depth': 4, 'max_features': 'sqrt', 'n_jobs': 1}),
+                                                ('lr', {'C': 1.0})])
+def test_refit_keeps_feature_names(model_type, params):
+    rng = np.random.default_rng(18)
+    X = pd.DataFrame(rng.normal(size=(400, 6)), columns=[f'f{i}' for i in range(6)])
+    y = pd.Series((X['f0'] + X['f3'] > 0).astype(int))
+    cm = refit(model_type, params, X, y)
+    assert list(cm.feature_names_in_) == list(X.columns)
+    #a scoring frame with its columns in another order and an extra id column is lined up with the training layout
+    scoring = X.astype(np.float32)[X.columns[::-1]].assign(icustay_id=np.arange(len(X)))
+    np.testing.assert_array_equal(cm.predict_proba(align_to_model(scoring, cm)), cm.predict_proba(X.astype(np.float32)))
@@ -0,0 +1,92 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import note_tokenizer
+from conftest import SRC_DIR
+from note_tokenizer import load_lemmatizer, lemmatize_stemming, preprocess, stemmer
+
+
+class MissingWordnet:
+    def lemmatize(self, token, pos='n'):
+        raise LookupError("Resource 'wordnet' not found.")
+
+
+@pytest.fixture
+def stem_only(monkeypatch):
+    monkeypatch.setattr(note_tokenizer, 'lemmatizer', None)
+    lemmatize_stemming.cache_clear()
+    yield
+    lemmatize_stemming.cache_clear()
+
+
+def test_missing_wordnet_data_raises(monkeypatch):
+    monkeypatch.delenv(note_tokenizer.STEM_ONLY_ENV, raising=False)
+    monkeypatch.setattr(note_tokenizer, 'WordNetLemmatizer', MissingWordnet)
+    with pytest.raises(LookupError, match='wordnet'):
+        load_lemmatizer()
+    #stemming only is an explicit opt-in, by argument or env var
+    assert load_lemmatizer(stem_only=True) is None
+    monkeypatch.setenv(note_tokenizer.STEM_ONLY_ENV, '1')
+    assert load_lemmatizer() is None
+
+
+def test_import_does_not_load_the_lemmatizer():
+    code = 'import note_tokenizer; assert note_tokenizer.lemmatizer is note_tokenizer.UNLOADED'
+    done = subprocess.run([sys.executable, '-c', code], cwd=SRC_DIR, capture_output=True, text=True,
+                          env={**os.environ, 'PYTHONPATH': SRC_DIR})
+    assert done.returncode == 0, done.stderr
+    assert done.stdout == ''
+
+
+def test_stem_only_tokens(stem_only):
+    tokens = preprocess('The ventricles were dilated, with moderate regurgitation noted')
+    assert tokens == [stemmer.stem(token) for token in ['ventricles', 'dilated', 'moderate', 'regurgitation', 'noted']]
+
+
+class FixedTopics:
+    #stands in for the LDA model with known topic weights per document
+    num_topics = 5
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def get_document_topics(self, corpus):
+        return [[(topic, weight) for topic, weight in enumerate(row) if weight > 0] for row in self.weights]
+
+
+def test_top_topics_are_the_two_heaviest(stem_only):
+    from gensim.corpora import Dictionary
+    from mimic_text import echoecg_topics
+    notes = pd.DataFrame({'subject_id': [1, 2, 3], 'hadm_id': [10, 20, 30], 'icustay_id': [100, 200, 300],
+                          'echo_ecg': ['sinus rhythm noted', 'mitral valve regurgitation', 'pericardial effusion noted']})
+    dictionary = Dictionary(note_tokenizer.preprocess_corpus(notes['echo_ecg']))
+    weights = np.array([[0.1, 0.6, 0.0, 0.3, 0.0],
+                        [0.0, 0.0, 0.2, 0.0, 0.8],
+                        [0.45, 0.0, 0.0, 0.05, 0.5]])
+    topics = echoecg_topics(notes, lda_model=FixedTopics(weights), dictionary=dictionary)
+    assert list(topics.columns) == ['subject_id', 'hadm_id', 'icustay_id', 'top2', 'top1']
+    assert topics['top1'].tolist() == [1, 4, 4]
+    assert topics['top2'].tolist() == [3, 2, 0]
+
+
+def test_top_topics_keep_a_gapped_index(stem_only):
+    #notes left after a dropna keep their original labels; each must get its own document's topics
+    from gensim.corpora import Dictionary
+    from mimic_text import echoecg_topics
+    notes = pd.DataFrame({'subject_id': [1, 2, 3], 'hadm_id': [10, 20, 30], 'icustay_id': [100, 200, 300],
+                          'echo_ecg': ['sinus rhythm noted', 'mitral valve regurgitation', 'pericardial effusion noted']},
+                         index=[2, 5, 9])
+    dictionary = Dictionary(note_tokenizer.preprocess_corpus(notes['echo_ecg']))
+    weights = np.array([[0.1, 0.6, 0.0, 0.3, 0.0],
+                        [0.0, 0.0, 0.2, 0.0, 0.8],
+                        [0.45, 0.0, 0.0, 0.05, 0.5]])
+    topics = echoecg_topics(notes, lda_model=FixedTopics(weights), dictionary=dictionary)
+    assert topics.index.tolist() == [2, 5, 9]
+    assert topics['subject_id'].tolist() == [1, 2, 3]
+    assert topics['top1'].tolist() == [1, 4, 4]
+    assert topics['top2'].tolist() == [3, 2, 0]
@@ -0,0 +1,92 @@
+import json
+import threading
+
+import pytest
+
+from pipeline_metrics import PipelineMetrics
+
+
+def test_nested_stages_are_named_by_path():
+    metrics = PipelineMetrics(echo=0)
+    with metrics.stage('data_processing', 10) as outer:
+        with metrics.stage('transform_labs', 10) as inner:
+            inner.output([1, 2, 3])
+        with metrics.stage('transform_labs'):
+            pass
+        outer.output(7)
+    assert set(metrics.totals) == {'data_processing', 'data_processing/transform_labs'}
+    assert metrics.totals['data_processing/transform_labs']['calls'] == 2
+    last = metrics.totals['data_processing']['last']
+    assert last['rows_in'] == 10 and last['rows_out'] == 7 and last['depth'] == 0
+    assert metrics.totals['data_processing/transform_labs']['last']['depth'] == 1
+
+
+def test_a_failing_stage_is_recorded_and_re_raised(capsys):
+    metrics = PipelineMetrics(echo=1)
+
+    @metrics.timed()
+    def featurize(df):
+        raise KeyError('echo_ecg')
+
+    with pytest.raises(KeyError):
+        featurize(None)
+    total = metrics.totals['featurize']
+    assert total['calls'] == 1 and total['errors'] == 1
+    assert total['last']['error'] == "KeyError: 'echo_ecg'"
+    out = capsys.readouterr().out
+    assert out.startswith('featurize: ') and "FAILED KeyError: 'echo_ecg'" in out
+
+
+def test_jsonl_records_are_appended(tmp_path):
+    path = str(tmp_path / 'metrics.jsonl')
+    for run in range(2):
+        metrics = PipelineMetrics(path, 'jsonl', echo=0)
+        with metrics.stage('extract', 5) as current:
+            current.output(run)
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [record['stage'] for record in records] == ['extract', 'extract']
+    assert [record['rows_out'] for record in records] == [0, 1]
+
+
+def test_prometheus_file_is_rewritten_with_totals(tmp_path):
+    path = tmp_path / 'metrics.prom'
+    metrics = PipelineMetrics(str(path), 'prom', echo=0)
+    with metrics.stage('predict', 3):
+        pass
+    assert 'mimic_stage_calls_total{stage="predict"} 1' in path.read_text()
+    with metrics.stage('predict', 4):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.stage('say "hi"'):
+            raise ValueError('bad')
+    text = path.read_text()
+    #the file holds the current totals only, never appended copies
+    assert text.count('# TYPE mimic_stage_calls_total counter') == 1
+    assert 'mimic_stage_calls_total{stage="predict"} 2' in text
+    assert 'mimic_stage_last_rows_in{stage="predict"} 4' in text
+    assert 'mimic_stage_errors_total{stage="say \\"hi\\""} 1' in text
+    assert not (tmp_path / 'metrics.prom.tmp').exists()
+
+
+def test_one_cprofile_profiler_across_threads(tmp_path):
+    metrics = PipelineMetrics(profile='cprofile', profile_dir=str(tmp_path), echo=0)
+    ready = threading.Barrier(4)
+
+    def run(i):
+        ready.wait()
+        with metrics.stage(f'worker{i}'):
+            sum(range(10000))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    profiled = [name for name, total in metrics.totals.items() if 'profile' in total['last']]
+    assert 1 <= len(profiled) <= 4
+    assert not metrics._cprofile_active
+    #once released the profiler is claimed again
+    with metrics.stage('after'):
+        pass
+    assert 'profile' in metrics.totals['after']['last']
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import pickle
+import types
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+import scoring_service
+from scoring_service import ScoringService, ADMISSION_FIELDS, VITAL_FIELDS
+from synthetic_mimic import synthetic_mimic
+from feature_pipeline import FeaturePipeline
+from pipeline_metrics import metrics
+
+
+@pytest.fixture(scope='module')
+def fitted(tmp_path_factory):
+    data = synthetic_mimic(300, 'train', 18)
+    #no notes, so no topic model is needed - every admission gets the missing-topic fill
+    data['notes'] = data['notes'].iloc[:0]
+    pipeline = FeaturePipeline()
+    X, y = pipeline.fit_transform(data['labs'], data['admits'], data['vitals'], data['notes'])
+    model = RandomForestClassifier(n_estimators=10, max_depth=4, random_state=18).fit(X[pipeline.columns], y)
+    path = tmp_path_factory.mktemp('service')
+    paths = {name: str(path / f'{name}.pickle') for name in ('model', 'pipeline', 'lda')}
+    for name, obj in (('model', model), ('pipeline', pipeline), ('lda', types.SimpleNamespace(id2word={}))):
+        with open(paths[name], 'wb') as f:
+            pickle.dump(obj, f)
+    return data, pipeline, model, paths
+
+
+def payloads(data, n):
+    admits = data['admits'].head(n)
+    labs = data['labs'].set_index(['subject_id', 'hadm_id'])
+    vitals = data['vitals'].set_index(['subject_id', 'hadm_id'])
+    out = []
+    for row in admits.to_dict('records'):
+        key = (row['subject_id'], row['hadm_id'])
+        out.append({'admission': {field: row[field] for field in ADMISSION_FIELDS},
+                    'labs': {col: val for col, val in labs.loc[key].items() if val == val},
+                    'vitals': {col: val for col, val in vitals.loc[key].items() if val == val}})
+    return json.loads(json.dumps(out, default=float))
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    data = json.dumps(body).encode('utf-8') if body is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(body)
+
+
+async def post_batch_then_stats(service, batch, bad=()):
+    service.queue = asyncio.Queue()
+    worker = asyncio.create_task(service.batch_worker())
+    server = await asyncio.start_server(service.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        scored = await asyncio.gather(*(request(port, 'POST', '/score', payload) for payload in list(batch) + list(bad)))
+        stats = await request(port, 'GET', '/stats')
+        missing = await request(port, 'POST', '/score', {'labs': {}})
+    finally:
+        server.close()
+        await server.wait_closed()
+        worker.cancel()
+    return scored, stats, missing
+
+
+def test_score_batch_and_stats(fitted, monkeypatch, capsys):
+    data, pipeline, model, paths = fitted
+    monkeypatch.setattr(scoring_service, 'LDA_MODEL_PATH', paths['lda'])
+    monkeypatch.setattr(scoring_service, 'LDA_DICTIONARY_PATH', paths['lda'] + '.missing')
+    #the per-stage echo is the caller's setting (--echo), not the service's
+    monkeypatch.setattr(metrics, 'echo', 1)
+    service = ScoringService(paths['model'], paths['pipeline'], max_batch=16, max_wait_ms=200)
+    assert metrics.echo == 1
+    metrics.echo = 0
+    batch = payloads(data, 12)
+    bad = [{**batch[0], 'labs': {'lactate': 'high'}}, {'admission': 'none'}, [batch[1]]]
+
+    with warnings.catch_warnings():
+        #e.g. sklearn's "X does not have valid feature names" for a model fit on a dataframe
+        warnings.simplefilter('error')
+        scored, (status, stats), (missing_status, missing) = asyncio.run(post_batch_then_stats(service, batch, bad))
+
+    #the malformed requests are turned away without failing the rest of their micro-batch
+    assert [status for status, _ in scored] == [200] * len(batch) + [400] * len(bad)
+    assert 'lactate' in scored[len(batch)][1]['error']
+    risks = np.array([body['mortality_risk'] for _, body in scored[:len(batch)]])
+    lab_cols = [col for col in pipeline.norm_ranges if col not in VITAL_FIELDS]
+    vital_cols = [col for col in pipeline.norm_ranges if col in VITAL_FIELDS]
+    features, y, keys = pipeline.transform(*scoring_service.payload_frames(batch, lab_cols, vital_cols))
+    np.testing.assert_allclose(risks, model.predict_proba(pd.DataFrame(features, columns=pipeline.columns))[:, 1])
+
+    assert status == 200
+    assert stats['requests'] == len(batch)
+    assert stats['p50_ms'] is not None and stats['p99_ms'] >= stats['p50_ms']
+    assert stats['throughput_rps'] > 0
+    #concurrent requests are micro-batched together
+    assert stats['mean_batch_size'] > 1
+    assert missing_status == 400 and 'admission' in missing['error']
+    assert capsys.readouterr().out == ''
+
+
+def test_a_failing_request_does_not_fail_its_batch(fitted, monkeypatch):
+    data, pipeline, model, paths = fitted
+    monkeypatch.setattr(scoring_service, 'LDA_MODEL_PATH', paths['lda'])
+    monkeypatch.setattr(scoring_service, 'LDA_DICTIONARY_PATH', paths['lda'] + '.missing')
+    service = ScoringService(paths['model'], paths['pipeline'], max_batch=16, max_wait_ms=200)
+    score_batch = service.score_batch
+
+    def fails_on_bad_age(batch):
+        #stands in for a request that is well formed but cannot be featurized
+        if any(payload['admission'].get('age_') == -1 for payload in batch):
+            raise ValueError('age out of range')
+        return score_batch(batch)
+
+    monkeypatch.setattr(service, 'score_batch', fails_on_bad_age)
+    batch = payloads(data, 6)
+    bad = {**batch[2], 'admission': {**batch[2]['admission'], 'age_': -1}}
+    scored, (_, stats), _ = asyncio.run(post_batch_then_stats(service, batch[:2] + [bad] + batch[3:]))
+    assert [status for status, _ in scored] == [200, 200, 400, 200, 200, 200]
+    alone = [score_batch([payload])[0] for payload in batch[:2] + batch[3:]]
+    np.testing.assert_allclose([body['mortality_risk'] for status, body in scored if status == 200], alone)
+    assert stats['requests'] == 5
@@ -0,0 +1,24 @@
+import pickle
+import types
+
+from mimic_text import topic_dictionary_path, load_topic_dictionary
+from model_registry import LDA_MODEL_PATH, LDA_DICTIONARY_PATH
+
+
+def test_dictionary_path_follows_model_path(tmp_path):
+    assert topic_dictionary_path(LDA_MODEL_PATH) == LDA_DICTIONARY_PATH
+    assert topic_dictionary_path(str(tmp_path / 'other.pickle')) == str(tmp_path / 'other_dictionary.pickle')
+
+
+def test_model_without_dictionary_file_uses_its_id2word(tmp_path):
+    model = types.SimpleNamespace(id2word={0: 'own'})
+    assert load_topic_dictionary(model) is model.id2word
+    assert load_topic_dictionary(model, str(tmp_path / 'missing_dictionary.pickle')) is model.id2word
+
+
+def test_saved_dictionary_is_loaded(tmp_path):
+    path = tmp_path / 'model_dictionary.pickle'
+    with open(path, 'wb') as f:
+        pickle.dump({0: 'saved'}, f)
+    model = types.SimpleNamespace(id2word={0: 'own'})
+    assert load_topic_dictionary(model, str(path)) == {0: 'saved'}
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from mimic_features import normal_lab_vital_ranges, lab_val_scale, transform_labs
+
+
+def lab_frame(rows=20000, seed=18):
+    #values spread well beyond each normal range, with exact bounds and missing values mixed in
+    norm_ranges = normal_lab_vital_ranges()
+    rng = np.random.default_rng(seed)
+    data = {}
+    for lab, (low, high) in norm_ranges.items():
+        width = high - low
+        values = rng.uniform(low - 3 * width, high + 3 * width, rows)
+        values[rng.random(rows) < .05] = low
+        values[rng.random(rows) < .05] = high
+        values[rng.random(rows) < .1] = np.nan
+        data[lab] = values
+    return pd.DataFrame(data), norm_ranges
+
+
+def test_transform_labs_matches_lab_val_scale():
+    df, norm_ranges = lab_frame()
+    expected = pd.DataFrame({lab: df[lab].apply(lab_val_scale, args=(norm_ranges[lab],)) for lab in norm_ranges})
+    result = transform_labs(df, norm_ranges, inplace=False)
+    #numpy squares exactly where python's float pow may round the last bit differently
+    np.testing.assert_allclose(result[list(norm_ranges)].to_numpy(), expected.to_numpy(), rtol=1e-12, atol=1e-15)
+
+
+def test_transform_labs_bounds_and_missing():
+    df, norm_ranges = lab_frame(rows=500)
+    result = transform_labs(df, norm_ranges, inplace=False)
+    for lab, (low, high) in norm_ranges.items():
+        in_range = df[lab].between(low, high) | df[lab].isna()
+        assert (result.loc[in_range, lab] == 0).all()
+        assert (result.loc[df[lab] > high, lab] > 0).all()
+        assert (result.loc[df[lab] < low, lab] < 0).all()
+
+
+def test_transform_labs_inplace_flag():
+    df, norm_ranges = lab_frame(rows=100)
+    original = df.copy()
+    transform_labs(df, norm_ranges, inplace=False)
+    pd.testing.assert_frame_equal(df, original)
+    transform_labs(df, norm_ranges)
+    assert not df.equals(original)